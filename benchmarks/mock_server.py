@@ -0,0 +1,583 @@
+# Local stand-in for the Spotify and TIDAL endpoints used by main.py, for offline benchmarks
+# Spotify is served under /spotify/v1 and TIDAL under /tidal/v2, with a synthetic library that is generated
+# on the fly (so 100k tracks need no memory), configurable latency, page size and 429 injection
+# Track objects are as large as the real ones (album, markets, URLs), unless the request has a fields filter
+# Usage: python benchmarks/mock_server.py --tracks 10000 --latency 0.05 --rate-limit 0.01
+# then run main.py with SPOTIFY_BASE_URL=http://127.0.0.1:8900/spotify/v1 TIDAL_BASE_URL=http://127.0.0.1:8900/tidal/v2
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 8900
+TIDAL_PAGE_SIZE = 20  # resources per page of the TIDAL playlist listing and playlist items
+MOCK_USER_ID = "mock-user"
+TOP_ARTIST_COUNT = 10  # artists that get the top artist share of the tracks
+TRACKS_PER_ALBUM = 12
+TIDAL_TRACK_ID_OFFSET = 100000000  # TIDAL track ID of the track index 0
+SPOTIFY_MAX_LIMITS = {"spotify /me/playlists": 50, "spotify /me/tracks": 50, "spotify /playlists/{id}/tracks": 100}  # larger limits are a 400
+MARKETS = ["AD", "AE", "AR", "AT", "AU", "BE", "BG", "BO", "BR", "CA", "CH", "CL", "CO", "CR", "CY", "CZ", "DE", "DK",
+           "DO", "EC", "EE", "ES", "FI", "FR", "GB", "GR", "GT", "HK", "HN", "HU", "ID", "IE", "IL", "IS", "IT", "JP",
+           "LI", "LT", "LU", "LV", "MC", "MT", "MX", "MY", "NI", "NL", "NO", "NZ", "PA", "PE", "PH", "PL", "PT", "PY",
+           "RO", "SE", "SG", "SK", "SV", "TH", "TR", "TW", "US", "UY", "VN", "ZA"]
+
+# Deterministic pseudo-random number for the given parts
+def stableHash(*parts):
+    return int.from_bytes(hashlib.blake2b("/".join(map(str, parts)).encode("utf-8"), digest_size=8).digest(), "big")
+
+# Synthetic music library: a pool of unique tracks spread over playlists and liked songs,
+# so that the same tracks appear in several playlists like in a real library
+# With a top artist share, that share of the tracks is by a few artists, like the favorite artists of a real library
+class SyntheticLibrary:
+    def __init__(self, trackCount, playlistCount=None, seed=0, topArtistShare=0.0):
+        self.seed = seed
+        self.topArtistShare = topArtistShare
+        self.trackCount = trackCount
+        self.uniqueTrackCount = max(1, int(trackCount * 0.6))
+        self.artistCount = max(1, self.uniqueTrackCount // 20)
+        self.likedCount = int(trackCount * 0.3)
+        self.playlistCount = playlistCount or max(1, trackCount // 100)
+        # split the remaining entries over the playlists with varying lengths
+        playlistEntries = trackCount - self.likedCount
+        weights = [1 + stableHash(seed, "weight", i) % 10 for i in range(self.playlistCount)]
+        self.playlistLengths = [playlistEntries * weight // sum(weights) for weight in weights]
+        self.playlistLengths[-1] += playlistEntries - sum(self.playlistLengths)
+        self.artistTracks = None  # artist index -> unique track indexes, built on the first artist catalog request
+        self.artistTracksLock = threading.Lock()
+
+    def artistIndex(self, trackIndex):
+        artistCount = self.artistCount
+        if stableHash(self.seed, "top", trackIndex) % 1000 < self.topArtistShare * 1000:
+            artistCount = min(TOP_ARTIST_COUNT, self.artistCount)
+        return stableHash(self.seed, "artist", trackIndex) % artistCount
+
+    # Returns the indexes of the unique tracks whose primary artist is the given artist
+    def tracksOfArtist(self, artistIndex):
+        with self.artistTracksLock:
+            if self.artistTracks is None:
+                self.artistTracks = {}
+                for trackIndex in range(self.uniqueTrackCount):
+                    self.artistTracks.setdefault(self.artistIndex(trackIndex), []).append(trackIndex)
+        return self.artistTracks.get(artistIndex, [])
+
+    # Some titles are decorated like real Spotify titles (remasters, mixes, "feat." credits with extra artists)
+    def track(self, trackIndex):
+        artistIndex = self.artistIndex(trackIndex)
+        hasIsrc = stableHash(self.seed, "isrc", trackIndex) % 10 < 7
+        artist = spotifyObject("artist", f"artist{artistIndex}", name=f"Artist {artistIndex}")
+        artists = [artist]
+        name = f"Song {trackIndex}"
+        match stableHash(self.seed, "decoration", trackIndex) % 20:
+            case 0 | 1:
+                name += f" - Remastered {2000 + trackIndex % 20}"
+            case 2:
+                name += f" - Artist {artistIndex} Original Mix"
+            case 3 | 4:
+                featuredIndex = (artistIndex + 1) % self.artistCount
+                name += f" (feat. Artist {featuredIndex})"
+                artists.append(spotifyObject("artist", f"artist{featuredIndex}", name=f"Artist {featuredIndex}"))
+            case 5:
+                artists += [spotifyObject("artist", f"artist{(artistIndex + i) % self.artistCount}",
+                                          name=f"Artist {(artistIndex + i) % self.artistCount}") for i in range(1, 5)]
+        albumId = f"album{trackIndex // TRACKS_PER_ALBUM}"
+        return spotifyObject("track", f"track{trackIndex}",
+            name=name,
+            artists=artists,
+            duration_ms=120000 + stableHash(self.seed, "duration", trackIndex) % 240000,
+            external_ids={"isrc": f"MOCK{trackIndex:08d}"} if hasIsrc else {},
+            album=spotifyObject("album", albumId, name=f"Album {trackIndex // TRACKS_PER_ALBUM}", album_type="album",
+                                artists=[artist], available_markets=MARKETS, release_date="2020-01-01",
+                                release_date_precision="day", total_tracks=TRACKS_PER_ALBUM,
+                                images=[{"url": f"https://i.scdn.co/image/{albumId}-{size}", "height": size, "width": size}
+                                        for size in (640, 300, 64)]),
+            available_markets=MARKETS,
+            disc_number=1,
+            track_number=trackIndex % TRACKS_PER_ALBUM + 1,
+            explicit=False,
+            is_local=False,
+            popularity=stableHash(self.seed, "popularity", trackIndex) % 100,
+            preview_url=f"https://p.scdn.co/mp3-preview/track{trackIndex}")
+
+    def playlist(self, playlistIndex):
+        return {
+            "id": f"playlist{playlistIndex}",
+            "name": f"Playlist {playlistIndex}",
+            "snapshot_id": f"snapshot{self.seed}",
+            "tracks": {"total": self.playlistLengths[playlistIndex]}
+        }
+
+    def playlistItem(self, playlistIndex, position):
+        return {"added_at": "2024-01-01T00:00:00Z", "is_local": False, "primary_color": None,
+                "added_by": spotifyObject("user", "mockuser"), "video_thumbnail": {"url": None},
+                "track": self.track(stableHash(self.seed, "playlist", playlistIndex, position) % self.uniqueTrackCount)}
+
+    def likedItem(self, position):
+        addedAt = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(1700000000 - position * 60))
+        return {"added_at": addedAt, "track": self.track(stableHash(self.seed, "liked", position) % self.uniqueTrackCount)}
+
+    # TIDAL finds most, but not all tracks
+    def tidalTrackId(self, trackIndex):
+        if stableHash(self.seed, "tidal", trackIndex) % 10 == 0:
+            return None
+        return str(TIDAL_TRACK_ID_OFFSET + trackIndex)
+
+    # Returns the TIDAL track resource and its artist resources as included in search results
+    # TIDAL titles have no decorations, versions (e.g. remasters) are a separate attribute
+    # A decoy is another recording of the same title (a live version by another artist), that TIDAL sometimes ranks first
+    def tidalTrackResources(self, trackIndex, decoy=False):
+        spotifyTrack = self.track(trackIndex)
+        artistNames = [artist["name"] for artist in spotifyTrack["artists"]]
+        durationMs = spotifyTrack["duration_ms"]
+        trackId = self.tidalTrackId(trackIndex)
+        version = "Remastered" if "Remastered" in spotifyTrack["name"] else None
+        if decoy:
+            artistNames = [f"Artist {(stableHash(self.seed, 'decoy', trackIndex) % self.artistCount) + self.artistCount}"]
+            durationMs += 90000
+            trackId = str(900000000 + trackIndex)
+            version = "Live"
+        artists = [{"id": f"tidal-{name.replace(' ', '-').lower()}", "type": "artists", "attributes": {"name": name}}
+                   for name in artistNames]
+        track = {
+            "id": trackId,
+            "type": "tracks",
+            "attributes": {"title": f"Song {trackIndex}", "version": version,
+                           "duration": f"PT{durationMs // 60000}M{durationMs % 60000 / 1000:g}S"},
+            "relationships": {"artists": {"data": [{"id": artist["id"], "type": "artists"} for artist in artists]}}
+        }
+        return track, artists
+
+# Returns a Spotify object with the usual id, type, uri, href and external URL fields
+def spotifyObject(objectType, objectId, **fields):
+    return {
+        "id": objectId,
+        "type": objectType,
+        "uri": f"spotify:{objectType}:{objectId}",
+        "href": f"https://api.spotify.com/v1/{objectType}s/{objectId}",
+        "external_urls": {"spotify": f"https://open.spotify.com/{objectType}/{objectId}"},
+        **fields
+    }
+
+# Parses a Spotify fields filter like "total,items(track(name,artists(name)))"
+# Returns a dict of field names to the filter of their subfields (None for the whole field)
+def parseFields(fields):
+    def parse(position):
+        result = {}
+        while position < len(fields):
+            end = position
+            while end < len(fields) and fields[end] not in ",()":
+                end += 1
+            name = fields[position:end]
+            if end < len(fields) and fields[end] == "(":
+                result[name], end = parse(end + 1)
+            else:
+                result[name] = None
+            if end < len(fields) and fields[end] == ")":
+                return result, end + 1
+            position = end + 1
+        return result, position
+    return parse(0)[0]
+
+# Keeps only the filtered fields of a response, filters apply to every element of a list
+def projectFields(data, fieldFilter):
+    if fieldFilter is None:
+        return data
+    if isinstance(data, list):
+        return [projectFields(item, fieldFilter) for item in data]
+    if isinstance(data, dict):
+        return {name: projectFields(data[name], subFilter) for name, subFilter in fieldFilter.items() if name in data}
+    return data
+
+# Shared state of the mock server: configuration, library, created playlists and request statistics
+class MockState:
+    def __init__(self, library, latency=0.0, pageSize=None, rateLimit=0.0, retryAfter=1):
+        self.library = library
+        self.latency = latency
+        self.pageSize = pageSize
+        self.rateLimit = rateLimit
+        self.retryAfter = retryAfter
+        self.lock = threading.Lock()
+        self.random = random.Random(library.seed)
+        self.reset()
+
+    # Clears the request statistics and, unless keepPlaylists is set, the created playlists
+    def reset(self, keepPlaylists=False):
+        with self.lock:
+            if not keepPlaylists:
+                self.playlists = {}  # playlist ID -> track IDs in playlist order
+                self.playlistItemIds = {}  # playlist ID -> item IDs, parallel to the track IDs
+                self.playlistAttributes = {}  # playlist ID -> name and lastModifiedAt
+                self.favorites = {}  # track IDs in the user collection, in the order they were added
+                self.nextItemId = 0
+            self.requestCounts = {}
+            self.rateLimitedCounts = {}
+            self.startTime = time.time()
+
+    # Marks a playlist as modified, must be called with the lock held
+    def touchPlaylist(self, playlistId):
+        self.playlistAttributes[playlistId]["lastModifiedAt"] = f"{time.time():.6f}"
+
+    def countRequest(self, endpoint, rateLimited):
+        with self.lock:
+            self.requestCounts[endpoint] = self.requestCounts.get(endpoint, 0) + 1
+            if rateLimited:
+                self.rateLimitedCounts[endpoint] = self.rateLimitedCounts.get(endpoint, 0) + 1
+
+    def shouldRateLimit(self):
+        with self.lock:
+            return self.rateLimit > 0 and self.random.random() < self.rateLimit
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": dict(self.requestCounts),
+                "rate_limited": dict(self.rateLimitedCounts),
+                "total_requests": sum(self.requestCounts.values()),
+                "elapsed": time.time() - self.startTime,
+                "playlists": {playlistId: len(items) for playlistId, items in self.playlists.items()},
+                "favorites": len(self.favorites),
+                "decoys_written": sum(itemId.startswith("9") for items in [*self.playlists.values(), self.favorites]
+                                      for itemId in items)
+            }
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real APIs
+
+    def log_message(self, format, *args):
+        pass  # Suppress logging to console
+
+    def sendJson(self, status, data=None, headers=None):
+        body = json.dumps(data).encode("utf-8") if data is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def readJson(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def do_GET(self):
+        self.handleRequest("GET")
+
+    def do_POST(self):
+        self.handleRequest("POST")
+
+    def do_DELETE(self):
+        self.handleRequest("DELETE")
+
+    def handleRequest(self, method):
+        state = self.server.state
+        parsed = urllib.parse.urlparse(self.path)
+        path = parsed.path
+        params = urllib.parse.parse_qs(parsed.query)
+        body = self.readJson() if method in ("POST", "DELETE") else None
+        if path == "/stats":
+            return self.sendJson(200, state.stats())
+        if path == "/reset":
+            state.reset(keepPlaylists="keep_playlists" in params)
+            return self.sendJson(200, {})
+        endpoint, handler = self.route(method, path)
+        if handler is None:
+            return self.sendJson(404, {"error": f"{method} {path} is not mocked"})
+        rateLimited = state.shouldRateLimit()
+        state.countRequest(endpoint, rateLimited)
+        if state.latency:
+            time.sleep(state.latency)
+        if rateLimited:
+            return self.sendJson(429, {"error": "rate limited"}, {"Retry-After": str(state.retryAfter)})
+        if endpoint in SPOTIFY_MAX_LIMITS and int(params.get("limit", ["20"])[0]) > SPOTIFY_MAX_LIMITS[endpoint]:
+            return self.sendJson(400, {"error": {"status": 400, "message": "Invalid limit"}})
+        status, data = handler(state, path, params, body)
+        if status == 200 and endpoint == "spotify /playlists/{id}/tracks" and "fields" in params:
+            data = projectFields(data, parseFields(params["fields"][0]))  # only this endpoint supports fields
+        self.sendJson(status, data)
+
+    # Returns the endpoint name and handler function for a request (else None)
+    def route(self, method, path):
+        segments = path.strip("/").split("/")
+        match method, segments:
+            case "GET", ["spotify", "v1", "me", "playlists"]:
+                return "spotify /me/playlists", spotifyPlaylists
+            case "GET", ["spotify", "v1", "playlists", _, "tracks"]:
+                return "spotify /playlists/{id}/tracks", spotifyPlaylistTracks
+            case "GET", ["spotify", "v1", "me", "tracks"]:
+                return "spotify /me/tracks", spotifySavedTracks
+            case "GET", ["tidal", "v2", "searchResults", _]:
+                return "tidal /searchResults/{query}", tidalSearch
+            case "GET", ["tidal", "v2", "tracks"]:
+                return "tidal /tracks", tidalTracks
+            case "GET", ["tidal", "v2", "artists", _, "relationships", "tracks"]:
+                return "tidal /artists/{id}/relationships/tracks", tidalArtistTracks
+            case "GET", ["tidal", "v2", "artists", _, "relationships", "albums"]:
+                return "tidal /artists/{id}/relationships/albums", tidalArtistAlbums
+            case "GET", ["tidal", "v2", "albums"]:
+                return "tidal /albums", tidalAlbums
+            case "GET", ["tidal", "v2", "users", "me"]:
+                return "tidal /users/me", tidalUser
+            case "GET", ["tidal", "v2", "playlists"]:
+                return "tidal GET /playlists", tidalListPlaylists
+            case "GET", ["tidal", "v2", "playlists", _]:
+                return "tidal /playlists/{id}", tidalGetPlaylist
+            case "POST", ["tidal", "v2", "playlists"]:
+                return "tidal /playlists", tidalCreatePlaylist
+            case "GET", ["tidal", "v2", "playlists", _, "relationships", "items"]:
+                return "tidal GET /playlists/{id}/relationships/items", tidalGetItems
+            case "POST", ["tidal", "v2", "playlists", _, "relationships", "items"]:
+                return "tidal /playlists/{id}/relationships/items", tidalAddItems
+            case "GET", ["tidal", "v2", "userCollections", _, "relationships", "tracks"]:
+                return "tidal GET /userCollections/{id}/relationships/tracks", tidalGetFavorites
+            case "POST", ["tidal", "v2", "userCollections", _, "relationships", "tracks"]:
+                return "tidal /userCollections/{id}/relationships/tracks", tidalAddFavorites
+            case "DELETE", ["tidal", "v2", "playlists", _, "relationships", "items"]:
+                return "tidal DELETE /playlists/{id}/relationships/items", tidalRemoveItems
+        return None, None
+
+# Returns the offset and limit of a Spotify paging request, with the limit capped to the page size (if set)
+def pagingParams(state, params):
+    offset = int(params.get("offset", ["0"])[0])
+    limit = int(params.get("limit", ["20"])[0])
+    if state.pageSize:
+        limit = min(limit, state.pageSize)
+    return offset, limit
+
+def pagingObject(items, offset, limit, total):
+    return {"items": items, "offset": offset, "limit": limit, "total": total}
+
+def spotifyPlaylists(state, path, params, body):
+    offset, limit = pagingParams(state, params)
+    total = state.library.playlistCount
+    items = [state.library.playlist(i) for i in range(offset, min(offset + limit, total))]
+    return 200, pagingObject(items, offset, limit, total)
+
+def spotifyPlaylistTracks(state, path, params, body):
+    playlistIndex = int(path.split("/")[-2].removeprefix("playlist"))
+    offset, limit = pagingParams(state, params)
+    total = state.library.playlistLengths[playlistIndex]
+    items = [state.library.playlistItem(playlistIndex, i) for i in range(offset, min(offset + limit, total))]
+    return 200, pagingObject(items, offset, limit, total)
+
+def spotifySavedTracks(state, path, params, body):
+    offset, limit = pagingParams(state, params)
+    total = state.library.likedCount
+    items = [state.library.likedItem(i) for i in range(offset, min(offset + limit, total))]
+    return 200, pagingObject(items, offset, limit, total)
+
+# Like TIDAL, the mock search misses queries with release decorations or too many extra words
+# and for every fifth track ranks a decoy (a live version by another artist) first
+# Tracks and their artists are included if requested with include=tracks,artists
+# A query that is just an artist name ("Artist 4") finds that artist, included if requested with include=artists
+def tidalSearch(state, path, params, body):
+    query = urllib.parse.unquote(path.split("/")[-1])
+    resources = []
+    foundArtists = []
+    # queries look like "Song 123 Artist 4"
+    words = query.split()
+    decorated = len(words) > 8 or any(word.casefold() in ("remastered", "mix", "feat.", "-") for word in words)
+    if len(words) >= 2 and words[0] == "Song" and words[1].isdigit() and not decorated:
+        trackIndex = int(words[1])
+        if stableHash(state.library.seed, "decoy", trackIndex) % 5 == 0:
+            resources.append(state.library.tidalTrackResources(trackIndex, decoy=True))
+        if state.library.tidalTrackId(trackIndex):
+            resources.append(state.library.tidalTrackResources(trackIndex))
+    if len(words) == 2 and words[0] == "Artist" and words[1].isdigit() and int(words[1]) < state.library.artistCount:
+        foundArtists.append({"id": f"tidal-artist-{words[1]}", "type": "artists", "attributes": {"name": query}})
+    hits = [{"id": track["id"], "type": "tracks"} for track, _ in resources]
+    relationships = {"tracks": {"data": hits},
+                     "artists": {"data": [{"id": artist["id"], "type": "artists"} for artist in foundArtists]}}
+    response = {"data": {"id": query, "type": "searchResults", "relationships": relationships}}
+    include = ",".join(params.get("include", [])).split(",")
+    if "tracks" in include:
+        response["included"] = [track for track, _ in resources]
+        if "artists" in include:
+            response["included"] += [artist for _, artists in resources for artist in artists]
+    if "artists" in include:
+        response.setdefault("included", []).extend(foundArtists)
+    return 200, response
+
+def tidalTracks(state, path, params, body):
+    tracks = []
+    for isrc in params.get("filter[isrc]", []):
+        trackIndex = int(isrc.removeprefix("MOCK"))
+        trackId = state.library.tidalTrackId(trackIndex)
+        if trackId:
+            tracks.append({"id": trackId, "type": "tracks", "attributes": {"isrc": isrc}})
+    return 200, {"data": tracks, "links": {}}
+
+# Returns the index of the artist in an artist path like /tidal/v2/artists/tidal-artist-4/relationships/tracks
+def artistIndexFromPath(path):
+    return int(path.split("/")[-3].removeprefix("tidal-artist-"))
+
+# The tracks of an artist are the unique tracks with the artist as primary artist that TIDAL has
+# The tracks of the page are included if requested with include=tracks
+def tidalArtistTracks(state, path, params, body):
+    library = state.library
+    references = [{"id": library.tidalTrackId(trackIndex), "type": "tracks"}
+                  for trackIndex in library.tracksOfArtist(artistIndexFromPath(path)) if library.tidalTrackId(trackIndex)]
+    page = tidalPage(references, path, params)
+    if "tracks" in ",".join(params.get("include", [])).split(","):
+        page["included"] = [library.tidalTrackResources(int(reference["id"]) - TIDAL_TRACK_ID_OFFSET)[0] for reference in page["data"]]
+    return 200, page
+
+# The albums of an artist are the albums its tracks are on (which also have tracks of other artists)
+def tidalArtistAlbums(state, path, params, body):
+    trackIndexes = state.library.tracksOfArtist(artistIndexFromPath(path))
+    albumIndexes = sorted({trackIndex // TRACKS_PER_ALBUM for trackIndex in trackIndexes})
+    return 200, tidalPage([{"id": f"tidal-album-{albumIndex}", "type": "albums"} for albumIndex in albumIndexes], path, params)
+
+# Albums by ID, with their tracks included if requested with include=items
+def tidalAlbums(state, path, params, body):
+    library = state.library
+    albums = []
+    included = []
+    for albumId in params.get("filter[id]", []):
+        albumIndex = int(albumId.removeprefix("tidal-album-"))
+        firstTrack = albumIndex * TRACKS_PER_ALBUM
+        tracks = [library.tidalTrackResources(trackIndex)[0]
+                  for trackIndex in range(firstTrack, min(firstTrack + TRACKS_PER_ALBUM, library.uniqueTrackCount))
+                  if library.tidalTrackId(trackIndex)]
+        albums.append({"id": albumId, "type": "albums", "attributes": {"title": f"Album {albumIndex}"},
+                       "relationships": {"items": {"data": [{"id": track["id"], "type": "tracks"} for track in tracks]}}})
+        included += tracks
+    response = {"data": albums, "links": {}}
+    if "items" in ",".join(params.get("include", [])).split(","):
+        response["included"] = included
+    return 200, response
+
+# Returns one page of TIDAL resources with a next link (cursor = offset) while there are more
+def tidalPage(resources, path, params):
+    offset = int(params.get("page[cursor]", ["0"])[0])
+    links = {}
+    if offset + TIDAL_PAGE_SIZE < len(resources):
+        query = {key: values[0] for key, values in params.items()}
+        query["page[cursor]"] = offset + TIDAL_PAGE_SIZE
+        links["next"] = f"{path.removeprefix('/tidal/v2')}?{urllib.parse.urlencode(query)}"
+    return {"data": resources[offset:offset + TIDAL_PAGE_SIZE], "links": links}
+
+def tidalPlaylistResource(state, playlistId):
+    return {"id": playlistId, "type": "playlists", "attributes": dict(state.playlistAttributes[playlistId])}
+
+def tidalUser(state, path, params, body):
+    return 200, {"data": {"id": MOCK_USER_ID, "type": "users"}}
+
+def tidalListPlaylists(state, path, params, body):
+    if params.get("filter[r.owners.id]", [None])[0] != MOCK_USER_ID:
+        return 400, {"errors": [{"detail": "Owner filter required"}]}
+    with state.lock:
+        resources = [tidalPlaylistResource(state, playlistId) for playlistId in state.playlists]
+    return 200, tidalPage(resources, path, params)
+
+def tidalGetPlaylist(state, path, params, body):
+    playlistId = path.split("/")[-1]
+    with state.lock:
+        if playlistId not in state.playlists:
+            return 404, {"errors": [{"detail": "Playlist not found"}]}
+        return 200, {"data": tidalPlaylistResource(state, playlistId)}
+
+def tidalCreatePlaylist(state, path, params, body):
+    with state.lock:
+        playlistId = f"mock-playlist-{len(state.playlists)}"
+        state.playlists[playlistId] = []
+        state.playlistItemIds[playlistId] = []
+        state.playlistAttributes[playlistId] = {"name": body["data"]["attributes"]["name"]}
+        state.touchPlaylist(playlistId)
+        resource = tidalPlaylistResource(state, playlistId)
+    return 201, {"data": resource}
+
+def tidalGetItems(state, path, params, body):
+    playlistId = path.split("/")[-3]
+    with state.lock:
+        if playlistId not in state.playlists:
+            return 404, {"errors": [{"detail": "Playlist not found"}]}
+        resources = [{"id": trackId, "type": "tracks", "meta": {"itemId": itemId}}
+                     for trackId, itemId in zip(state.playlists[playlistId], state.playlistItemIds[playlistId])]
+    return 200, tidalPage(resources, path, params)
+
+def tidalAddItems(state, path, params, body):
+    playlistId = path.split("/")[-3]
+    items = body["data"]
+    if len(items) > 20:
+        return 400, {"errors": [{"detail": "Too many items"}]}
+    with state.lock:
+        if playlistId not in state.playlists:
+            return 404, {"errors": [{"detail": "Playlist not found"}]}
+        for item in items:
+            state.playlists[playlistId].append(item["id"])
+            state.playlistItemIds[playlistId].append(f"mock-item-{state.nextItemId}")
+            state.nextItemId += 1
+        state.touchPlaylist(playlistId)
+    return 201, None
+
+def tidalRemoveItems(state, path, params, body):
+    playlistId = path.split("/")[-3]
+    items = body["data"]
+    if len(items) > 20:
+        return 400, {"errors": [{"detail": "Too many items"}]}
+    with state.lock:
+        if playlistId not in state.playlists:
+            return 404, {"errors": [{"detail": "Playlist not found"}]}
+        removedItemIds = {item["meta"]["itemId"] for item in items}
+        kept = [(trackId, itemId) for trackId, itemId in zip(state.playlists[playlistId], state.playlistItemIds[playlistId])
+                if itemId not in removedItemIds]
+        state.playlists[playlistId] = [trackId for trackId, _ in kept]
+        state.playlistItemIds[playlistId] = [itemId for _, itemId in kept]
+        state.touchPlaylist(playlistId)
+    return 204, None
+
+def tidalGetFavorites(state, path, params, body):
+    if path.split("/")[-3] != MOCK_USER_ID:
+        return 403, {"errors": [{"detail": "Not your collection"}]}
+    with state.lock:
+        resources = [{"id": trackId, "type": "tracks"} for trackId in state.favorites]
+    return 200, tidalPage(resources, path, params)
+
+def tidalAddFavorites(state, path, params, body):
+    if path.split("/")[-3] != MOCK_USER_ID:
+        return 403, {"errors": [{"detail": "Not your collection"}]}
+    items = body["data"]
+    if len(items) > 20:
+        return 400, {"errors": [{"detail": "Too many items"}]}
+    with state.lock:
+        for item in items:
+            state.favorites.setdefault(item["id"], None)
+    return 201, None
+
+# Starts the mock server in a background thread
+# Returns the server (its base URL is http://127.0.0.1:{server.server_port})
+def startMockServer(state, port=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Spotify/TIDAL stand-in server for benchmarks.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--tracks", type=int, default=1000, help="playlist entries in the synthetic library (100 to 100000)")
+    parser.add_argument("--playlists", type=int, help="number of playlists (default: one per 100 tracks)")
+    parser.add_argument("--latency", type=float, default=0.05, help="added latency per request in seconds")
+    parser.add_argument("--page-size", type=int,
+                        help="cap Spotify pages below the endpoint maximum (the limit in the response tells the client)")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="probability of a 429 response per request")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds of injected 429 responses")
+    parser.add_argument("--top-artists", type=float, default=0.0,
+                        help=f"share of the tracks by the {TOP_ARTIST_COUNT} top artists (default: spread evenly)")
+    args = parser.parse_args()
+    state = MockState(SyntheticLibrary(args.tracks, args.playlists, topArtistShare=args.top_artists), args.latency,
+                      args.page_size, args.rate_limit, args.retry_after)
+    server = startMockServer(state, args.port)
+    print(f"Mock server running on http://127.0.0.1:{server.server_port}")
+    print(f"SPOTIFY_BASE_URL=http://127.0.0.1:{server.server_port}/spotify/v1")
+    print(f"TIDAL_BASE_URL=http://127.0.0.1:{server.server_port}/tidal/v2")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
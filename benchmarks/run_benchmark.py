@@ -0,0 +1,141 @@
+# Runs the full migration against the local mock server and reports wall time, requests per second, wrong matches
+# (decoy tracks written to playlists) and peak memory
+# Each migration runs in its own process (so peak memory is not shared between runs) in a temporary directory,
+# with SPOTIFY_BASE_URL and TIDAL_BASE_URL pointing at the mock server
+# The resync mode migrates the library with the pipeline and measures a second pipeline run in the same directory,
+# which finds the playlists on TIDAL and only syncs them
+# Usage: python benchmarks/run_benchmark.py --tracks 100 1000 10000 --modes pipeline phased --latency 0.05
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# Migrates the mock library once, in the current process
+# Returns the benchmark result of this run
+def runMigration(mode, serverUrl):
+    sys.path.insert(0, REPO_DIR)
+    import main
+    spotifyClient = main.SpotifyClient("mock-token")
+    tidalClient = main.TidalClient("mock-token")
+    journal = main.RunJournal()
+    searchCache = main.TidalSearchCache()
+    spotifyStore = main.SpotifyLibraryStore()
+    startTime = time.perf_counter()
+    playlists = list(main.spotifyGetPlaylists(spotifyClient))
+    if mode == "pipeline":
+        main.runPipeline(spotifyClient, tidalClient, playlists, main.LIBRARY_FILE, journal, searchCache, spotifyStore)
+    else:
+        main.saveLibraryToJsonl(spotifyClient, main.LIBRARY_FILE, playlists, store=spotifyStore)
+        journal.recordExported()
+        main.transferLibrary(tidalClient, main.LIBRARY_FILE, journal, searchCache)
+    wallTime = time.perf_counter() - startTime
+    with urllib.request.urlopen(f"{serverUrl}/stats") as response:
+        stats = json.load(response)
+    return {
+        "mode": mode,
+        "wall_time": wallTime,
+        "requests": stats["total_requests"],
+        "requests_per_second": stats["total_requests"] / wallTime,
+        "rate_limited": sum(stats["rate_limited"].values()),
+        "requests_by_endpoint": stats["requests"],
+        "written_tracks": sum(stats["playlists"].values()) + stats["favorites"],
+        "wrong_tracks": stats["decoys_written"],
+        "throttled_seconds": main.requestMetrics.report()["throttled_seconds"],
+        "received_mb": sum(metrics["bytes_received"] for metrics in main.requestMetrics.report()["endpoints"].values()) / 1e6,
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+# Starts the mock server in a subprocess and waits until it answers
+# Returns the process and the server URL
+def startServer(port, tracks, latency, rateLimit, retryAfter, pageSize, topArtists=0.0):
+    command = [sys.executable, os.path.join(BENCHMARKS_DIR, "mock_server.py"),
+               "--port", str(port), "--tracks", str(tracks), "--latency", str(latency),
+               "--rate-limit", str(rateLimit), "--retry-after", str(retryAfter), "--top-artists", str(topArtists)]
+    if pageSize:
+        command += ["--page-size", str(pageSize)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    serverUrl = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"{serverUrl}/stats").close()
+            return process, serverUrl
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Mock server did not start.")
+
+# Runs one migration in a fresh process against the given server
+# Returns the benchmark result
+def runBenchmark(mode, serverUrl):
+    urllib.request.urlopen(f"{serverUrl}/reset").close()
+    env = dict(os.environ, SPOTIFY_BASE_URL=f"{serverUrl}/spotify/v1", TIDAL_BASE_URL=f"{serverUrl}/tidal/v2")
+    with tempfile.TemporaryDirectory() as workDir:
+        runModes = ["pipeline", "pipeline"] if mode == "resync" else [mode]
+        for i, runMode in enumerate(runModes):
+            if i > 0:
+                urllib.request.urlopen(f"{serverUrl}/reset?keep_playlists=1").close()  # measure only the last run
+            completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-once", runMode, "--server", serverUrl],
+                                       cwd=workDir, env=env, capture_output=True, text=True)
+            if completed.returncode != 0:
+                print(completed.stdout[-2000:])
+                print(completed.stderr[-2000:])
+                raise RuntimeError(f"Benchmark run ({mode}) failed.")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["mode"] = mode
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the migration against the local mock server.")
+    parser.add_argument("--tracks", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="library sizes (playlist entries) to benchmark")
+    parser.add_argument("--modes", nargs="+", choices=["pipeline", "phased", "resync"], default=["pipeline", "phased"])
+    parser.add_argument("--latency", type=float, default=0.05, help="mock latency per request in seconds")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="probability of an injected 429 response")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--page-size", type=int, help="cap the Spotify page size of the mock server")
+    parser.add_argument("--top-artists", type=float, default=0.0, help="share of the mock tracks by a few top artists")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--run-once", choices=["pipeline", "phased"], help=argparse.SUPPRESS)
+    parser.add_argument("--server", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_once:
+        resultStdout = sys.stdout
+        with open(os.devnull, "w") as devnull:
+            sys.stdout = devnull  # silence the migration output, only the result goes to stdout
+            result = runMigration(args.run_once, args.server)
+            sys.stdout = resultStdout
+        print(json.dumps(result))
+        sys.exit()
+
+    results = []
+    print(f"{'tracks':>8} {'mode':<9} {'wall time':>10} {'requests':>9} {'req/s':>8} {'429s':>6} {'throttled':>10} "
+          f"{'recv MB':>8} {'written':>8} {'wrong':>6} {'peak MB':>8}")
+    for tracks in args.tracks:
+        process, serverUrl = startServer(args.port, tracks, args.latency, args.rate_limit, args.retry_after, args.page_size,
+                                         args.top_artists)
+        try:
+            for mode in args.modes:
+                result = runBenchmark(mode, serverUrl)
+                result["tracks"] = tracks
+                results.append(result)
+                print(f"{tracks:>8} {mode:<9} {result['wall_time']:>9.1f}s {result['requests']:>9} "
+                      f"{result['requests_per_second']:>8.1f} {result['rate_limited']:>6} {result['throttled_seconds']:>9.1f}s "
+                      f"{result['received_mb']:>8.1f} {result['written_tracks']:>8} {result['wrong_tracks']:>6} "
+                      f"{result['peak_memory_mb']:>8.1f}")
+        finally:
+            process.terminate()
+            process.wait()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
@@ -0,0 +1,41 @@
+# Compares request latency of one-off requests.get calls (a new connection per request, as main.py did before)
+# with the pooled ApiClient session (kept-alive connections)
+# Usage: python benchmarks/session_latency.py [url] [number of requests]
+import os
+import statistics
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from main import ApiClient, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+
+# Sends the given number of requests with the given get function
+# Returns the list of request latencies in milliseconds
+def measureLatencies(get, url, count):
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        get(url)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+def printLatencies(label, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f"{label:<22} median {statistics.median(latencies):8.1f} ms   p95 {p95:8.1f} ms   "
+          f"mean {statistics.mean(latencies):8.1f} ms   total {sum(latencies) / 1000:6.2f} s")
+
+if __name__ == "__main__":
+    url = sys.argv[1] if len(sys.argv) > 1 else "https://openapi.tidal.com/v2/"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    print(f"Sending {count} requests to {url} per mode...")
+    before = measureLatencies(lambda u: requests.get(u, timeout=timeout), url, count)
+    client = ApiClient(url)
+    after = measureLatencies(client.get, url, count)
+    client.close()
+    printLatencies("requests.get (before)", before)
+    printLatencies("ApiClient (after)", after)
+    print(f"Speedup (median): {statistics.median(before) / statistics.median(after):.1f}x")
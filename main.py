@@ -1,81 +1,480 @@
 import requests
-# Patch requests.get and requests.post to always use a timeout of 20 seconds if not specified
-_original_get = requests.get
-_original_post = requests.post
-
-def _get_with_timeout(*args, **kwargs):
-    if "timeout" not in kwargs:
-        kwargs["timeout"] = 20
-    return _original_get(*args, **kwargs)
-
-def _post_with_timeout(*args, **kwargs):
-    if "timeout" not in kwargs:
-        kwargs["timeout"] = 20
-    return _original_post(*args, **kwargs)
-
-requests.get = _get_with_timeout
-requests.post = _post_with_timeout
+from requests.adapters import HTTPAdapter
 import json
-from dotenv import load_dotenv
 import os
 import random
-import webbrowser
 import urllib.parse
-from http.server import BaseHTTPRequestHandler, HTTPServer
 import base64
 import hashlib
 import time
 import platform
+import sqlite3
+import re
+import bisect
+import atexit
+import threading
+import argparse
+import queue
+import contextlib
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
-load_dotenv()
+# HTTP global variables
+HTTP_POOL_SIZE = 16  # kept-alive connections per host, should be at least the number of concurrent workers
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 20
+METRICS_LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # upper bounds of the latency histogram in seconds
+METRICS_REPORT_FILE = "run_report.json"
+TOKEN_STORE_FILE = "oauth_tokens.json"  # saved logins of both services, readable only by the current user
+TOKEN_EXPIRY_MARGIN = 60  # saved access tokens that expire within this many seconds are refreshed before use
 
 # Spotify global variables
 REDIRECT_URI = "http://127.0.0.1:8000/callback"
 state = None # to store the state parameter for CSRF protection
-SPOTIFY_BASE_URL = "https://api.spotify.com/v1"
+SPOTIFY_BASE_URL = "https://api.spotify.com/v1"  # overridable with SPOTIFY_BASE_URL in the environment or .env
 SPOTIFY_RETRY_AFTER = 5  # default retry time for Spotify rate limiting
+SPOTIFY_MAX_WORKERS = 8  # maximum number of concurrent Spotify requests
+spotifyRequestSlots = threading.BoundedSemaphore(SPOTIFY_MAX_WORKERS)  # bounds in-flight requests across all threads
+spotifyRateLimitLock = threading.Lock()
+spotifyRetryAt = 0  # shared 429 backoff: no worker sends a request before this time
+SPOTIFY_PAGE_LIMIT = 50  # largest page size of the playlists and saved tracks endpoints
+SPOTIFY_PLAYLIST_ITEMS_LIMIT = 100  # largest page size of the playlist items endpoint
+# Only the playlist items endpoint supports the fields parameter, it is asked for just what matching needs
+SPOTIFY_PLAYLIST_ITEM_FIELDS = "total,limit,items(track(name,id,duration_ms,external_ids(isrc),artists(name)))"
+
+# Library file global variables
+LIBRARY_FILE = "library.jsonl"
+LIBRARY_FORMAT = "spotify-to-tidal-library"
+LIBRARY_VERSION = 1
+MATCH_FILE = "tidal_matches.jsonl"  # TIDAL track IDs of the library tracks, written by the match command
+MATCH_FORMAT = "spotify-to-tidal-matches"
+MATCH_VERSION = 1
+LIKED_SONGS_PLAYLIST_NAME = "Spotify Liked Songs"
+RUN_JOURNAL_FILE = "run_journal.jsonl"
+SPOTIFY_STORE_FILE = "spotify_store.sqlite3"
+PIPELINE_QUEUE_SIZE = 1000  # bounded length of the queues between pipeline stages
+BATCH_MAX_WORKERS = 4  # accounts migrated at the same time in batch mode, each in its own process
+BATCH_LOG_FILE = "migration.log"  # output of a batch worker, in the account directory
 
 # Tidal global variables
 TIDAL_REDIRECT_URI = "http://127.0.0.1:3000/callback"
-TIDAL_BASE_URL = "https://openapi.tidal.com/v2"
+TIDAL_SCOPE = "user.read search.read playlists.write playlists.read collection.read collection.write"
+TIDAL_COLLECTION_SCOPE = "collection.read collection.write"  # needed to add the liked songs to the favorites
+TIDAL_BASE_URL = "https://openapi.tidal.com/v2"  # overridable with TIDAL_BASE_URL in the environment or .env
+TIDAL_COUNTRY_CODE = "DE"
 randomOctetSequence = os.urandom(32)
 codeVerifier = base64.urlsafe_b64encode(randomOctetSequence).decode("utf-8").rstrip("=")
+TIDAL_SEARCH_INITIAL_IN_FLIGHT = 4  # concurrent searches at start, adapted to rate limiting
+TIDAL_SEARCH_MAX_IN_FLIGHT = 16  # upper bound of concurrent searches
+TIDAL_SEARCH_MAX_ARTISTS = 2  # artists per search query, long artist lists make the search miss
+TIDAL_SEARCH_MAX_QUERIES_PER_TRACK = 3  # request budget of the query planner per track
+MATCH_MIN_CONFIDENCE = 0.7  # search matches below this confidence are listed in the review file
+MATCH_REJECT_CONFIDENCE = 0.5  # search matches below this confidence are not used, the track counts as not found
+MATCH_DURATION_TOLERANCE_MS = 15000  # duration difference at which the duration score drops to 0
+MATCH_REVIEW_FILE = "tidal_review.txt"
+CATALOG_MIN_TRACKS = 25  # artists with at least this many tracks waiting for search get their catalog prefetched (0: never)
+CATALOG_MAX_REQUEST_SHARE = 0.5  # a catalog may cost at most this share of the search queries it replaces
+CATALOG_ALBUM_BATCH_SIZE = 20  # albums fetched with their items per request
+TIDAL_ISRC_BATCH_SIZE = 20  # number of ISRCs looked up per request
+TIDAL_WRITE_BATCH_SIZE = 20  # maximum number of items TIDAL accepts per playlist items request (shrinks on 413)
+TIDAL_WRITE_MAX_PLAYLISTS = 4  # number of playlists filled at the same time
+TIDAL_WRITE_MAX_IN_FLIGHT = 4  # global limit of concurrent playlist write requests
+TIDAL_WRITE_MAX_REQUESTS_PER_SECOND = 5  # global limit of playlist write requests per second
+TIDAL_WRITE_MAX_RETRIES = 5  # retries of a failed chunk (rate limiting does not count)
+TIDAL_WRITE_RETRY_AFTER = 5  # default wait time if a 429 response has no Retry-After header
+TIDAL_WRITE_RETRY_BACKOFF = 2  # initial backoff for failed chunks, doubled on every retry
+TIDAL_WRITE_BACKOFF_INTERVAL = 0.5  # minimum request interval after a 429 response
+TIDAL_WRITE_MAX_INTERVAL = 5  # upper bound of the request interval
+TIDAL_SYNC_STATE_FILE = "tidal_sync.sqlite3"  # what was last synced into each existing TIDAL playlist
+TIDAL_FAVORITES_BATCH_SIZE = 20  # tracks per user collection request, the most a TIDAL relationship request accepts
 
-## SPOTIFY
+# Search cache global variables
+SEARCH_CACHE_FILE = "tidal_search_cache.sqlite3"
+SEARCH_CACHE_TTL = 30 * 24 * 60 * 60  # cached search results expire after 30 days
+SEARCH_CACHE_NEGATIVE_TTL = 7 * 24 * 60 * 60  # "no results" entries are re-checked sooner
+SEARCH_CACHE_BUSY_TIMEOUT = 30  # seconds to wait while another process writes to a shared cache
+SEARCH_CACHE_MAX_ENTRIES = 200000  # least recently used entries are evicted beyond this
 
-# Handles the redirect from Spotify after user authorization
-class SpotifyAuthHandler(BaseHTTPRequestHandler):
-    # overwrites do_GET method to handle the redirect from Spotify
-    def do_GET(self):
-        parsed_path = urllib.parse.urlparse(self.path)
-        params = urllib.parse.parse_qs(parsed_path.query)
-        if "code" in params and "state" in params:
-            code = params["code"][0]
-            returned_state = params["state"][0]
-            if returned_state == state:
-                self.send_response(200)
-                self.send_header("Content-type", "text/html")
-                self.end_headers()
-                self.wfile.write(b"<html><body><h1>Spotify authorization successful!</h1>You can close this window and return to console.</body></html>")
-                #print(f"Handler got authorization code: {code}")
-                self.server.code = code
+# Run planner global variables
+PLAN_SEARCH_SHARE = 0.25  # share of the tracks assumed to need a search because their ISRC is not found
+PLAN_QUERIES_PER_SEARCH = 1.3  # average search queries per searched track (see the search query planner)
+PLAN_REQUEST_LATENCY = 0.3  # assumed latency per request in seconds
+PROGRESS_INTERVAL = 15  # seconds between two progress lines
+PROGRESS_WINDOW = 60  # seconds of request history the rolling ETA is based on
+
+## METRICS
+
+# Collects per-endpoint request metrics (counts, status codes, latency histogram, bytes)
+# and the time spent throttled (rate limit backoffs and request pacing) per source
+class RequestMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.startTime = time.time()
+        self.endpoints = {}
+        self.throttled = {}
+        self.counters = {}
+        self.transfers = {}
+
+    # Returns the endpoint label of a request path (relative to the base URL of the API), with IDs and queries
+    # replaced by placeholders
+    @staticmethod
+    def endpointLabel(service, method, url, baseUrl):
+        path = urllib.parse.urlparse(url).path
+        prefix = urllib.parse.urlparse(baseUrl).path
+        if prefix and path.startswith(prefix + "/"):
+            path = path[len(prefix):]
+        path = re.sub(r"/searchResults/[^/]+", "/searchResults/{query}", path)
+        path = re.sub(r"/(playlists|artists|albums|tracks|users|userCollections)/[^/]+", r"/\1/{id}", path)
+        return f"{service} {method} {path}"
+
+    def recordRequest(self, endpoint, status, latency, bytesSent, bytesReceived):
+        with self.lock:
+            metrics = self.endpoints.get(endpoint)
+            if metrics is None:
+                metrics = self.endpoints[endpoint] = {
+                    "count": 0, "status_codes": {}, "latency_sum": 0.0, "latency_min": None, "latency_max": 0.0,
+                    "latency_buckets": [0] * (len(METRICS_LATENCY_BUCKETS) + 1), "bytes_sent": 0, "bytes_received": 0
+                }
+            metrics["count"] += 1
+            metrics["status_codes"][str(status)] = metrics["status_codes"].get(str(status), 0) + 1
+            metrics["latency_sum"] += latency
+            metrics["latency_min"] = latency if metrics["latency_min"] is None else min(metrics["latency_min"], latency)
+            metrics["latency_max"] = max(metrics["latency_max"], latency)
+            metrics["latency_buckets"][bisect.bisect_left(METRICS_LATENCY_BUCKETS, latency)] += 1
+            metrics["bytes_sent"] += bytesSent
+            metrics["bytes_received"] += bytesReceived
+
+    def recordThrottle(self, source, seconds):
+        if seconds > 0:
+            with self.lock:
+                throttle = self.throttled.setdefault(source, {"count": 0, "seconds": 0.0})
+                throttle["count"] += 1
+                throttle["seconds"] += seconds
+
+    # Counts an event of a group, e.g. the query tier that matched a track search
+    def countEvent(self, group, name):
+        with self.lock:
+            groupCounters = self.counters.setdefault(group, {})
+            groupCounters[name] = groupCounters.get(name, 0) + 1
+
+    # Returns the number of requests so far and the time spent throttled, cheaper than a report
+    def progressTotals(self):
+        with self.lock:
+            return (sum(metrics["count"] for metrics in self.endpoints.values()),
+                    sum(throttle["seconds"] for throttle in self.throttled.values()))
+
+    # Records the throughput of a bulk transfer, e.g. of the liked songs into the TIDAL favorites
+    def recordTransfer(self, name, items, requests, seconds):
+        with self.lock:
+            self.transfers[name] = {"items": items, "requests": requests, "seconds": seconds,
+                                    "items_per_second": items / seconds if seconds else 0.0}
+
+    # Returns the number of requests and bytes received of the endpoints starting with the prefix
+    def endpointTotals(self, prefix):
+        with self.lock:
+            prefixMetrics = [metrics for endpoint, metrics in self.endpoints.items() if endpoint.startswith(prefix)]
+            return sum(metrics["count"] for metrics in prefixMetrics), sum(metrics["bytes_received"] for metrics in prefixMetrics)
+
+    # Returns the number of requests and bytes received of a service ("spotify" or "tidal")
+    def serviceTotals(self, service):
+        return self.endpointTotals(f"{service} ")
+
+    # Returns the report of the run as a JSON serializable dictionary
+    def report(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, metrics in sorted(self.endpoints.items()):
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(METRICS_LATENCY_BUCKETS + [float("inf")], metrics["latency_buckets"]):
+                    cumulative += count
+                    buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+                endpoints[endpoint] = {
+                    "count": metrics["count"],
+                    "status_codes": metrics["status_codes"],
+                    "latency_seconds": {
+                        "sum": metrics["latency_sum"],
+                        "mean": metrics["latency_sum"] / metrics["count"],
+                        "min": metrics["latency_min"],
+                        "max": metrics["latency_max"],
+                        "buckets": buckets
+                    },
+                    "bytes_sent": metrics["bytes_sent"],
+                    "bytes_received": metrics["bytes_received"]
+                }
+            return {
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.startTime)),
+                "wall_seconds": time.time() - self.startTime,
+                "requests": sum(metrics["count"] for metrics in self.endpoints.values()),
+                "network_seconds": sum(metrics["latency_sum"] for metrics in self.endpoints.values()),
+                "throttled_seconds": sum(throttle["seconds"] for throttle in self.throttled.values()),
+                "endpoints": endpoints,
+                "throttled": dict(self.throttled),
+                "counters": {group: dict(groupCounters) for group, groupCounters in self.counters.items()},
+                "transfers": {name: dict(transfer) for name, transfer in self.transfers.items()}
+            }
+
+    def writeJsonReport(self, filename):
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+
+    # Writes the metrics in the Prometheus text format (e.g. for the node exporter textfile collector)
+    def writePrometheusTextfile(self, filename):
+        report = self.report()
+        lines = [
+            "# HELP spotify_to_tidal_requests_total HTTP requests by endpoint and status code.",
+            "# TYPE spotify_to_tidal_requests_total counter"
+        ]
+        for endpoint, metrics in report["endpoints"].items():
+            for status, count in metrics["status_codes"].items():
+                lines.append(f'spotify_to_tidal_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+        lines += [
+            "# HELP spotify_to_tidal_request_duration_seconds HTTP request latency by endpoint.",
+            "# TYPE spotify_to_tidal_request_duration_seconds histogram"
+        ]
+        for endpoint, metrics in report["endpoints"].items():
+            for bound, count in metrics["latency_seconds"]["buckets"].items():
+                lines.append(f'spotify_to_tidal_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+            lines.append(f'spotify_to_tidal_request_duration_seconds_sum{{endpoint="{endpoint}"}} {metrics["latency_seconds"]["sum"]}')
+            lines.append(f'spotify_to_tidal_request_duration_seconds_count{{endpoint="{endpoint}"}} {metrics["count"]}')
+        lines += [
+            "# HELP spotify_to_tidal_response_bytes_total Bytes received by endpoint.",
+            "# TYPE spotify_to_tidal_response_bytes_total counter"
+        ]
+        for endpoint, metrics in report["endpoints"].items():
+            lines.append(f'spotify_to_tidal_response_bytes_total{{endpoint="{endpoint}"}} {metrics["bytes_received"]}')
+        lines += [
+            "# HELP spotify_to_tidal_throttled_seconds_total Time spent waiting for rate limits and request pacing.",
+            "# TYPE spotify_to_tidal_throttled_seconds_total counter"
+        ]
+        for source, throttle in report["throttled"].items():
+            lines.append(f'spotify_to_tidal_throttled_seconds_total{{source="{source}"}} {throttle["seconds"]}')
+        lines += [
+            "# HELP spotify_to_tidal_run_wall_seconds Wall time of the run.",
+            "# TYPE spotify_to_tidal_run_wall_seconds gauge",
+            f"spotify_to_tidal_run_wall_seconds {report['wall_seconds']}"
+        ]
+        # write and rename, so that the collector never reads a partial file
+        with open(f"{filename}.tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(f"{filename}.tmp", filename)
+
+requestMetrics = RequestMetrics()
+
+# Sleeps for a rate limit backoff or request pacing and records the time as throttled
+def throttledSleep(source, seconds):
+    if seconds > 0:
+        requestMetrics.recordThrottle(source, seconds)
+        time.sleep(seconds)
+
+## HTTP CLIENTS
+
+# Pooled HTTP client for one API
+# Keeps connections alive across requests (and threads) and sends the Bearer token with every request
+class ApiClient:
+    def __init__(self, baseUrl, token=None, poolSize=HTTP_POOL_SIZE,
+                 timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), name="api"):
+        self.baseUrl = baseUrl
+        self.name = name
+        self.timeout = timeout
+        self.token = None
+        self.tokenRefresher = None  # called with the client to get a new token when a request is rejected with 401
+        self.tokenRefreshLock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        if token:
+            self.setToken(token)
+
+    def setToken(self, token):
+        self.token = token
+        self.session.headers["Authorization"] = f"Bearer {token}"
+
+    # Sends a request to a path relative to the base URL (or to an absolute URL) and records its metrics
+    # An API request rejected with 401 (expired token) is sent once more after refreshing the token
+    # Returns the response
+    def request(self, method, path, **kwargs):
+        url = path if path.startswith("http") else f"{self.baseUrl}{path}"
+        kwargs.setdefault("timeout", self.timeout)
+        usedToken = self.token
+        response = self.sendRequest(method, url, **kwargs)
+        if response.status_code == 401 and self.tokenRefresher and url.startswith(self.baseUrl):
+            if self.refreshToken(usedToken):
+                response = self.sendRequest(method, url, **kwargs)
+        return response
+
+    # Replaces an expired token, only once if several threads find it expired at the same time
+    # Returns whether there is a new token
+    def refreshToken(self, expiredToken):
+        with self.tokenRefreshLock:
+            if self.token != expiredToken:
+                return True  # another thread has refreshed it already
+            print(f"{self.name.capitalize()} access token expired. Refreshing it...")
+            return self.tokenRefresher(self) is not None
+
+    def sendRequest(self, method, url, **kwargs):
+        endpoint = RequestMetrics.endpointLabel(self.name, method, url, self.baseUrl)
+        startTime = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            requestMetrics.recordRequest(endpoint, "error", time.perf_counter() - startTime, 0, 0)
+            raise
+        latency = time.perf_counter() - startTime
+        requestBody = response.request.body or b""
+        contentLength = response.headers.get("Content-Length")
+        requestMetrics.recordRequest(endpoint, response.status_code, latency, len(requestBody),
+                                     int(contentLength) if contentLength else len(response.content))
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+# Returns the base URL of an API, overridden by the environment variable of the same name (also read from .env),
+# e.g. for benchmarks/mock_server.py
+def apiBaseUrl(variable, default):
+    loadDotenv()
+    return os.getenv(variable, default)
+
+class SpotifyClient(ApiClient):
+    def __init__(self, token=None, **kwargs):
+        super().__init__(apiBaseUrl("SPOTIFY_BASE_URL", SPOTIFY_BASE_URL), token, name="spotify", **kwargs)
+
+class TidalClient(ApiClient):
+    def __init__(self, token=None, **kwargs):
+        super().__init__(apiBaseUrl("TIDAL_BASE_URL", TIDAL_BASE_URL), token, name="tidal", **kwargs)
+
+## TOKEN STORE
+
+# Saved OAuth tokens of both services, so that later runs refresh them instead of asking the user to log in again
+# Stored as JSON in a file that only the current user can read
+class TokenStore:
+    def __init__(self, filename=TOKEN_STORE_FILE):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.tokens = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename, "r", encoding="utf-8") as f:
+                    self.tokens = json.load(f)
+            except (OSError, ValueError):
+                print(f"Could not read the saved logins from {filename}, logging in again.")
+
+    def get(self, service):
+        with self.lock:
+            return self.tokens.get(service)
+
+    # Saves the token response of a service
+    # Refresh responses may leave out the refresh token, then the previous one stays valid and is kept
+    def put(self, service, tokenResponse):
+        with self.lock:
+            savedToken = dict(self.tokens.get(service) or {})
+            savedToken["access_token"] = tokenResponse["access_token"]
+            savedToken["expires_at"] = time.time() + tokenResponse.get("expires_in", 3600)
+            for field in ("refresh_token", "user_id", "scope"):
+                if tokenResponse.get(field):
+                    savedToken[field] = tokenResponse[field]
+            self.tokens[service] = savedToken
+            self.save()
+
+    def remove(self, service):
+        with self.lock:
+            if self.tokens.pop(service, None) is not None:
+                self.save()
+
+    # Writes the file with owner-only permissions and replaces the old one at once
+    def save(self):
+        tmpFilename = f"{self.filename}.tmp"
+        fileDescriptor = os.open(tmpFilename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fileDescriptor, "w", encoding="utf-8") as f:
+            json.dump(self.tokens, f)
+        os.replace(tmpFilename, self.filename)
+
+# Lets the client refresh its token whenever a request is rejected with 401, then sets the saved access token on it
+# (refreshed first if it expires soon)
+# Returns whether the client has a usable token
+def useSavedToken(client, tokenStore, service, refreshAccessToken):
+    client.tokenRefresher = lambda client: refreshAccessToken(client, tokenStore)
+    savedToken = tokenStore.get(service)
+    if not savedToken:
+        return False
+    if savedToken.get("expires_at", 0) > time.time() + TOKEN_EXPIRY_MARGIN:
+        client.setToken(savedToken["access_token"])
+        return True
+    return refreshAccessToken(client, tokenStore) is not None
+
+## BROWSER LOGIN
+# Only the logins need the client credentials from .env, the browser and a local server for the redirect,
+# so these modules are imported on first use and commands that run on saved logins start without them
+
+# Loads the client IDs and secrets (and base URL overrides) from .env into the environment (once)
+@functools.cache
+def loadDotenv():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+# Opens the authorization page of a service in the browser
+def openInBrowser(url):
+    import webbrowser
+    webbrowser.open(url)
+
+# Serves the redirect of the browser after user authorization on the given local port
+# Returns the authorization code or None if the user did not authorize
+def waitForAuthorizationCode(port, serviceName):
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    # Handles the redirect after user authorization
+    class AuthHandler(BaseHTTPRequestHandler):
+        # overwrites do_GET method to handle the redirect
+        def do_GET(self):
+            parsed_path = urllib.parse.urlparse(self.path)
+            params = urllib.parse.parse_qs(parsed_path.query)
+            if "code" in params and "state" in params:
+                code = params["code"][0]
+                returned_state = params["state"][0]
+                if returned_state == state:
+                    self.send_response(200)
+                    self.send_header("Content-type", "text/html")
+                    self.end_headers()
+                    self.wfile.write(f"<html><body><h1>{serviceName} authorization successful!</h1>You can close this window "
+                                     "and return to console.</body></html>".encode("utf-8"))
+                    self.server.code = code
+                else:
+                    self.send_response(400)
+                    self.end_headers()
+                    self.wfile.write(b"State mismatch. Possible CSRF attack.")
             else:
                 self.send_response(400)
                 self.end_headers()
-                self.wfile.write(b"State mismatch. Possible CSRF attack.")
-        else:
-            self.send_response(400)
-            self.end_headers()
-            self.wfile.write(b"Missing code or state parameter.")
-            
-    def log_message(self, format, *args):
-        pass  # Suppress logging to console
+                self.wfile.write(b"Missing code or state parameter.")
+
+        def log_message(self, format, *args):
+            pass  # Suppress logging to console
+
+    server = HTTPServer(("127.0.0.1", port), AuthHandler)
+    server.handle_request()  # Handles a single request, then exits
+    return getattr(server, "code", None)
+
+## SPOTIFY
 
 # Opens the browser to let the user authorize the app
 # Returns the authorization code or None if the user did not authorize
 def spotifyGetUserAuthorizationCode():
     # open the browser to let the user authorize the app
     global state
+    loadDotenv()
     url = "https://accounts.spotify.com/authorize"
     scope = "playlist-read-private user-library-read"
     state = ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=16))
@@ -87,30 +486,50 @@ def spotifyGetUserAuthorizationCode():
         "scope": scope,
     }
     auth_url = f"{url}?{urllib.parse.urlencode(params)}"
-    webbrowser.open(auth_url)    
-     # Start local server to catch the redirect
-    server = HTTPServer(("127.0.0.1", 8000), SpotifyAuthHandler)
-    server.handle_request()  # Handles a single request, then exits
-    return getattr(server, "code", None)
+    openInBrowser(auth_url)
+    # Start local server to catch the redirect
+    return waitForAuthorizationCode(8000, "Spotify")
 
 # Sends a request to Spotify to get an access token using the authorization code
+# The token is set on the client for all further requests and saved to the token store
 # Returns the access token (else None)
-def spotifyGetAccessToken(code):
-    url = "https://accounts.spotify.com/api/token"
+def spotifyGetAccessToken(client, code, tokenStore=None):
     data = {
         "grant_type": "authorization_code",
         "code": code,
         "redirect_uri": REDIRECT_URI
     }
+    return spotifyRequestToken(client, data, tokenStore)
+
+# Sends a request to Spotify to get a new access token using the saved refresh token
+# Returns the access token (else None)
+def spotifyRefreshAccessToken(client, tokenStore):
+    savedToken = tokenStore.get("spotify")
+    if not savedToken or not savedToken.get("refresh_token"):
+        return None
+    data = {
+        "grant_type": "refresh_token",
+        "refresh_token": savedToken["refresh_token"]
+    }
+    return spotifyRequestToken(client, data, tokenStore)
+
+# Sends a token request (authorization code or refresh token grant) to Spotify
+# Returns the access token (else None)
+def spotifyRequestToken(client, data, tokenStore=None):
+    url = "https://accounts.spotify.com/api/token"
+    loadDotenv()
     clientIDnSecretStringBytes = f"{os.getenv('SPOTIFY_CLIENT_ID')}:{os.getenv('SPOTIFY_CLIENT_SECRET')}".encode("ascii")
     encodedClientIDnSecret = base64.b64encode(clientIDnSecretStringBytes).decode("ascii")
     headers = {
         "Authorization": f"Basic {encodedClientIDnSecret}",
         "Content-Type": "application/x-www-form-urlencoded"
         }
-    response = requests.post(url, data=data, headers=headers)
+    response = client.post(url, data=data, headers=headers)
     if response.status_code == 200:
         token = response.json()["access_token"]
+        client.setToken(token)
+        if tokenStore:
+            tokenStore.put("spotify", response.json())
         #print("Token retrieved successfully. Response:")
         #print(json.dumps(response.json(), indent=2))
         return token
@@ -119,75 +538,117 @@ def spotifyGetAccessToken(code):
     return None
 
 # Retrieves the user ID from Spotify using the access token
-def spotifyGetUserID(token):
-    url = f"{SPOTIFY_BASE_URL}/me"
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(url, headers=headers)
+def spotifyGetUserID(client):
+    response = client.get("/me")
     if response.status_code == 200:
         return response.json()["id"]
     else:
         print("Failed to retrieve user ID:", response.status_code)
         return None
     
-# Retrieves all playlists of the signed in user from Spotify using the access token
-# Returns a generator that yields playlists
-def spotifyGetPlaylists(token):
-    limit = 50
-    offset = 0
-    total = -1
-    url = f"{SPOTIFY_BASE_URL}/me/playlists"
-    headers = {"Authorization": f"Bearer {token}"}
-    while (total == -1 or offset < total):
-        params = {
-            "limit": limit,
-            "offset": offset
-        }
-        response = requests.get(url, headers=headers, params=params)
+# Waits until the shared Spotify rate limit backoff has passed
+def spotifyWaitForRateLimit():
+    while True:
+        with spotifyRateLimitLock:
+            waitTime = spotifyRetryAt - time.time()
+        if waitTime <= 0:
+            return
+        time.sleep(waitTime)  # recorded as throttled once per backoff in spotifyRegisterRateLimit
+
+# Registers a Spotify 429 response, so that all workers back off together
+def spotifyRegisterRateLimit(response):
+    global spotifyRetryAt
+    retryAfter = response.headers.get("Retry-After")
+    waitTime = int(retryAfter) if retryAfter else SPOTIFY_RETRY_AFTER
+    with spotifyRateLimitLock:
+        if time.time() + waitTime > spotifyRetryAt:
+            requestMetrics.recordThrottle("spotify rate limit", time.time() + waitTime - max(spotifyRetryAt, time.time()))
+            spotifyRetryAt = time.time() + waitTime
+            print(f"Spotify rate limit exceeded. Retrying after {waitTime} seconds...")
+
+# Retrieves a single page of a Spotify paging object, retrying on rate limiting
+# fields (if given) is the Spotify fields filter, so that only these fields are sent
+# Returns the page data (else None)
+def spotifyGetPage(client, path, offset, limit, fields=None):
+    params = {
+        "limit": limit,
+        "offset": offset
+    }
+    if fields:
+        params["fields"] = fields
+    while True:
+        spotifyWaitForRateLimit()
+        with spotifyRequestSlots:
+            response = client.get(path, params=params)
         if response.status_code == 200:
-            playlists = response.json()
-            total = playlists["total"]
-            offset += limit
-            yield from playlists["items"]
+            return response.json()
         elif response.status_code == 429:
-            waitTime = SPOTIFY_RETRY_AFTER
-            print(f"Spotify rate limit exceeded. Retrying after {waitTime} seconds...")
-            time.sleep(waitTime)
-            return spotifyGetPlaylists(token)  # Retry the request
+            spotifyRegisterRateLimit(response)
         else:
-            print("Failed to retrieve playlists:", response.status_code)
-            break
-        
+            print(f"Failed to retrieve {path} at offset {offset}:", response.status_code)
+            return None
+
+# Retrieves all items of a Spotify paging object, limit items per page (the largest page size of the endpoint)
+# The first page tells the total, the remaining pages are fetched concurrently with up to maxWorkers threads
+# Returns a generator that yields the items in order, followed by the total (None if a page failed, so that
+# the items are incomplete)
+def spotifyGetAllPages(client, path, maxWorkers=SPOTIFY_MAX_WORKERS, limit=SPOTIFY_PAGE_LIMIT, fields=None):
+    firstPage = spotifyGetPage(client, path, 0, limit, fields)
+    if firstPage is None:
+        return None
+    yield from firstPage["items"]
+    total = firstPage["total"]
+    limit = firstPage.get("limit") or limit  # the page size the server actually used
+    offsets = range(limit, total, limit)
+    if maxWorkers > 1 and len(offsets) > 1:
+        with ThreadPoolExecutor(max_workers=min(maxWorkers, len(offsets))) as executor:
+            pages = executor.map(lambda offset: spotifyGetPage(client, path, offset, limit, fields), offsets)
+            for page in pages:
+                if page is None:
+                    return None
+                yield from page["items"]
+    else:
+        for offset in offsets:
+            page = spotifyGetPage(client, path, offset, limit, fields)
+            if page is None:
+                return None
+            yield from page["items"]
+    return total
+
+# Collects all items of a paging generator like spotifyGetAllPages
+# Returns the list of items and whether they are complete (no page failed and the total is reached)
+def collectPages(pages):
+    items = []
+    while True:
+        try:
+            items.append(next(pages))
+        except StopIteration as stop:
+            return items, stop.value is not None and len(items) >= stop.value
+
+# Retrieves all playlists of the signed in user from Spotify using the access token
+# Returns a generator that yields playlists
+def spotifyGetPlaylists(client, maxWorkers=SPOTIFY_MAX_WORKERS):
+    total = yield from spotifyGetAllPages(client, "/me/playlists", maxWorkers)
+    if total is None:
+        print("Failed to retrieve playlists.")
+    return total
+
 # Retrieves all tracks of a specific playlist from Spotify using the access token
 # Returns a generator that yields tracks
-def spotifyGetSpecificPlaylistTracks(token, playlistID):
-    limit = 50
-    offset = 0
-    total = -1
-    url = f"{SPOTIFY_BASE_URL}/playlists/{playlistID}/tracks"
-    headers = {"Authorization": f"Bearer {token}"}
-    while (total == -1 or offset < total):
-        params = {
-            "limit": limit,
-            "offset": offset
-        }
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            total = data["total"]
-            offset += limit
-            yield from data["items"]
-        elif response.status_code == 429:
-            waitTime = SPOTIFY_RETRY_AFTER
-            print(f"Spotify rate limit exceeded. Retrying after {waitTime} seconds...")
-            time.sleep(waitTime)
-            return spotifyGetSpecificPlaylistTracks(token, playlistID)
-        else:
-            print("Failed to retrieve playlist tracks:", response.status_code)
-            print(f"Playlist: {playlistID}")
-            break
-    if total == 0:
+def spotifyGetSpecificPlaylistTracks(client, playlistID, maxWorkers=SPOTIFY_MAX_WORKERS):
+    total = yield from spotifyGetAllPages(client, f"/playlists/{playlistID}/tracks", maxWorkers,
+                                          SPOTIFY_PLAYLIST_ITEMS_LIMIT, SPOTIFY_PLAYLIST_ITEM_FIELDS)
+    if total is None:
+        print(f"Failed to retrieve tracks of playlist {playlistID}.")
+    elif total == 0:
         print(f"No tracks found in playlist {playlistID}.")
-        
+    return total
+
+# Prints the number of Spotify requests and the bytes received so far
+def spotifyPrintTransferSummary():
+    requestCount, bytesReceived = requestMetrics.serviceTotals("spotify")
+    print(f"Spotify export: {requestCount} requests, {bytesReceived / 1e6:.1f} MB received")
+
 # def printPlaylist(token, playlists, search):
 #     searchlist = [playlist for playlist in playlists if search.lower() in playlist["name"].lower()]
 #     for item in searchlist:
@@ -197,107 +658,528 @@ def spotifyGetSpecificPlaylistTracks(token, playlistID):
 #         for track in tracks:
 #             print(f"{track['track']['name']} by {track['track']['artists'][0]['name']}")
 
-def spotifyGetUserSavedTracks(token):
-    limit = 50
-    offset = 0
-    total = -1
-    url = f"{SPOTIFY_BASE_URL}/me/tracks"
-    headers = {"Authorization": f"Bearer {token}"}
-    while (total == -1 or offset < total):
-        params = {
-            "limit": limit,
-            "offset": offset
-        }
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            total = data["total"]
-            offset += limit
-            yield from data["items"]
-        elif response.status_code == 429:
-            waitTime = SPOTIFY_RETRY_AFTER
-            print(f"Spotify rate limit exceeded. Retrying after {waitTime} seconds...")
-            time.sleep(waitTime)
-            return spotifyGetUserSavedTracks(token)
-        else:
-            print("Failed to retrieve user saved tracks:", response.status_code)
-            break
-    if total == 0:
+# Retrieves the number of saved tracks (liked songs) of the signed in user with a single one-item page
+# Returns the number of saved tracks (else None)
+def spotifyGetUserSavedTracksTotal(client):
+    page = spotifyGetPage(client, "/me/tracks", 0, 1)
+    return page["total"] if page else None
+
+# Retrieves all saved tracks (liked songs) of the signed in user from Spotify using the access token
+# Returns a generator that yields tracks
+def spotifyGetUserSavedTracks(client, maxWorkers=SPOTIFY_MAX_WORKERS):
+    total = yield from spotifyGetAllPages(client, "/me/tracks", maxWorkers)
+    if total is None:
+        print("Failed to retrieve user saved tracks.")
+    elif total == 0:
         print(f"No user saved tracks found.")
+    return total
 
-# Saves the playlists with tracks to a JSON file
-# Each playlist is a dictionary with the playlist name and a list of tracks
-# Returns None
-def savePlaylistsToJson(token, filename, playlists):
-    playlistsWithTracks = []
-    for playlist in playlists:
-        tracks = list(spotifyGetSpecificPlaylistTracks(token, playlist["id"]))
-        print(f"App received tracks from playlist {playlist['name']}: {len(tracks)} tracks")
-        playlistsWithTracks.append({
-            "playlist_name": playlist["name"],
-            "tracks": [
-                {
-                    "track_name": track["track"]["name"],
-                    "artist_name": track["track"]["artists"]
-                }
-                for track in tracks if track.get("track") # if tracks is not None
-            ]
-        })
-    userSavedTracks = list(spotifyGetUserSavedTracks(token))
-    if userSavedTracks:
-        tracks = userSavedTracks
-        print(f"App received user's saved tracks: {len(tracks)} tracks")
-        playlistsWithTracks.append({
-            "playlist_name": "Spotify Liked Songs",
-            "tracks": [
-                {
-                    "track_name": track["track"]["name"],
-                    "artist_name": track["track"]["artists"]
-                }
-                for track in tracks if track.get("track") # if tracks is not None
-            ]
+## SPOTIFY LIBRARY STORE
+
+# Persistent SQLite store of fetched Spotify playlists and liked songs (as compact tracks)
+# Playlists are keyed by ID and snapshot_id, so that unchanged playlists are served from disk
+class SpotifyLibraryStore:
+    def __init__(self, filename=SPOTIFY_STORE_FILE):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS playlists (
+                id TEXT PRIMARY KEY,
+                snapshot_id TEXT NOT NULL,
+                tracks TEXT NOT NULL
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS liked_songs (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                entries TEXT NOT NULL
+            )""")
+        self.connection.commit()
+
+    # Returns the stored compact tracks of a playlist if its snapshot is unchanged (else None)
+    def getPlaylistTracks(self, playlistId, snapshotId):
+        with self.lock:
+            row = self.connection.execute("SELECT snapshot_id, tracks FROM playlists WHERE id = ?",
+                                          (playlistId,)).fetchone()
+        if row and row[0] == snapshotId:
+            return json.loads(row[1])
+        return None
+
+    # Returns whether the tracks of a playlist are stored for this snapshot, without loading them
+    def hasPlaylist(self, playlistId, snapshotId):
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM playlists WHERE id = ? AND snapshot_id = ?",
+                                          (playlistId, snapshotId)).fetchone()
+        return row is not None
+
+    def putPlaylistTracks(self, playlistId, snapshotId, tracks):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO playlists (id, snapshot_id, tracks) VALUES (?, ?, ?)",
+                                    (playlistId, snapshotId, json.dumps(tracks)))
+            self.connection.commit()
+
+    # Returns the stored liked songs, newest first, as {"added_at", "track"} entries (track None for unavailable tracks)
+    def getLikedSongs(self):
+        with self.lock:
+            row = self.connection.execute("SELECT entries FROM liked_songs WHERE id = 0").fetchone()
+        return json.loads(row[0]) if row else []
+
+    def putLikedSongs(self, entries):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO liked_songs (id, entries) VALUES (0, ?)",
+                                    (json.dumps(entries),))
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+# Retrieves the compact tracks of a playlist (without removed and local tracks)
+# Returns the list of compact tracks (else None if not all of them could be retrieved)
+def spotifyGetCompactPlaylistTracks(client, playlistId, maxWorkers=SPOTIFY_MAX_WORKERS):
+    items, complete = collectPages(spotifyGetSpecificPlaylistTracks(client, playlistId, maxWorkers))
+    if not complete:
+        return None
+    return [compactTrack for compactTrack in (compactSpotifyTrack(item.get("track")) for item in items) if compactTrack]
+
+# Retrieves the compact liked songs (without removed and local tracks)
+# Returns the list of compact tracks (else None if not all of them could be retrieved)
+def spotifyGetCompactUserSavedTracks(client, maxWorkers=SPOTIFY_MAX_WORKERS):
+    items, complete = collectPages(spotifyGetUserSavedTracks(client, maxWorkers))
+    if not complete:
+        return None
+    return [compactTrack for compactTrack in (compactSpotifyTrack(item.get("track")) for item in items) if compactTrack]
+
+# Retrieves the compact tracks of a playlist, from the store if its snapshot_id is unchanged
+# Only a complete fetch is stored, so that a failed page is fetched again by the next run
+# Returns the list of compact tracks (None if not all of them could be retrieved) and whether they were served
+# from the store
+def spotifyGetPlaylistTracksWithStore(client, playlist, store, maxWorkers=SPOTIFY_MAX_WORKERS):
+    snapshotId = playlist.get("snapshot_id")
+    if snapshotId:
+        tracks = store.getPlaylistTracks(playlist["id"], snapshotId)
+        if tracks is not None:
+            return tracks, True
+    tracks = spotifyGetCompactPlaylistTracks(client, playlist["id"], maxWorkers)
+    if snapshotId and tracks is not None:
+        store.putPlaylistTracks(playlist["id"], snapshotId, tracks)
+    return tracks, False
+
+# Retrieves the compact liked songs, fetching only the ones added since the last run
+# Pages /me/tracks from newest to oldest and stops at the first already known entry; if the result does not
+# add up to the total (e.g. songs were removed), all liked songs are fetched again
+# Returns the list of compact tracks, newest first (else None if not all of them could be retrieved)
+def spotifyGetUserSavedTracksWithStore(client, store, maxWorkers=SPOTIFY_MAX_WORKERS):
+    knownEntries = store.getLikedSongs()
+    entries = None
+    if knownEntries:
+        known = {(entry["added_at"], (entry["track"] or {}).get("spotify_id")) for entry in knownEntries}
+        newestAddedAt = knownEntries[0]["added_at"]
+        newEntries = []
+        limit = SPOTIFY_PAGE_LIMIT
+        offset = 0
+        reachedKnown = False
+        while not reachedKnown:
+            page = spotifyGetPage(client, "/me/tracks", offset, limit)
+            if page is None:
+                break
+            for item in page["items"]:
+                track = compactSpotifyTrack(item.get("track"))
+                if item["added_at"] < newestAddedAt or (item["added_at"], (track or {}).get("spotify_id")) in known:
+                    reachedKnown = True
+                    break
+                newEntries.append({"added_at": item["added_at"], "track": track})
+            offset += limit
+            if offset >= page["total"]:
+                reachedKnown = True
+        if page is not None and len(newEntries) + len(knownEntries) == page["total"]:
+            entries = newEntries + knownEntries
+            print(f"Liked songs: {len(newEntries)} new, {len(knownEntries)} served from the store.")
+    if entries is None:
+        items, complete = collectPages(spotifyGetUserSavedTracks(client, maxWorkers))
+        if not complete:
+            return None  # an incomplete list would be taken as the known liked songs by the next run
+        entries = [{"added_at": item["added_at"], "track": compactSpotifyTrack(item.get("track"))} for item in items]
+    store.putLikedSongs(entries)
+    return [entry["track"] for entry in entries if entry["track"]]
+
+## LIBRARY FILE
+# The library file is JSONL with one record per line:
+#   {"format": "spotify-to-tidal-library", "version": 1}     header
+#   {"artist": "Mark Boombastik"}                             interned artist, referenced by order of appearance
+#   {"playlist": "Beschissene Lieder", "id": "..."}           starts a playlist, followed by its tracks
+#   {"name": "...", "artists": [0], "isrc": "...", "duration_ms": 123, "id": "..."}
+# Only the fields needed for matching are kept, and writer and reader work one record at a time
+
+# Reduces a Spotify track object to the fields needed for matching
+# Returns the compact track (else None for removed/local tracks without data)
+def compactSpotifyTrack(track):
+    if not track:
+        return None
+    return {
+        "track_name": track["name"],
+        "artist_names": [artist["name"] for artist in track.get("artists", [])],
+        "isrc": track.get("external_ids", {}).get("isrc"),
+        "duration_ms": track.get("duration_ms"),
+        "spotify_id": track.get("id")
+    }
+
+# Writes playlists and compact tracks to a library file, one record at a time
+class LibraryWriter:
+    def __init__(self, filename):
+        self.file = open(filename, "w", encoding="utf-8")
+        self.artistIndex = {}
+        self.writeRecord({"format": LIBRARY_FORMAT, "version": LIBRARY_VERSION})
+
+    def writeRecord(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+        self.file.write("\n")
+
+    def startPlaylist(self, playlistName, playlistId=None):
+        self.writeRecord({"playlist": playlistName, "id": playlistId})
+
+    def writeTrack(self, track):
+        artists = []
+        for artistName in track["artist_names"]:
+            if artistName not in self.artistIndex:
+                self.artistIndex[artistName] = len(self.artistIndex)
+                self.writeRecord({"artist": artistName})
+            artists.append(self.artistIndex[artistName])
+        self.writeRecord({
+            "name": track["track_name"],
+            "artists": artists,
+            "isrc": track.get("isrc"),
+            "duration_ms": track.get("duration_ms"),
+            "id": track.get("spotify_id")
         })
-    with open(f"{filename}.json", "w") as f:
-        json.dump(playlistsWithTracks, f, indent=2)
-    print(f"Playlists saved to {filename}.json")
 
-## TIDAL
+    def close(self):
+        self.file.close()
 
-# Handles the redirect from TIDAL after user authorization
-class TidalAuthHandler(BaseHTTPRequestHandler):
-    # overwrites do_GET method to handle the redirect from TIDAL
-    def do_GET(self):
-        parsed_path = urllib.parse.urlparse(self.path)
-        params = urllib.parse.parse_qs(parsed_path.query)
-        if "code" in params and "state" in params:
-            code = params["code"][0]
-            returned_state = params["state"][0]
-            if returned_state == state:
-                self.send_response(200)
-                self.send_header("Content-type", "text/html")
-                self.end_headers()
-                self.wfile.write(b"<html><body><h1>Tidal authorization successful!</h1>You can close this window.</body></html>")
-                #print(f"Handler got authorization code: {code}")
-                self.server.code = code
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Reads a library file one record at a time
+# Returns a generator that yields ("playlist", name, playlistId) and ("track", track, None) events in file order
+def iterLibraryEvents(filename):
+    artistNames = []
+    with open(filename, "r", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("format") != LIBRARY_FORMAT:
+            raise ValueError(f"{filename} is not a library file. Convert old JSON files with --convert.")
+        for line in f:
+            record = json.loads(line)
+            if "artist" in record:
+                artistNames.append(record["artist"])
+            elif "playlist" in record:
+                yield "playlist", record["playlist"], record.get("id")
             else:
-                self.send_response(400)
-                self.end_headers()
-                self.wfile.write(b"State mismatch. Possible CSRF attack.")
-        else:
-            self.send_response(400)
-            self.end_headers()
-            self.wfile.write(b"Missing code or state parameter.")
-        
-    def log_message(self, format, *args):
-        pass  # Suppress logging to console
+                yield "track", {
+                    "track_name": record["name"],
+                    "artist_names": [artistNames[i] for i in record["artists"]],
+                    "isrc": record.get("isrc"),
+                    "duration_ms": record.get("duration_ms"),
+                    "spotify_id": record.get("id")
+                }, None
+
+# Returns whether a library playlist is the liked songs of the user (they have no Spotify playlist ID)
+def isLikedSongsPlaylist(playlistName, playlistId):
+    return playlistId is None and playlistName == LIKED_SONGS_PLAYLIST_NAME
+
+# Reads a library file
+# Returns a generator that yields playlists with their tracks, holding only one playlist in memory
+def readLibraryFromJsonl(filename):
+    playlist = None
+    for kind, value, playlistId in iterLibraryEvents(filename):
+        if kind == "playlist":
+            if playlist:
+                yield playlist
+            playlist = {"playlist_name": value, "playlist_id": playlistId, "tracks": []}
+        elif playlist:
+            playlist["tracks"].append(value)
+    if playlist:
+        yield playlist
+
+# Saves the playlists with tracks to a library file
+# Playlists and liked songs are fetched concurrently and reduced to compact tracks as they arrive,
+# the file keeps the order of the given playlists
+# With a store, unchanged playlists are served from disk and only new liked songs are fetched
+# A playlist whose tracks could not all be retrieved is left out, so that it is not synced with a partial track list
+# Returns whether all playlists and the liked songs were saved
+def saveLibraryToJsonl(client, filename, playlists, maxWorkers=SPOTIFY_MAX_WORKERS, store=None):
+    def fetchPlaylistTracks(playlist):
+        if store:
+            return spotifyGetPlaylistTracksWithStore(client, playlist, store, maxWorkers)
+        return spotifyGetCompactPlaylistTracks(client, playlist["id"], maxWorkers), False
+
+    def fetchUserSavedTracks():
+        if store:
+            return spotifyGetUserSavedTracksWithStore(client, store, maxWorkers)
+        return spotifyGetCompactUserSavedTracks(client, maxWorkers)
+
+    unchangedCount = 0
+    complete = True
+    with LibraryWriter(filename) as writer, ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        userSavedTracksFuture = executor.submit(fetchUserSavedTracks)
+        playlistTracks = executor.map(fetchPlaylistTracks, playlists)
+        for playlist, (tracks, unchanged) in zip(playlists, playlistTracks):
+            if tracks is None:
+                print(f"Leaving out playlist {playlist['name']}, its tracks could not all be retrieved from Spotify.")
+                complete = False
+                continue
+            if unchanged:
+                unchangedCount += 1
+                print(f"Playlist {playlist['name']} is unchanged: {len(tracks)} tracks served from the store")
+            else:
+                print(f"App received tracks from playlist {playlist['name']}: {len(tracks)} tracks")
+            writer.startPlaylist(playlist["name"], playlist["id"])
+            for track in tracks:
+                writer.writeTrack(track)
+        userSavedTracks = userSavedTracksFuture.result()
+        if userSavedTracks is None:
+            print("Leaving out the liked songs, they could not all be retrieved from Spotify.")
+            complete = False
+        elif userSavedTracks:
+            print(f"App received user's saved tracks: {len(userSavedTracks)} tracks")
+            writer.startPlaylist(LIKED_SONGS_PLAYLIST_NAME)
+            for track in userSavedTracks:
+                writer.writeTrack(track)
+    if store:
+        print(f"{unchangedCount} of {len(playlists)} playlists were unchanged and not fetched again.")
+    spotifyPrintTransferSummary()
+    print(f"Playlists saved to {filename}")
+    return complete
+
+# Converts an old playlists JSON file (as written by earlier versions) into a library file
+# Old files have no ISRC, duration or Spotify ID, so those fields stay empty
+# Returns the number of converted tracks
+def convertPlaylistsJsonToJsonl(jsonFilename, jsonlFilename):
+    trackCount = 0
+    with open(jsonFilename, "r", encoding="utf-8") as f:
+        playlists = json.load(f)
+    with LibraryWriter(jsonlFilename) as writer:
+        for playlist in playlists:
+            writer.startPlaylist(playlist["playlist_name"])
+            for track in playlist["tracks"]:
+                writer.writeTrack({
+                    "track_name": track["track_name"],
+                    "artist_names": [artist["name"] for artist in track["artist_name"]]
+                })
+                trackCount += 1
+    print(f"Converted {len(playlists)} playlists with {trackCount} tracks from {jsonFilename} to {jsonlFilename}")
+    return trackCount
+
+## SEARCH QUERY PLANNER
+
+# "feat." credits in brackets or at the end of a title, e.g. "Song (feat. Artist)" or "Song ft. Artist"
+FEATURING_PATTERN = re.compile(r"\s*[(\[]\s*(?:feat\.?|ft\.?|featuring|with)\s[^)\]]*[)\]]|\s+(?:feat\.?|ft\.?|featuring)\s.*$",
+                               re.IGNORECASE)
+# Release decorations that TIDAL titles usually do not have, e.g. "Song - Remastered 2011" or "Song (Original Mix)"
+VERSION_SUFFIX_PATTERN = re.compile(
+    r"\s*[(\[][^)\]]*\b(?:remaster(?:ed)?|original mix|radio edit|album version|single version|mono|stereo)\b[^)\]]*[)\]]"
+    r"|\s+-\s+[^-]*\b(?:remaster(?:ed)?|original mix|radio edit|album version|single version|mono|stereo)\b.*$",
+    re.IGNORECASE)
+# Any part in brackets or after " - ", including remix and live names
+TITLE_SUFFIX_PATTERN = re.compile(r"\s*[(\[][^)\]]*[)\]]|\s+-\s+.*$")
+
+# Removes repeated words from a search query (case-insensitive), keeping the first occurrence
+def dedupeQueryTokens(query):
+    seenTokens = set()
+    tokens = []
+    for token in query.split():
+        if token.casefold() not in seenTokens:
+            seenTokens.add(token.casefold())
+            tokens.append(token)
+    return " ".join(tokens)
+
+# Plans the search queries of a track, ranked from the most specific to the loosest:
+#   full     title without "feat." credits and release decorations, with the first maxArtists artists
+#   base     title without any suffix (also remix names), with the first maxArtists artists
+#   primary  title without any suffix, with the first artist only
+#   title    title without any suffix only
+# Repeated words are removed and identical queries are only planned once
+# Returns a list of (tier, query) tuples
+def planSearchQueries(trackName, artistNames, maxArtists=TIDAL_SEARCH_MAX_ARTISTS):
+    cleanTitle = VERSION_SUFFIX_PATTERN.sub("", FEATURING_PATTERN.sub("", trackName)).strip() or trackName
+    baseTitle = TITLE_SUFFIX_PATTERN.sub("", cleanTitle).strip() or cleanTitle
+    artistNames = artistNames[:maxArtists]
+    candidates = [
+        ("full", f"{cleanTitle} {' '.join(artistNames)}"),
+        ("base", f"{baseTitle} {' '.join(artistNames)}"),
+        ("primary", f"{baseTitle} {' '.join(artistNames[:1])}"),
+        ("title", baseTitle)
+    ]
+    plannedQueries = []
+    plannedKeys = set()
+    for tier, query in candidates:
+        query = dedupeQueryTokens(query.replace(" - ", " "))
+        if query.casefold() not in plannedKeys:
+            plannedKeys.add(query.casefold())
+            plannedQueries.append((tier, query))
+    return plannedQueries
+
+## MATCH SCORING
+# All hits of a search are ranked locally by title and artist token similarity and duration difference
+# Each component scores from 0 to 1, the confidence is their weighted mean (missing components are left out)
+MATCH_WEIGHTS = {"title": 0.5, "artists": 0.3, "duration": 0.2}
+
+# Returns the set of normalized words of a title or name, without "feat." credits and release decorations
+# Cached, so the words of recurring titles and artist names are computed once
+@functools.lru_cache(maxsize=100000)
+def matchTokens(text):
+    text = VERSION_SUFFIX_PATTERN.sub("", FEATURING_PATTERN.sub("", text or ""))
+    return frozenset(re.findall(r"\w+", text.casefold()))
+
+# Returns the Jaccard similarity of two token sets
+def tokenSimilarity(tokens, otherTokens):
+    if not tokens or not otherTokens:
+        return 0.0
+    return len(tokens & otherTokens) / len(tokens | otherTokens)
+
+# Converts an ISO 8601 duration as used by TIDAL (e.g. "PT3M25S") to milliseconds
+# Returns the duration in milliseconds (else None)
+def parseIsoDuration(duration):
+    match = re.fullmatch(r"PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?", duration or "")
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int((int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(seconds or 0)) * 1000)
+
+# Scores how well a TIDAL search hit matches a Spotify track
+# Returns the confidence from 0 to 1
+def scoreSearchHit(track, hit):
+    hitTitle = f"{hit.get('title') or ''} {hit.get('version') or ''}"
+    scores = {"title": tokenSimilarity(matchTokens(track["track_name"]), matchTokens(hitTitle))}
+    if hit.get("artists"):
+        trackArtists = [matchTokens(name) for name in track["artist_names"][:TIDAL_SEARCH_MAX_ARTISTS]]
+        hitArtists = [matchTokens(name) for name in hit["artists"]]
+        scores["artists"] = sum(max(tokenSimilarity(artist, hitArtist) for hitArtist in hitArtists)
+                                for artist in trackArtists) / len(trackArtists) if trackArtists else 0.0
+    if track.get("duration_ms") and hit.get("duration_ms"):
+        difference = abs(track["duration_ms"] - hit["duration_ms"])
+        scores["duration"] = max(0.0, 1 - difference / MATCH_DURATION_TOLERANCE_MS)
+    return sum(MATCH_WEIGHTS[name] * score for name, score in scores.items()) / sum(MATCH_WEIGHTS[name] for name in scores)
+
+# Ranks all hits of a search by their confidence
+# Returns a list of (confidence, hit) tuples, best first
+def rankSearchHits(track, hits):
+    return sorted(((scoreSearchHit(track, hit), hit) for hit in hits), key=lambda scoredHit: scoredHit[0], reverse=True)
+
+## SEARCH CACHE
+
+# Normalizes a track search query so that equivalent searches share one cache entry
+# Returns the normalized query string
+def normalizeSearchQuery(trackName, artistNames):
+    query = f"{trackName} {' '.join(artistNames)}"
+    return " ".join(query.casefold().split())
+
+# Persistent SQLite cache for TIDAL track search results, keyed by normalized query and country code
+# Stores the chosen track ID (None for "no results") and the raw hit list of each search
+class TidalSearchCache:
+    def __init__(self, filename=SEARCH_CACHE_FILE, ttl=SEARCH_CACHE_TTL,
+                 negativeTtl=SEARCH_CACHE_NEGATIVE_TTL, maxEntries=SEARCH_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # the cache is shared by the pipeline stages and search workers
+        # the cache file may be shared by the processes of a batch migration, WAL lets them read while one writes
+        self.connection = sqlite3.connect(filename, check_same_thread=False, timeout=SEARCH_CACHE_BUSY_TIMEOUT)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS search_cache (
+                query TEXT NOT NULL,
+                country_code TEXT NOT NULL,
+                track_id TEXT,
+                hits TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (query, country_code)
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS search_cache_last_used ON search_cache (last_used)")
+        self.connection.commit()
+        self.entryCount = self.connection.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+
+    # Returns a (trackId, hits) tuple for a fresh cache entry (else None)
+    def get(self, query, countryCode):
+        with self.lock:
+            return self.getLocked(query, countryCode)
+
+    def getLocked(self, query, countryCode):
+        row = self.connection.execute(
+            "SELECT track_id, hits, created_at FROM search_cache WHERE query = ? AND country_code = ?",
+            (query, countryCode)).fetchone()
+        now = time.time()
+        if row:
+            trackId, hits, createdAt = row
+            ttl = self.ttl if trackId else self.negativeTtl
+            if now - createdAt < ttl:
+                self.connection.execute(
+                    "UPDATE search_cache SET last_used = ? WHERE query = ? AND country_code = ?",
+                    (now, query, countryCode))
+                self.connection.commit()
+                self.hits += 1
+                return trackId, json.loads(hits)
+        self.misses += 1
+        return None
+
+    # Returns a (trackId, hits) tuple for a fresh cache entry (else None), without counting a hit or miss
+    def peek(self, query, countryCode):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT track_id, hits, created_at FROM search_cache WHERE query = ? AND country_code = ?",
+                (query, countryCode)).fetchone()
+        if row is None or time.time() - row[2] >= (self.ttl if row[0] else self.negativeTtl):
+            return None
+        return row[0], json.loads(row[1])
+
+    # Stores a search result; an empty hit list is cached as a negative result
+    def put(self, query, countryCode, hits):
+        with self.lock:
+            self.putLocked(query, countryCode, hits)
+
+    def putLocked(self, query, countryCode, hits):
+        now = time.time()
+        trackId = hits[0]["id"] if hits else None
+        self.connection.execute(
+            "INSERT OR REPLACE INTO search_cache (query, country_code, track_id, hits, created_at, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (query, countryCode, trackId, json.dumps(hits), now, now))
+        self.entryCount += 1  # may overcount replaced entries, corrected by evict()
+        if self.entryCount > self.maxEntries:
+            self.evict()
+        self.connection.commit()
+
+    # Removes the least recently used entries beyond the size cap
+    def evict(self):
+        count = self.connection.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+        if count > self.maxEntries:
+            self.connection.execute(
+                "DELETE FROM search_cache WHERE rowid IN "
+                "(SELECT rowid FROM search_cache ORDER BY last_used ASC LIMIT ?)",
+                (count - self.maxEntries,))
+            count = self.maxEntries
+        self.entryCount = count
+
+    def printSummary(self):
+        lookups = self.hits + self.misses
+        hitRate = (self.hits / lookups * 100) if lookups else 0
+        print(f"Search cache: {self.hits} hits, {self.misses} misses ({hitRate:.1f}% hit rate)")
+
+    def close(self):
+        self.connection.close()
+
+## TIDAL
 
 # Opens the browser to let the user authorize the app
 # Returns the authorization code or None if the user did not authorize
 def tidalGetUserAuthorizationCode():
     # open the browser to let the user authorize the app
     global state
+    loadDotenv()
     url = "https://login.tidal.com/authorize"
-    scope = "user.read search.read playlists.write playlists.read"
     state = ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=16))
     codeChallengeS256Digest = hashlib.sha256(codeVerifier.encode("utf-8")).digest()
     codeChallenge = base64.urlsafe_b64encode(codeChallengeS256Digest).decode("utf-8").rstrip("=")
@@ -305,24 +1187,23 @@ def tidalGetUserAuthorizationCode():
         "response_type": "code",
         "client_id": os.getenv("TIDAL_CLIENT_ID"),
         "redirect_uri": TIDAL_REDIRECT_URI,
-        "scope": scope,
+        "scope": TIDAL_SCOPE,
         "code_challenge_method": "S256",
         "code_challenge": codeChallenge,
         "state": state
     }
     auth_url = f"{url}?{urllib.parse.urlencode(params)}"
-    webbrowser.open(auth_url)
+    openInBrowser(auth_url)
     print("Please authorize the app in your browser.")
     
-     # Start local server to catch the redirect
-    server = HTTPServer(("127.0.0.1", 3000), TidalAuthHandler)
-    server.handle_request()  # Handles a single request, then exits
-    return getattr(server, "code", None)
+    # Start local server to catch the redirect
+    return waitForAuthorizationCode(3000, "Tidal")
 
 # Sends a request to TIDAL to get an access token using the authorization code
+# The token is set on the client for all further requests and saved to the token store
 # Returns the access token and user ID in a list (else None)
-def tidalGetAccessToken(code):
-    url = "https://auth.tidal.com/v1/oauth2/token"
+def tidalGetAccessToken(client, code, tokenStore=None):
+    loadDotenv()
     data = {
         "grant_type": "authorization_code",
         "client_id": os.getenv("TIDAL_CLIENT_ID"),
@@ -330,60 +1211,343 @@ def tidalGetAccessToken(code):
         "redirect_uri": TIDAL_REDIRECT_URI,
         "code_verifier": codeVerifier
     }
+    return tidalRequestToken(client, data, tokenStore, TIDAL_SCOPE)
+
+# Sends a request to TIDAL to get a new access token using the refresh token saved from the PKCE login
+# (the code verifier is only needed for the first token request)
+# Returns the access token and user ID in a list (else None)
+def tidalRefreshAccessToken(client, tokenStore):
+    savedToken = tokenStore.get("tidal")
+    if not savedToken or not savedToken.get("refresh_token"):
+        return None
+    loadDotenv()
+    data = {
+        "grant_type": "refresh_token",
+        "client_id": os.getenv("TIDAL_CLIENT_ID"),
+        "refresh_token": savedToken["refresh_token"]
+    }
+    return tidalRequestToken(client, data, tokenStore)
+
+# Sends a token request (authorization code or refresh token grant) to TIDAL
+# A response without a scope was granted the requested scope (or, for a refresh, the scope of the saved login)
+# Returns the access token and user ID in a list (else None)
+def tidalRequestToken(client, data, tokenStore=None, requestedScope=None):
+    url = "https://auth.tidal.com/v1/oauth2/token"
     headers = {
         "Content-Type": "application/x-www-form-urlencoded"
     }
-    response = requests.post(url, data=data, headers=headers)
+    response = client.post(url, data=data, headers=headers)
     if response.status_code == 200:
-        token = response.json()["access_token"]
-        userID = response.json()["user_id"]
+        tokenResponse = response.json()
+        token = tokenResponse["access_token"]
+        userID = tokenResponse.get("user_id")
+        client.setToken(token)
+        if tokenStore:
+            tokenStore.put("tidal", {"scope": requestedScope, **tokenResponse})
         print("Token retrieved successfully.")
         # print(json.dumps(response.json(), indent=2))
         return token, userID
     else:
         print("Failed to retrieve token:", response.status_code)
+    return None
+
+# Concurrency limit that adapts to rate limiting: it grows by one slot per limit successful responses
+# (additive increase) and is halved on a 429 response (multiplicative decrease), which also pauses all requests
+# for the Retry-After time
+class AdaptiveConcurrencyLimiter:
+    def __init__(self, initialLimit=TIDAL_SEARCH_INITIAL_IN_FLIGHT, maxLimit=TIDAL_SEARCH_MAX_IN_FLIGHT, minLimit=1):
+        self.limit = float(initialLimit)
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        self.peakLimit = self.limit
+        self.inFlight = 0
+        self.retryAt = 0
+        self.rateLimitCount = 0
+        self.condition = threading.Condition()
+
+    # Waits for a free slot (and for a running backoff to pass)
+    def acquire(self):
+        with self.condition:
+            while True:
+                waitTime = self.retryAt - time.time()
+                if waitTime > 0:
+                    self.condition.wait(waitTime)
+                elif self.inFlight < int(self.limit):
+                    break
+                else:
+                    self.condition.wait()
+            self.inFlight += 1
+
+    def release(self):
+        with self.condition:
+            self.inFlight -= 1
+            self.condition.notify_all()
+
+    def registerSuccess(self):
+        with self.condition:
+            self.limit = min(self.maxLimit, self.limit + 1 / self.limit)
+            self.peakLimit = max(self.peakLimit, self.limit)
+            self.condition.notify_all()
+
+    def registerRateLimit(self, waitTime):
+        with self.condition:
+            self.rateLimitCount += 1
+            if time.time() >= self.retryAt:  # decrease only once for all requests rejected in the same backoff
+                self.limit = max(self.minLimit, self.limit / 2)
+                self.retryAt = time.time() + waitTime
+                requestMetrics.recordThrottle("tidal search rate limit", waitTime)  # once per backoff, not per worker
+                print(f"Rate limit exceeded. Retrying after {waitTime} seconds with {int(self.limit)} concurrent searches...")
+
+# Reduces a TIDAL search response (with included tracks and artists) to the fields used for scoring
+# Returns a list of hits with id, title, version, artists (names) and duration_ms, in TIDAL's order
+def compactTidalSearchHits(data):
+    included = {(resource["type"], resource["id"]): resource for resource in data.get("included", [])}
+    artistNames = {artistId: resource.get("attributes", {}).get("name")
+                   for (resourceType, artistId), resource in included.items() if resourceType == "artists"}
+    hits = []
+    for trackReference in data["data"]["relationships"]["tracks"]["data"]:
+        track = included.get(("tracks", trackReference["id"]), {})
+        attributes = track.get("attributes", {})
+        artistReferences = track.get("relationships", {}).get("artists", {}).get("data") or []
+        hits.append({
+            "id": trackReference["id"],
+            "title": attributes.get("title"),
+            "version": attributes.get("version"),
+            "artists": [artistNames[artist["id"]] for artist in artistReferences if artistNames.get(artist["id"])],
+            "duration_ms": parseIsoDuration(attributes.get("duration"))
+        })
+    return hits
+
+# Sends a request to TIDAL within the limiter's concurrency (if given), retrying on rate limiting
+# Without a limiter, the wait for a rate limit is recorded as throttled time under throttleReason
+# Returns the response (never a 429 response), or None if the request failed (e.g. a timeout or connection error)
+def tidalLimitedRequest(client, method, path, limiter=None, throttleReason="tidal rate limit", **kwargs):
+    while True:
+        if limiter:
+            limiter.acquire()
+        try:
+            response = client.request(method, path, **kwargs)
+        except requests.exceptions.RequestException as e:
+            print(f"Request to TIDAL failed ({path}): {e!r}")
+            return None
+        finally:
+            if limiter:
+                limiter.release()
+        if response.status_code != 429:
+            break
+        retryAfter = response.headers.get("Retry-After")
+        if retryAfter:
+            waitTime = int(retryAfter)
+        else:
+            waitTime = 5
+        waitTime += 1
+        if limiter:
+            limiter.registerRateLimit(waitTime)
+        else:
+            print(f"Rate limit exceeded. Retrying after {waitTime} seconds...")
+            throttledSleep(throttleReason, waitTime)
+    if response.status_code < 400 and limiter:
+        limiter.registerSuccess()
+    return response
 
-# Sends a request to TIDAL to search for a track
-# Returns all data of track search result (else None)
-def tidalSearchForTrack(token, trackName, artistNames):
-    query = urllib.parse.quote(f"{trackName} {' '.join(artistNames)}").replace("/", "%2F")
+# Sends a GET request to TIDAL (see tidalLimitedRequest)
+# Returns the response (never a 429 response), or None if the request failed
+def tidalLimitedGet(client, path, params=None, limiter=None, throttleReason="tidal search rate limit"):
+    return tidalLimitedRequest(client, "GET", path, limiter, throttleReason, params=params)
+
+# Sends a request to TIDAL to search for a track with a query planned by planSearchQueries
+# The tracks and artists are included in the response, so all hits can be scored without further requests
+# If a search cache is given, cached results are returned without a request and new results are stored
+# If a limiter is given, the request waits for a free slot and rate limiting is reported to the limiter
+# Returns the list of compact hits (else None)
+def tidalSearchForTrack(client, searchQuery, cache=None, limiter=None):
+    if cache:
+        cacheKey = normalizeSearchQuery(searchQuery, [])
+        cached = cache.get(cacheKey, TIDAL_COUNTRY_CODE)
+        if cached and all("title" in hit for hit in cached[1]):  # entries of older versions have no attributes
+            return cached[1]
+    query = urllib.parse.quote(searchQuery).replace("/", "%2F")
     # query = f"{trackName} {' '.join(artistNames)}".replace(" ", "%20").replace("'", "%27").replace("/", "%2F")
-    url = f"{TIDAL_BASE_URL}/searchResults/{query}"
-    headers = {"Authorization": f"Bearer {token}"}
+    path = f"/searchResults/{query}"
     params = {
-        "countryCode": "DE",
+        "countryCode": TIDAL_COUNTRY_CODE,
         "explicitFilter": "include",
-        "include": ["tracks"]
+        "include": "tracks,artists"
     }
-    response = requests.get(url, headers=headers, params=params)
+    response = tidalLimitedGet(client, path, params, limiter)
+    if response is None:
+        return None
     if response.status_code == 200:
         data = response.json()
         if data:
-            return data
+            hits = compactTidalSearchHits(data)
+            if cache:
+                cache.put(cacheKey, TIDAL_COUNTRY_CODE, hits)
+            return hits
         else:
             print(f"Critical search failure for '{query}'")
             print("No data returned.")
             return None
-    elif response.status_code == 429:
-        retryAfter = response.headers.get("Retry-After")
-        if retryAfter:
-            waitTime = int(retryAfter)
-        else:
-            waitTime = 5
-        waitTime += 1
-        print(f"Rate limit exceeded. Retrying after {waitTime} seconds...")
-        time.sleep(waitTime)
-        return tidalSearchForTrack(token, trackName, artistNames)
     else:
         print("Failed to search for track: ", response.status_code)
-        print(json.dumps(response.json(), indent=2))
+        print(response.text)
     return None
 
+# Searches a track with its planned queries, from the most specific to the loosest, and stops at the first
+# query with hits or when maxQueries queries were sent
+# A query with only low-confidence hits also stops the search: the match goes to the review file instead
+# Returns the hits ranked by confidence as (confidence, hit) tuples (empty if no query had hits), the tier that
+# matched (None if none did) and the number of queries sent; the hits are None if a search failed
+def tidalSearchWithPlanner(client, track, cache=None, limiter=None, maxQueries=TIDAL_SEARCH_MAX_QUERIES_PER_TRACK):
+    queryCount = 0
+    for tier, searchQuery in planSearchQueries(track["track_name"], track["artist_names"])[:maxQueries]:
+        hits = tidalSearchForTrack(client, searchQuery, cache, limiter)
+        queryCount += 1
+        if hits is None:
+            return None, None, queryCount
+        if hits:
+            return rankSearchHits(track, hits), tier, queryCount
+    return [], None, queryCount
+
+# Checks whether the cache answers every query the planner would send for a track, so its search sends no request
+def tidalSearchIsCached(track, cache, maxQueries=TIDAL_SEARCH_MAX_QUERIES_PER_TRACK):
+    for tier, searchQuery in planSearchQueries(track["track_name"], track["artist_names"])[:maxQueries]:
+        cached = cache.peek(normalizeSearchQuery(searchQuery, []), TIDAL_COUNTRY_CODE)
+        if not cached or not all("title" in hit for hit in cached[1]):
+            return False
+        if cached[1]:
+            return True
+    return True
+
+# Runs TIDAL track searches concurrently within an adaptive in-flight limit
+# Counts the tier of the planned query that matched each track, to tune request count against hit rate
+class TidalSearchEngine:
+    def __init__(self, client, cache=None, initialInFlight=TIDAL_SEARCH_INITIAL_IN_FLIGHT,
+                 maxInFlight=TIDAL_SEARCH_MAX_IN_FLIGHT, maxQueriesPerTrack=TIDAL_SEARCH_MAX_QUERIES_PER_TRACK,
+                 catalogMinTracks=CATALOG_MIN_TRACKS):
+        self.client = client
+        self.cache = cache
+        self.maxQueriesPerTrack = maxQueriesPerTrack
+        self.limiter = AdaptiveConcurrencyLimiter(initialInFlight, maxInFlight)
+        self.catalogs = TidalArtistCatalogs(client, cache, self.limiter, catalogMinTracks)
+        self.executor = ThreadPoolExecutor(max_workers=maxInFlight)
+        self.lock = threading.Lock()
+        self.searchCount = 0
+        self.queryCount = 0
+        self.tierCounts = {}
+        self.confidences = []
+        self.startTime = time.time()
+
+    # Searches all given tracks, with a budget only as long as it allows matching
+    # Returns a generator that yields the ranked hits of each track (None if its search failed or was stopped by the
+    # budget) in the order of the tracks
+    def searchAll(self, tracks, budget=None):
+        def search(track):
+            if budget and not budget.allowsMatching():
+                return None
+            if self.cache and tidalSearchIsCached(track, self.cache, self.maxQueriesPerTrack):
+                self.catalogs.uncountTracks([track])  # the cached search costs nothing, a catalog would
+                searchResult = None
+            else:
+                searchResult = self.catalogs.match(track)
+            if searchResult:
+                tier, queryCount = "catalog", 0
+            else:
+                searchResult, tier, queryCount = tidalSearchWithPlanner(self.client, track, self.cache, self.limiter,
+                                                                        self.maxQueriesPerTrack)
+            if searchResult is not None:
+                tier = tier or "not found"
+                requestMetrics.countEvent("search_tier", tier)
+                if searchResult:
+                    confidence = searchResult[0][0]
+                    requestMetrics.countEvent("match_confidence", "high" if confidence >= MATCH_MIN_CONFIDENCE else
+                                              "low" if confidence >= MATCH_REJECT_CONFIDENCE else "rejected")
+                with self.lock:
+                    self.queryCount += queryCount
+                    self.tierCounts[tier] = self.tierCounts.get(tier, 0) + 1
+                    if searchResult:
+                        self.confidences.append(searchResult[0][0])
+            return searchResult
+        self.searchCount += len(tracks)
+        return self.executor.map(search, tracks)
+
+    def printSummary(self):
+        if self.searchCount:
+            elapsed = time.time() - self.startTime
+            print(f"Searched {self.searchCount} tracks in {elapsed:.1f} seconds ({self.searchCount / elapsed:.1f} per second), "
+                  f"concurrency peaked at {int(self.limiter.peakLimit)}, {self.limiter.rateLimitCount} rate limited responses.")
+            tierOrder = ["catalog", "full", "base", "primary", "title", "not found"]
+            tiers = ", ".join(f"{tier} {self.tierCounts[tier]}" for tier in tierOrder if tier in self.tierCounts)
+            print(f"Search queries: {self.queryCount} for {self.searchCount} tracks "
+                  f"({self.queryCount / self.searchCount:.2f} per track), matched by tier: {tiers}")
+            self.catalogs.printSummary()
+        if self.confidences:
+            lowCount = sum(confidence < MATCH_MIN_CONFIDENCE for confidence in self.confidences)
+            rejectedCount = sum(confidence < MATCH_REJECT_CONFIDENCE for confidence in self.confidences)
+            print(f"Match confidence: {sum(self.confidences) / len(self.confidences):.2f} on average, "
+                  f"{lowCount} of {len(self.confidences)} matches below {MATCH_MIN_CONFIDENCE}, "
+                  f"{rejectedCount} of them below {MATCH_REJECT_CONFIDENCE} rejected.")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+# Sends requests to TIDAL to look up tracks by ISRC, several ISRCs per request, within the limiter (if given)
+# Returns a dictionary mapping each found ISRC to the list of matching track IDs (else None)
+def tidalGetTracksByIsrc(client, isrcs, limiter=None):
+    path = "/tracks"
+    params = {
+        "countryCode": TIDAL_COUNTRY_CODE,
+        "filter[isrc]": list(isrcs)
+    }
+    matches = {}
+    while path:
+        response = tidalLimitedGet(client, path, params, limiter, "tidal isrc rate limit")
+        if response is None:
+            return None
+        if response.status_code != 200:
+            print("Failed to look up tracks by ISRC:", response.status_code)
+            print(response.text)
+            return None
+        data = response.json()
+        for track in data.get("data", []):
+            isrc = track.get("attributes", {}).get("isrc")
+            if isrc:
+                matches.setdefault(isrc.upper(), []).append(track["id"])
+        path = data.get("links", {}).get("next")  # the next link already contains the query
+        params = None
+    return matches
+
+# Resolves ISRCs to TIDAL track IDs in batches, using the search cache if given
+# With a budget, the batches stop as soon as it does not allow matching any more
+# With a limiter (e.g. the one of the searches), rate limiting of the lookups slows down all requests sharing it
+# Returns a dictionary mapping each ISRC to a track ID (None if TIDAL has no track with this ISRC);
+# ISRCs of failed batches are left out, so that their tracks fall back to text search
+def tidalResolveIsrcs(client, isrcs, cache=None, batchSize=TIDAL_ISRC_BATCH_SIZE, budget=None, limiter=None):
+    resolved = {}
+    pending = []
+    for isrc in dict.fromkeys(isrc.upper() for isrc in isrcs if isrc):
+        cached = cache.get(f"isrc:{isrc}", TIDAL_COUNTRY_CODE) if cache else None
+        if cached:
+            resolved[isrc] = cached[0]
+        else:
+            pending.append(isrc)
+    for i in range(0, len(pending), batchSize):
+        if budget and not budget.allowsMatching():
+            break
+        batch = pending[i:i + batchSize]
+        matches = tidalGetTracksByIsrc(client, batch, limiter)
+        if matches is None:
+            continue
+        for isrc in batch:
+            trackIds = matches.get(isrc, [])
+            resolved[isrc] = trackIds[0] if trackIds else None
+            if cache:
+                cache.put(f"isrc:{isrc}", TIDAL_COUNTRY_CODE, [{"id": trackId, "type": "tracks"} for trackId in trackIds])
+    return resolved
+
 # Creates a TIDAL Playlist
 # Returns the playlist ID if successful (else None)
-def tidalCreatePlaylist(token, playlistName):
-    url = f"{TIDAL_BASE_URL}/playlists"
-    headers = {"Authorization": f"Bearer {token}"}
+def tidalCreatePlaylist(client, playlistName):
     data = {
         "data" : {
             "attributes": {
@@ -394,7 +1558,9 @@ def tidalCreatePlaylist(token, playlistName):
             "type": "playlists"
         }
     }
-    response = requests.post(url, headers=headers, json=data) #send as data instead of json?
+    response = tidalLimitedRequest(client, "POST", "/playlists", throttleReason="tidal write rate limit", json=data)
+    if response is None:
+        return None
     if response.status_code == 201:
         print(f"Playlist '{playlistName}' created successfully.")
         return response.json()["data"]["id"]
@@ -402,42 +1568,1488 @@ def tidalCreatePlaylist(token, playlistName):
         print("Failed to create playlist:", response.status_code)
         print(json.dumps(response.json(), indent=2))
 
-# Fills a TIDAL playlist with tracks
-# Returns None
-def tidalFillPlaylistWithTracks(token, playlistId, trackIdList, playlistName=None):
-    print(f"Adding {len(trackIdList)} tracks...")
-    if trackIdList:
-        url = f"{TIDAL_BASE_URL}/playlists/{playlistId}/relationships/items"
-        headers = {"Authorization": f"Bearer {token}"}
-        trackIdListSplit = [trackIdList[i:i + 20] for i in range(0, len(trackIdList), 20)]  # Split into chunks of 20
-        for splitList in trackIdListSplit:
+# Schedules writes of track chunks into TIDAL playlists
+# Requests are paced by observed 429/Retry-After responses instead of a fixed sleep, and all playlists
+# filled through one scheduler share one request budget (in-flight requests and requests per second)
+class TidalWriteScheduler:
+    def __init__(self, client, batchSize=TIDAL_WRITE_BATCH_SIZE, maxPlaylists=TIDAL_WRITE_MAX_PLAYLISTS,
+                 maxInFlight=TIDAL_WRITE_MAX_IN_FLIGHT, maxRequestsPerSecond=TIDAL_WRITE_MAX_REQUESTS_PER_SECOND,
+                 maxRetries=TIDAL_WRITE_MAX_RETRIES, readLimiter=None):
+        self.client = client
+        self.readLimiter = readLimiter  # limits the reads of synced playlists and favorites, e.g. shared with the searches
+        self.batchSize = batchSize
+        self.minInterval = 1 / maxRequestsPerSecond if maxRequestsPerSecond else 0
+        self.interval = self.minInterval  # grows on 429 responses and shrinks again on success
+        self.maxRetries = maxRetries
+        self.lock = threading.Lock()
+        self.nextRequestAt = 0
+        self.retryAt = 0
+        self.throttledUntil = 0  # end of the pacing time already recorded in the metrics
+        self.requestSlots = threading.BoundedSemaphore(maxInFlight)
+        self.executor = ThreadPoolExecutor(max_workers=maxPlaylists)
+        self.futures = []
+
+    # Waits until the request budget allows the next request
+    # The pacing is recorded as wall-clock time: writers that wait at the same time count only the part of their
+    # wait that extends the time already recorded
+    def waitForTurn(self):
+        with self.lock:
+            now = time.time()
+            requestAt = max(now, self.nextRequestAt, self.retryAt)
+            self.nextRequestAt = requestAt + self.interval
+            if requestAt > max(now, self.throttledUntil):
+                requestMetrics.recordThrottle("tidal write pacing", requestAt - max(now, self.throttledUntil))
+                self.throttledUntil = requestAt
+        if requestAt > now:
+            time.sleep(requestAt - now)
+
+    def registerRateLimit(self, response):
+        retryAfter = response.headers.get("Retry-After")
+        waitTime = int(retryAfter) if retryAfter else TIDAL_WRITE_RETRY_AFTER
+        with self.lock:
+            self.retryAt = max(self.retryAt, time.time() + waitTime)
+            self.interval = min(max(self.interval * 2, TIDAL_WRITE_BACKOFF_INTERVAL), TIDAL_WRITE_MAX_INTERVAL)
+        print(f"TIDAL rate limit exceeded. Retrying after {waitTime} seconds...")
+
+    def registerSuccess(self):
+        with self.lock:
+            self.interval = max(self.interval * 0.9, self.minInterval)
+
+    # Posts one chunk of track IDs to a playlist (see postTracks)
+    # Returns the list of track IDs that could not be added
+    def postChunk(self, playlistId, chunk):
+        return self.postTracks(f"/playlists/{playlistId}/relationships/items", chunk, f"playlist {playlistId}")
+
+    # Posts one chunk of track IDs to a relationship path, retrying rate limited and failed requests with backoff
+    # A rejected chunk is split in halves, so that a single invalid track does not drop the whole chunk
+    # Returns the list of track IDs that could not be added
+    def postTracks(self, path, chunk, target):
+        data = {
+            "data": [
+                {
+                    "id": trackId,
+                    "type": "tracks"
+                } for trackId in chunk
+            ]
+        }
+        attempt = 0
+        while True:
+            self.waitForTurn()
+            try:
+                with self.requestSlots:
+                    response = self.client.post(path, json=data)
+            except requests.exceptions.RequestException as e:
+                response = None
+                error = str(e)
+            if response is not None:
+                if response.status_code == 201:
+                    self.registerSuccess()
+                    return []
+                if response.status_code == 429:
+                    self.registerRateLimit(response)
+                    continue  # rate limiting does not count as a failed attempt
+                if response.status_code in (400, 413) and len(chunk) > 1:
+                    if response.status_code == 413:
+                        with self.lock:
+                            self.batchSize = max(1, min(self.batchSize, len(chunk) // 2))
+                    half = len(chunk) // 2
+                    return self.postTracks(path, chunk[:half], target) + self.postTracks(path, chunk[half:], target)
+                if response.status_code < 500 and response.status_code != 408:
+                    print(f"Failed to add tracks to {target}:", response.status_code)
+                    print(response.text)
+                    return chunk
+                error = response.status_code
+            attempt += 1
+            if attempt > self.maxRetries:
+                print(f"Failed to add tracks to {target} after {attempt} attempts:", error)
+                return chunk
+            waitTime = TIDAL_WRITE_RETRY_BACKOFF * 2 ** (attempt - 1)
+            print(f"Adding tracks to {target} failed ({error}). Retrying in {waitTime} seconds...")
+            throttledSleep("tidal write retry backoff", waitTime)
+
+    # Removes (track ID, item ID) items from a playlist in chunks, paced like the writes
+    # Returns the number of items that could not be removed
+    def removeItems(self, playlistId, items):
+        path = f"/playlists/{playlistId}/relationships/items"
+        failedCount = 0
+        for i in range(0, len(items), self.batchSize):
+            chunk = items[i:i + self.batchSize]
             data = {
                 "data": [
                     {
                         "id": trackId,
-                        "type": "tracks"
-                    } for trackId in splitList
+                        "type": "tracks",
+                        "meta": {"itemId": itemId}
+                    } for trackId, itemId in chunk
                 ]
             }
-            time.sleep(1) # to avoid rate limiting
-            response = requests.post(url, headers=headers, json=data)
-            if response.status_code == 201:
-                if playlistName:
-                    print(f"Tracks added to playlist {playlistName} successfully.")
-                else:
-                    print(f"Tracks added to playlist {playlistId} successfully.")
+            self.waitForTurn()
+            with self.requestSlots:
+                response = tidalLimitedRequest(self.client, "DELETE", path, throttleReason="tidal write rate limit",
+                                               json=data)
+            if response is not None and response.status_code in (200, 204):
+                self.registerSuccess()
             else:
-                print("Failed to add tracks to playlist:", response.status_code)
-                print(json.dumps(response.json(), indent=2))
-    else:
-        print("No tracks found. 0 tracks were added.")
+                print(f"Failed to remove tracks from playlist {playlistId}:",
+                      response.status_code if response is not None else "request failed")
+                failedCount += len(chunk)
+        return failedCount
+
+    # Fills a TIDAL playlist with tracks, chunk by chunk in playlist order, starting at startPosition
+    # onChunkPosted(position, failed) is called after each chunk with the number of items handled so far and whether
+    # any of its tracks could not be added
+    # Returns the list of track IDs that could not be added
+    def fillPlaylist(self, playlistId, trackIdList, playlistName=None, startPosition=0, onChunkPosted=None):
+        print(f"Adding {len(trackIdList) - startPosition} tracks to playlist {playlistName or playlistId}...")
+        if not trackIdList:
+            print("No tracks found. 0 tracks were added.")
+            return []
+        failedTrackIds = []
+        position = startPosition
+        while position < len(trackIdList):
+            chunk = trackIdList[position:position + self.batchSize]
+            position += len(chunk)
+            failedChunkTrackIds = self.postChunk(playlistId, chunk)
+            failedTrackIds.extend(failedChunkTrackIds)
+            if onChunkPosted:
+                onChunkPosted(position, bool(failedChunkTrackIds))
+        if failedTrackIds:
+            print(f"{len(failedTrackIds)} of {len(trackIdList)} tracks could not be added to playlist {playlistName or playlistId}.")
+        else:
+            print(f"Tracks added to playlist {playlistName or playlistId} successfully.")
+        return failedTrackIds
+
+    # Fills a playlist in the background, so that several playlists are filled at once
+    # Returns a future with the list of track IDs that could not be added
+    def submit(self, playlistId, trackIdList, playlistName=None, startPosition=0, onChunkPosted=None):
+        future = self.executor.submit(self.fillPlaylist, playlistId, trackIdList, playlistName,
+                                      startPosition, onChunkPosted)
+        self.futures.append(future)
+        return future
+
+    # Adds tracks to the TIDAL favorites in the background (see tidalSyncFavorites)
+    # Returns a future with the list of track IDs that could not be added
+    def submitFavorites(self, userId, trackIdList, syncState):
+        future = self.executor.submit(tidalSyncFavorites, self, userId, trackIdList, syncState)
+        self.futures.append(future)
+        return future
+
+    # Syncs an existing playlist in the background (see tidalSyncPlaylist)
+    # Returns a future with the list of track IDs that could not be added
+    def submitSync(self, existingPlaylist, trackIdList, playlistName, syncState, removeExtra=False):
+        future = self.executor.submit(tidalSyncPlaylist, self, existingPlaylist, trackIdList, playlistName,
+                                      syncState, removeExtra)
+        self.futures.append(future)
+        return future
+
+    # Waits for all submitted playlists to be filled
+    # Returns the list of track IDs that could not be added
+    def waitForAll(self):
+        failedTrackIds = []
+        for future in self.futures:
+            failedTrackIds.extend(future.result())
+        self.futures = []
+        return failedTrackIds
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+# Fills a TIDAL playlist with tracks
+# Returns the list of track IDs that could not be added
+def tidalFillPlaylistWithTracks(client, playlistId, trackIdList, playlistName=None):
+    scheduler = TidalWriteScheduler(client, maxPlaylists=1)
+    try:
+        return scheduler.fillPlaylist(playlistId, trackIdList, playlistName)
+    finally:
+        scheduler.shutdown()
+
+## ARTIST CATALOG
+# Libraries are heavy on a few artists. When many tracks of one artist are left for search, the artist is resolved
+# once and its TIDAL tracks and albums are paged into a local title index, so that its tracks are matched in memory
+# and only the leftovers are searched one by one. Loading a catalog may cost at most CATALOG_MAX_REQUEST_SHARE of
+# the search queries it replaces, so that prefetching always pays off.
+
+# Returns the key of the primary artist of a track (None if it has no artist)
+def primaryArtistKey(track):
+    return " ".join(sorted(matchTokens(track["artist_names"][0]))) if track["artist_names"] else None
+
+# Sends a request to TIDAL to find an artist by name
+# Returns the ID of the first artist hit whose name has the same words (else None)
+def tidalSearchArtist(client, artistName, limiter=None):
+    path = f"/searchResults/{urllib.parse.quote(artistName).replace('/', '%2F')}"
+    params = {"countryCode": TIDAL_COUNTRY_CODE, "include": "artists"}
+    response = tidalLimitedGet(client, path, params, limiter)
+    if response is None:
+        return None
+    if response.status_code != 200:
+        print(f"Failed to search for artist {artistName}:", response.status_code)
+        return None
+    data = response.json()
+    artistNames = {resource["id"]: resource.get("attributes", {}).get("name")
+                   for resource in data.get("included", []) if resource["type"] == "artists"}
+    for artistReference in data["data"].get("relationships", {}).get("artists", {}).get("data") or []:
+        if matchTokens(artistNames.get(artistReference["id"])) == matchTokens(artistName):
+            return artistReference["id"]
+    return None
+
+# The TIDAL tracks of one artist with an index of their title words
+class TidalArtistCatalog:
+    def __init__(self, artistId, artistName):
+        self.artistId = artistId
+        self.artistName = artistName
+        self.hits = {}  # track ID -> compact hit, like the hits of a search
+        self.titleIndex = {}  # title word -> track IDs
+        self.requestCount = 0
+
+    # Adds a track resource, unless it is listed with other artists only (e.g. on a compilation album)
+    def addTrack(self, resource):
+        if resource.get("type") != "tracks" or resource["id"] in self.hits:
+            return
+        artistReferences = resource.get("relationships", {}).get("artists", {}).get("data")
+        if artistReferences and all(reference["id"] != self.artistId for reference in artistReferences):
+            return
+        attributes = resource.get("attributes", {})
+        self.hits[resource["id"]] = {
+            "id": resource["id"],
+            "title": attributes.get("title"),
+            "version": attributes.get("version"),
+            "artists": [self.artistName],
+            "duration_ms": parseIsoDuration(attributes.get("duration"))
+        }
+        for word in matchTokens(f"{attributes.get('title') or ''} {attributes.get('version') or ''}"):
+            self.titleIndex.setdefault(word, []).append(resource["id"])
+
+    # Pages the tracks of the artist, then its albums and their items in bulk, with at most maxRequests requests
+    def load(self, client, limiter=None, maxRequests=1):
+        artistId = self.artistId
+        def pages(path, params):
+            while path and self.requestCount < maxRequests:
+                response = tidalLimitedGet(client, path, params, limiter)
+                self.requestCount += 1
+                if response is None:
+                    return
+                if response.status_code != 200:
+                    print(f"Failed to retrieve {path}:", response.status_code)
+                    return
+                data = response.json()
+                yield data
+                path = data.get("links", {}).get("next")  # the next link already contains the query
+                params = None
+
+        for data in pages(f"/artists/{artistId}/relationships/tracks",
+                          {"countryCode": TIDAL_COUNTRY_CODE, "collapseBy": "FINGERPRINT", "include": "tracks"}):
+            for resource in data.get("included", []):
+                self.addTrack(resource)
+        albumIds = [albumReference["id"] for data in pages(f"/artists/{artistId}/relationships/albums",
+                                                           {"countryCode": TIDAL_COUNTRY_CODE})
+                    for albumReference in data.get("data", [])]
+        for i in range(0, len(albumIds), CATALOG_ALBUM_BATCH_SIZE):
+            for data in pages("/albums", {"countryCode": TIDAL_COUNTRY_CODE, "include": "items",
+                                          "filter[id]": albumIds[i:i + CATALOG_ALBUM_BATCH_SIZE]}):
+                for resource in data.get("included", []):
+                    self.addTrack(resource)
+
+    # Returns the catalog tracks that share one of the two rarest title words of the track, ranked by confidence
+    # (common words like "love" would otherwise rank a large part of the catalog for every track)
+    def match(self, track):
+        postings = sorted((self.titleIndex[word] for word in matchTokens(track["track_name"]) if word in self.titleIndex),
+                          key=len)
+        trackIds = {trackId for posting in postings[:2] for trackId in posting}
+        return rankSearchHits(track, [self.hits[trackId] for trackId in trackIds])
+
+# Prefetched artist catalogs of a run: counts the tracks waiting for search per primary artist and loads the catalog
+# of an artist (once, other searches of the artist wait for it) when its count reaches minTracks
+# Only tracks that missed their ISRC lookup and whose search is not cached are counted, each once, as soon as they are
+# known (by the pipeline when their playlist is exported, by the phased transfer all at once), and uncounted when they
+# are searched. Catalog matches are cached like search results.
+class TidalArtistCatalogs:
+    def __init__(self, client, cache=None, limiter=None, minTracks=CATALOG_MIN_TRACKS):
+        self.client = client
+        self.cache = cache
+        self.limiter = limiter
+        self.minTracks = minTracks
+        self.lock = threading.Lock()
+        self.trackCounts = {}  # artist key -> tracks waiting for search
+        self.countedKeys = set()  # track keys of the counted tracks
+        self.catalogs = {}  # artist key -> catalog (None if the artist was not found)
+        self.loading = {}  # artist key -> event set when its catalog is loaded
+        self.stats = {"catalogs": 0, "requests": 0, "matched": 0, "leftovers": 0}
+
+    @staticmethod
+    def cacheKey(track):
+        return normalizeSearchQuery(planSearchQueries(track["track_name"], track["artist_names"])[0][1], [])
+
+    # Counts the tracks that are going to be searched (tracks counted before are skipped), match uncounts them
+    def countTracks(self, tracks):
+        if not self.minTracks:
+            return
+        for track in tracks:
+            key = primaryArtistKey(track)
+            if not key or self.cache and tidalSearchIsCached(track, self.cache):
+                continue
+            with self.lock:
+                if trackKey(track) not in self.countedKeys:
+                    self.countedKeys.add(trackKey(track))
+                    self.trackCounts[key] = self.trackCounts.get(key, 0) + 1
+
+    # Uncounts tracks that are no longer waiting for search
+    def uncountTracks(self, tracks):
+        if not self.minTracks:
+            return
+        with self.lock:
+            for track in tracks:
+                if trackKey(track) in self.countedKeys:
+                    self.countedKeys.discard(trackKey(track))
+                    self.trackCounts[primaryArtistKey(track)] -= 1
+
+    # Returns the catalog of the primary artist of a track, loading it if the artist has enough tracks (else None)
+    def getCatalog(self, track):
+        key = primaryArtistKey(track)
+        with self.lock:
+            if key in self.catalogs:
+                return self.catalogs[key]
+            loaded = self.loading.get(key)
+            if loaded is None:
+                trackCount = self.trackCounts.get(key, 0)
+                if trackCount < self.minTracks:
+                    return None
+                loaded = self.loading[key] = threading.Event()
+            else:
+                trackCount = None
+        if trackCount is None:
+            loaded.wait()  # another search loads this catalog
+            return self.catalogs.get(key)
+        catalog = None
+        try:
+            maxRequests = int(trackCount * PLAN_QUERIES_PER_SEARCH * CATALOG_MAX_REQUEST_SHARE)
+            artistId = tidalSearchArtist(self.client, track["artist_names"][0], self.limiter) if maxRequests > 1 else None
+            if artistId:
+                catalog = TidalArtistCatalog(artistId, track["artist_names"][0])
+                catalog.load(self.client, self.limiter, maxRequests - 1)
+        finally:
+            with self.lock:
+                self.catalogs[key] = catalog
+                if maxRequests > 1:
+                    self.stats["catalogs"] += 1
+                    self.stats["requests"] += 1 + (catalog.requestCount if catalog else 0)
+            loaded.set()
+        return catalog
+
+    # Matches a track against the catalog of its primary artist
+    # Returns the catalog tracks ranked by confidence if the best one is a confident match (else None)
+    def match(self, track):
+        if not self.minTracks or not track["artist_names"]:
+            return None
+        catalog = self.getCatalog(track)
+        self.uncountTracks([track])
+        if not catalog:
+            return None
+        rankedHits = catalog.match(track)
+        with self.lock:
+            matched = bool(rankedHits) and rankedHits[0][0] >= MATCH_MIN_CONFIDENCE
+            self.stats["matched" if matched else "leftovers"] += 1
+        if not matched:
+            return None
+        if self.cache:
+            self.cache.put(self.cacheKey(track), TIDAL_COUNTRY_CODE, [rankedHits[0][1]])
+        return rankedHits
+
+    def printSummary(self):
+        if self.stats["catalogs"]:
+            print(f"Artist catalogs: {self.stats['catalogs']} prefetched with {self.stats['requests']} requests, "
+                  f"{self.stats['matched']} tracks matched in memory, {self.stats['leftovers']} left for search.")
+
+## TIDAL PLAYLIST SYNC
+# Playlists that already exist on TIDAL (same name) are synced instead of created again: their items are read
+# and only the missing tracks are posted, extra items are only removed on request. A playlist whose tracks and
+# TIDAL modification time are unchanged since its last sync is skipped without reading its items.
+
+# Retrieves all resources of a paginated TIDAL endpoint by following the next links, within the limiter (if given)
+# and retrying on rate limiting
+# Returns the list of resources (else None)
+def tidalGetAllPages(client, path, params=None, limiter=None):
+    resources = []
+    while path:
+        response = tidalLimitedGet(client, path, params, limiter, "tidal read rate limit")
+        if response is None:
+            return None
+        if response.status_code != 200:
+            print(f"Failed to retrieve {path}:", response.status_code)
+            return None
+        data = response.json()
+        resources.extend(data.get("data", []))
+        path = data.get("links", {}).get("next")  # the next link already contains the query
+        params = None
+    return resources
+
+# Retrieves the user ID of the signed in TIDAL user
+# Returns the user ID (else None)
+def tidalGetUserID(client, limiter=None):
+    response = tidalLimitedRequest(client, "GET", "/users/me", limiter)
+    if response is not None and response.status_code == 200:
+        return response.json()["data"]["id"]
+    print("Failed to retrieve TIDAL user ID:", response.status_code if response is not None else "request failed")
+    return None
+
+# Retrieves the items of a TIDAL playlist in playlist order
+# Returns a list of (track ID, item ID) tuples (else None)
+def tidalGetPlaylistItems(client, playlistId, limiter=None):
+    resources = tidalGetAllPages(client, f"/playlists/{playlistId}/relationships/items", {"countryCode": TIDAL_COUNTRY_CODE},
+                                 limiter)
+    if resources is None:
+        return None
+    return [(resource["id"], resource.get("meta", {}).get("itemId")) for resource in resources if resource["type"] == "tracks"]
+
+# Retrieves the last modification time of a TIDAL playlist
+# Returns the lastModifiedAt attribute (else None)
+def tidalGetPlaylistModifiedAt(client, playlistId, limiter=None):
+    response = tidalLimitedRequest(client, "GET", f"/playlists/{playlistId}", limiter,
+                                   params={"countryCode": TIDAL_COUNTRY_CODE})
+    if response is not None and response.status_code == 200:
+        return response.json()["data"].get("attributes", {}).get("lastModifiedAt")
+    return None
+
+# The playlists of the signed in TIDAL user, listed once and indexed by name
+# Each TIDAL playlist is claimed by at most one Spotify playlist per run: the one linked to it in the sync state
+# (it was created or synced for it before), else the first same-named Spotify playlist, so that Spotify playlists
+# that share a name keep their own TIDAL playlists
+class TidalPlaylistIndex:
+    def __init__(self, client, limiter=None, syncState=None):
+        self.lock = threading.Lock()
+        self.syncState = syncState
+        self.playlists = {}  # name -> [{"id", "modified_at"}] in TIDAL's order
+        self.playlistsById = {}
+        self.claimedIds = set()
+        self.userId = tidalGetUserID(client, limiter)
+        resources = None
+        if self.userId:
+            resources = tidalGetAllPages(client, "/playlists", {"countryCode": TIDAL_COUNTRY_CODE,
+                                                                "filter[r.owners.id]": self.userId}, limiter)
+        if resources is None:
+            print("Could not list your TIDAL playlists, all playlists will be created as new playlists.")
+            resources = []
+        for resource in resources:
+            attributes = resource.get("attributes", {})
+            playlist = {"id": resource["id"], "modified_at": attributes.get("lastModifiedAt")}
+            self.playlists.setdefault(attributes.get("name"), []).append(playlist)
+            self.playlistsById[resource["id"]] = playlist
+        print(f"Found {len(self.playlistsById)} existing TIDAL playlists.")
+
+    # Keeps playlists from being claimed, e.g. the ones the run journal has created already
+    def reserve(self, tidalIds):
+        with self.lock:
+            self.claimedIds.update(tidalIds)
+
+    # Claims the existing playlist for a Spotify playlist (spotifyId is None for the liked songs) and links them
+    # Returns the existing playlist (else None)
+    def claim(self, name, spotifyId=None):
+        with self.lock:
+            linkedId = self.syncState.linkedTidalId(spotifyId) if self.syncState and spotifyId else None
+            playlist = self.playlistsById.get(linkedId)
+            if playlist is None or linkedId in self.claimedIds:
+                playlist = next((candidate for candidate in self.playlists.get(name, [])
+                                 if candidate["id"] not in self.claimedIds
+                                 and not (self.syncState and self.syncState.linkedSpotifyId(candidate["id"])
+                                          not in (None, spotifyId))), None)
+            if playlist is None:
+                return None
+            self.claimedIds.add(playlist["id"])
+        if self.syncState and spotifyId:
+            self.syncState.link(spotifyId, playlist["id"])
+        return playlist
+
+    # Records a playlist that was created for a Spotify playlist, so that later runs find it by the link
+    def addCreated(self, spotifyId, tidalId):
+        with self.lock:
+            self.claimedIds.add(tidalId)
+        if self.syncState and spotifyId:
+            self.syncState.link(spotifyId, tidalId)
+
+# Difference between the items of an existing TIDAL playlist and the tracks it should contain
+# Tracks are matched with multiplicity, so a track that is twice in the Spotify playlist is twice on TIDAL
+class PlaylistDiff:
+    def __init__(self, existingItems):
+        self.remainingItems = {}  # track ID -> item IDs not matched to a wanted track yet
+        for trackId, itemId in existingItems:
+            self.remainingItems.setdefault(trackId, deque()).append(itemId)
+
+    # Returns the wanted track IDs that are not in the playlist yet, in order
+    def missingTracks(self, trackIds):
+        missingTrackIds = []
+        for trackId in trackIds:
+            itemIds = self.remainingItems.get(trackId)
+            if itemIds:
+                itemIds.popleft()
+            else:
+                missingTrackIds.append(trackId)
+        return missingTrackIds
+
+    # Returns the (track ID, item ID) tuples of the items that are not wanted
+    def extraItems(self):
+        return [(trackId, itemId) for trackId, itemIds in self.remainingItems.items() for itemId in itemIds]
+
+# Remembers what was last synced into each existing TIDAL playlist: a hash of the track IDs and the
+# lastModifiedAt of the playlist afterwards, and which Spotify playlist each TIDAL playlist belongs to
+class TidalSyncState:
+    def __init__(self, filename=TIDAL_SYNC_STATE_FILE):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS playlists (
+                tidal_id TEXT PRIMARY KEY,
+                tracks_hash TEXT NOT NULL,
+                modified_at TEXT
+            )""")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS favorites (track_id TEXT PRIMARY KEY)")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS links (
+                spotify_id TEXT PRIMARY KEY,
+                tidal_id TEXT NOT NULL UNIQUE
+            )""")
+        self.connection.commit()
+
+    @staticmethod
+    def tracksHash(trackIds):
+        return hashlib.sha256("\n".join(trackIds).encode("utf-8")).hexdigest()
+
+    # Returns whether the playlist was synced with these tracks and was not modified since
+    def isUnchanged(self, tidalId, trackIds, modifiedAt):
+        with self.lock:
+            row = self.connection.execute("SELECT tracks_hash, modified_at FROM playlists WHERE tidal_id = ?",
+                                          (tidalId,)).fetchone()
+        return row is not None and modifiedAt is not None and row == (self.tracksHash(trackIds), modifiedAt)
+
+    def put(self, tidalId, trackIds, modifiedAt):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO playlists (tidal_id, tracks_hash, modified_at) VALUES (?, ?, ?)",
+                                    (tidalId, self.tracksHash(trackIds), modifiedAt))
+            self.connection.commit()
+
+    # Returns the ID of the TIDAL playlist linked to a Spotify playlist (else None)
+    def linkedTidalId(self, spotifyId):
+        with self.lock:
+            row = self.connection.execute("SELECT tidal_id FROM links WHERE spotify_id = ?", (spotifyId,)).fetchone()
+        return row[0] if row else None
+
+    # Returns the ID of the Spotify playlist linked to a TIDAL playlist (else None)
+    def linkedSpotifyId(self, tidalId):
+        with self.lock:
+            row = self.connection.execute("SELECT spotify_id FROM links WHERE tidal_id = ?", (tidalId,)).fetchone()
+        return row[0] if row else None
+
+    # Links a Spotify playlist to a TIDAL playlist, replacing earlier links of either
+    def link(self, spotifyId, tidalId):
+        with self.lock:
+            self.connection.execute("DELETE FROM links WHERE spotify_id = ? OR tidal_id = ?", (spotifyId, tidalId))
+            self.connection.execute("INSERT INTO links (spotify_id, tidal_id) VALUES (?, ?)", (spotifyId, tidalId))
+            self.connection.commit()
+
+    # Returns the set of track IDs known to be in the TIDAL favorites
+    def favoriteTrackIds(self):
+        with self.lock:
+            return {row[0] for row in self.connection.execute("SELECT track_id FROM favorites")}
+
+    def addFavorites(self, trackIds):
+        with self.lock:
+            self.connection.executemany("INSERT OR IGNORE INTO favorites (track_id) VALUES (?)",
+                                        ((trackId,) for trackId in trackIds))
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+# Syncs an existing TIDAL playlist with the wanted track IDs: posts only the missing tracks and,
+# if removeExtra is set, removes the items that are not wanted
+# Returns the list of track IDs that could not be added
+def tidalSyncPlaylist(scheduler, existingPlaylist, trackIdList, playlistName, syncState, removeExtra=False):
+    tidalId = existingPlaylist["id"]
+    if syncState.isUnchanged(tidalId, trackIdList, existingPlaylist["modified_at"]):
+        print(f"Playlist {playlistName} is unchanged since its last sync.")
+        return []
+    existingItems = tidalGetPlaylistItems(scheduler.client, tidalId, scheduler.readLimiter)
+    if existingItems is None:
+        print(f"Could not read the items of playlist {playlistName}, it is not synced.")
+        return list(trackIdList)
+    diff = PlaylistDiff(existingItems)
+    missingTrackIds = diff.missingTracks(trackIdList)
+    extraItems = diff.extraItems()
+    print(f"Syncing playlist {playlistName}: {len(existingItems)} tracks on TIDAL, {len(missingTrackIds)} missing, "
+          f"{len(extraItems)} extra" + (" to remove." if removeExtra else " kept."))
+    failedTrackIds = scheduler.fillPlaylist(tidalId, missingTrackIds, playlistName) if missingTrackIds else []
+    failedRemovals = scheduler.removeItems(tidalId, extraItems) if extraItems and removeExtra else 0
+    # a playlist with kept extra items is not recorded, so that a later run with removeExtra still reads it
+    if not failedTrackIds and not failedRemovals and (removeExtra or not extraItems):
+        modifiedAt = existingPlaylist["modified_at"]
+        if missingTrackIds or extraItems or modifiedAt is None:
+            modifiedAt = tidalGetPlaylistModifiedAt(scheduler.client, tidalId, scheduler.readLimiter)
+        syncState.put(tidalId, trackIdList, modifiedAt)
+    return failedTrackIds
+
+# Retrieves the track IDs in the TIDAL favorites (user collection) of the user
+# Returns the set of track IDs (else None)
+def tidalGetFavoriteTrackIds(client, userId, limiter=None):
+    resources = tidalGetAllPages(client, f"/userCollections/{userId}/relationships/tracks", {"countryCode": TIDAL_COUNTRY_CODE},
+                                 limiter)
+    if resources is None:
+        return None
+    return {resource["id"] for resource in resources if resource["type"] == "tracks"}
+
+# Adds the liked songs to the TIDAL favorites of the user instead of a playlist
+# Tracks that were favorited by an earlier run are skipped without a request, the favorites are only read when
+# another track comes up, and only tracks that are not favorited yet are posted. Their order does not matter,
+# so full chunks are posted right away and at the same time (within the write scheduler's limits).
+class TidalFavoritesWriter:
+    def __init__(self, scheduler, userId, syncState, batchSize=TIDAL_FAVORITES_BATCH_SIZE):
+        self.scheduler = scheduler
+        self.userId = userId
+        self.path = f"/userCollections/{userId}/relationships/tracks"
+        self.syncState = syncState
+        self.batchSize = batchSize
+        self.knownTrackIds = syncState.favoriteTrackIds()
+        self.favoriteTrackIds = None  # read when the first track that is not known comes up
+        self.seenTrackIds = set()
+        self.pending = []
+        self.futures = []
+        self.executor = ThreadPoolExecutor(max_workers=TIDAL_WRITE_MAX_IN_FLIGHT)
+        self.stats = {"tracks": 0, "known": 0, "favorited": 0, "added": 0}
+        self.startTime = time.time()
+        self.requestsBefore = self.requestCount()
+
+    @staticmethod
+    def requestCount():
+        return sum(requestMetrics.endpointTotals(f"tidal {method} /userCollections")[0] for method in ("GET", "POST"))
+
+    # Adds track IDs, posting every full chunk
+    def add(self, trackIds):
+        for trackId in trackIds:
+            self.stats["tracks"] += 1
+            if trackId in self.seenTrackIds:
+                continue
+            self.seenTrackIds.add(trackId)
+            if trackId in self.knownTrackIds:
+                self.stats["known"] += 1
+                continue
+            if self.favoriteTrackIds is None:
+                self.favoriteTrackIds = tidalGetFavoriteTrackIds(self.scheduler.client, self.userId, self.scheduler.readLimiter)
+                if self.favoriteTrackIds is None:
+                    print("Could not read your TIDAL favorites, all liked songs are added.")
+                    self.favoriteTrackIds = set()
+            if trackId in self.favoriteTrackIds:
+                self.stats["favorited"] += 1
+                self.syncState.addFavorites([trackId])
+                continue
+            self.pending.append(trackId)
+            if len(self.pending) >= self.batchSize:
+                self.futures.append(self.executor.submit(self.postChunk, self.pending))
+                self.pending = []
+
+    def postChunk(self, chunk):
+        failedTrackIds = self.scheduler.postTracks(self.path, chunk, "TIDAL favorites")
+        self.syncState.addFavorites(trackId for trackId in chunk if trackId not in failedTrackIds)
+        return failedTrackIds
+
+    # Posts the last chunk, waits for all chunks and prints the throughput of the favorites transfer
+    # Returns the list of track IDs that could not be added
+    def finish(self):
+        if self.pending:
+            self.futures.append(self.executor.submit(self.postChunk, self.pending))
+            self.pending = []
+        failedTrackIds = [trackId for future in self.futures for trackId in future.result()]
+        self.executor.shutdown()
+        seconds = time.time() - self.startTime
+        requestCount = self.requestCount() - self.requestsBefore
+        self.stats["added"] = len(self.seenTrackIds) - self.stats["known"] - self.stats["favorited"] - len(failedTrackIds)
+        requestMetrics.recordTransfer("tidal_favorites", self.stats["added"], requestCount, seconds)
+        print(f"Liked songs: {self.stats['added']} of {self.stats['tracks']} tracks added to your TIDAL favorites "
+              f"with {requestCount} requests in {seconds:.1f}s ({self.stats['added'] / seconds if seconds else 0:.1f} tracks/s), "
+              f"{self.stats['known'] + self.stats['favorited']} were already favorited, {len(failedTrackIds)} failed.")
+        return failedTrackIds
+
+# Adds the liked songs to the TIDAL favorites of the user (see TidalFavoritesWriter)
+# Returns the list of track IDs that could not be added
+def tidalSyncFavorites(scheduler, userId, trackIdList, syncState):
+    favoritesWriter = TidalFavoritesWriter(scheduler, userId, syncState)
+    favoritesWriter.add(trackIdList)
+    return favoritesWriter.finish()
+
+# Records a playlist that was created and completely filled by this run as synced, so that the next run
+# can skip it as long as it is not modified on TIDAL
+def tidalRecordFilledPlaylist(client, tidalId, trackIdList, syncState, limiter=None):
+    modifiedAt = tidalGetPlaylistModifiedAt(client, tidalId, limiter)
+    if modifiedAt is not None:
+        syncState.put(tidalId, trackIdList, modifiedAt)
+
+## RUN JOURNAL
+# The run journal is JSONL with one event per line, flushed after every event, so that an interrupted
+# run can be resumed with --resume:
+#   {"event": "exported"}                                          library file is complete
+#   {"event": "resolved", "key": "isrc:...", "track_id": "..."}     track resolved (track_id None if not found)
+#   {"event": "playlist", "index": 0, "name": "...", "tidal_id": "..."}   TIDAL playlist created
+#   {"event": "chunk", "index": 0, "position": 40}                  items up to position posted
+#   {"event": "chunk_failed", "index": 0}                           tracks of the next chunk could not be added
+#   {"event": "playlist_done", "index": 0}                          playlist completely filled
+
+# Durable journal of a migration run
+class RunJournal:
+    def __init__(self, filename=RUN_JOURNAL_FILE, resume=False):
+        self.lock = threading.Lock()
+        self.exported = False
+        self.resolvedTrackIds = {}
+        self.playlists = {}  # library playlist index -> {"name", "tidal_id", "position", "done", "failed"}
+        if resume:
+            if os.path.exists(filename):
+                self.load(filename)
+                print(f"Resuming run from {filename}: {len(self.resolvedTrackIds)} resolved tracks, "
+                      f"{sum(p['done'] for p in self.playlists.values())} of {len(self.playlists)} created playlists done.")
+            else:
+                print(f"No run journal {filename} found. Starting a new run.")
+        self.file = open(filename, "a" if resume else "w", encoding="utf-8")
+
+    def load(self, filename):
+        validLength = 0
+        with open(filename, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # incomplete last line of a crashed run
+                if not line.endswith(b"\n"):
+                    break
+                validLength += len(line)
+                match record["event"]:
+                    case "exported":
+                        self.exported = True
+                    case "resolved":
+                        self.resolvedTrackIds[record["key"]] = record["track_id"]
+                    case "playlist":
+                        self.playlists[record["index"]] = {"name": record["name"], "tidal_id": record["tidal_id"],
+                                                           "position": 0, "done": False, "failed": False}
+                    case "chunk":
+                        playlist = self.playlists[record["index"]]
+                        playlist["position"] = max(playlist["position"], record["position"])
+                    case "chunk_failed":
+                        self.playlists[record["index"]]["failed"] = True
+                    case "playlist_done":
+                        self.playlists[record["index"]]["done"] = True
+        with open(filename, "r+b") as f:
+            f.truncate(validLength)  # drop the incomplete line, so that new events start on a fresh line
+
+    def record(self, event, **fields):
+        with self.lock:
+            self.file.write(json.dumps({"event": event, **fields}, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def recordExported(self):
+        self.exported = True
+        self.record("exported")
+
+    def recordResolved(self, key, trackId):
+        self.resolvedTrackIds[key] = trackId
+        self.record("resolved", key=key, track_id=trackId)
+
+    def recordPlaylistCreated(self, index, name, tidalId):
+        self.playlists[index] = {"name": name, "tidal_id": tidalId, "position": 0, "done": False, "failed": False}
+        self.record("playlist", index=index, name=name, tidal_id=tidalId)
+
+    # The position only advances while all chunks of the playlist were added completely. Once tracks of a chunk
+    # could not be added, a resume syncs the playlist with its TIDAL items instead of continuing at the position.
+    def recordChunkPosted(self, index, position, failed=False):
+        playlist = self.playlists[index]
+        if playlist["failed"]:
+            return
+        if failed:
+            playlist["failed"] = True
+            self.record("chunk_failed", index=index)
+        else:
+            playlist["position"] = position
+            self.record("chunk", index=index, position=position)
+
+    def recordPlaylistDone(self, index):
+        self.playlists[index]["done"] = True
+        self.record("playlist_done", index=index)
+
+    def close(self):
+        self.file.close()
 
+## MATCHING
+
+# Identifies a track across playlists: by ISRC if known, else by its normalized search query
+# Returns the key string
+def trackKey(track):
+    if track.get("isrc"):
+        return f"isrc:{track['isrc'].upper()}"
+    return f"query:{normalizeSearchQuery(track['track_name'], track['artist_names'])}"
+
+# Builds an index of the unique tracks of all playlists in a library file
+# Returns the dictionary mapping track keys to tracks and the total number of track occurrences
+def buildTrackIndex(filename):
+    uniqueTracks = {}
+    trackCount = 0
+    for kind, track, _ in iterLibraryEvents(filename):
+        if kind == "track":
+            trackCount += 1
+            uniqueTracks.setdefault(trackKey(track), track)
+    return uniqueTracks, trackCount
+
+## MATCH FILE
+# The match file passes the TIDAL track IDs from the match command to the push command. It is JSONL:
+#   {"format": "spotify-to-tidal-matches", "version": 1}    header
+#   {"key": "isrc:USRC17607839", "tidal_id": "75413016"}     a unique track by its track key (tidal_id null if not found)
+# Matches are appended as tracks are resolved, so an interrupted match continues where it stopped
+
+# Reads a match file, ignoring incomplete lines of an interrupted match
+# Returns a dictionary mapping track keys to TIDAL track IDs (empty if there is no match file)
+def readMatchFile(filename):
+    resolvedTrackIds = {}
+    if not os.path.exists(filename):
+        return resolvedTrackIds
+    with open(filename, "r", encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("format") != MATCH_FORMAT:
+            raise ValueError(f"{filename} is not a match file.")
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            resolvedTrackIds[record["key"]] = record["tidal_id"]
+    return resolvedTrackIds
+
+# Appends resolved tracks to a match file (started with a header if it is new), one line per track
+class MatchWriter:
+    def __init__(self, filename):
+        size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        self.lock = threading.Lock()
+        self.file = open(filename, "a", encoding="utf-8")
+        if not size:
+            self.writeRecord({"format": MATCH_FORMAT, "version": MATCH_VERSION})
+        else:
+            with open(filename, "rb") as f:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    self.file.write("\n")  # new matches start on a fresh line after an interrupted one
+
+    def writeRecord(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+            self.file.flush()
+
+    def recordResolved(self, key, trackId):
+        self.writeRecord({"key": key, "tidal_id": trackId})
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Resolves each unique track once: by ISRC in batches first, text search only for the rest
+# The tracks left for search are counted for the artist catalogs of the search engine
+# A search match below MATCH_MIN_CONFIDENCE is listed for review, below MATCH_REJECT_CONFIDENCE it is not used at all
+# onResolved(key, trackId) is called for every resolved track, e.g. to record it in the run journal
+# With a budget, matching stops once it is used up or its deadline is reached; the tracks left are not resolved
+# (budget.reached tells) and are matched by a resumed run
+# Returns a dictionary mapping track keys to TIDAL track IDs (None if not found),
+# or None if a search failed fundamentally
+def tidalResolveTracks(client, uniqueTracks, cache=None, onResolved=None, quiet=False, searchEngine=None, budget=None):
+    engine = searchEngine or TidalSearchEngine(client, cache)
+    isrcMatches = tidalResolveIsrcs(client, [track["isrc"] for track in uniqueTracks.values()], cache, budget=budget,
+                                    limiter=engine.limiter)
+    resolvedTrackIds = {}
+    searchKeys = []
+    for key, track in uniqueTracks.items():
+        isrcTrackId = isrcMatches.get((track["isrc"] or "").upper())
+        if isrcTrackId:
+            resolvedTrackIds[key] = isrcTrackId
+            if onResolved:
+                onResolved(key, isrcTrackId)
+        else:
+            searchKeys.append(key)
+    isrcMatchCount = len(resolvedTrackIds)
+    reviewCount = 0
+    engine.catalogs.countTracks(uniqueTracks[key] for key in searchKeys)
+    searchFailed = False
+    try:
+        searchResults = engine.searchAll([uniqueTracks[key] for key in searchKeys], budget)
+        for key, rankedHits in zip(searchKeys, searchResults):
+            if rankedHits is None and budget and budget.reached:
+                continue  # left for the resumed run
+            if rankedHits is None:
+                print("Search failed for track:", uniqueTracks[key]["track_name"])
+                searchFailed = True
+                continue
+            confidence, hit = rankedHits[0] if rankedHits else (None, None)
+            resolvedTrackIds[key] = hit["id"] if rankedHits and confidence >= MATCH_REJECT_CONFIDENCE else None
+            if rankedHits and confidence < MATCH_MIN_CONFIDENCE:
+                writeMatchForReview(uniqueTracks[key], confidence, hit, rejected=confidence < MATCH_REJECT_CONFIDENCE)
+                reviewCount += 1
+            if onResolved:
+                onResolved(key, resolvedTrackIds[key])
+    finally:
+        if not searchEngine:
+            engine.printSummary()
+            engine.shutdown()
+    if searchFailed:
+        return None
+    if budget and budget.reached:
+        print(f"Matching stopped with {len(resolvedTrackIds)} of {len(uniqueTracks)} unique tracks matched.")
+        return resolvedTrackIds
+    if not quiet:
+        print(f"Matched {isrcMatchCount} of {len(uniqueTracks)} unique tracks by ISRC, {len(uniqueTracks) - isrcMatchCount} by search.")
+    if reviewCount:
+        print(f"{reviewCount} search matches have a low confidence, please check them in {MATCH_REVIEW_FILE}.")
+    return resolvedTrackIds
+
+# Adds a low-confidence search match to the review file
+# The match is still used unless it is rejected, the file lets the user check it by hand
+def writeMatchForReview(track, confidence, hit, rejected=False):
+    hitVersion = f" ({hit['version']})" if hit.get("version") else ""
+    note = " (rejected, not added)" if rejected else ""
+    with open(MATCH_REVIEW_FILE, "a", encoding="utf-8") as f:
+        f.write(f"{confidence:.2f}: {track['track_name']} by {', '.join(track['artist_names'])} -> TIDAL track {hit['id']}: "
+                f"{hit.get('title')}{hitVersion} by {', '.join(hit.get('artists') or ['?'])}{note}\n")
+
+## RUN PLANNER
+# Before a run, the requests it needs are estimated per endpoint from the track counts of the playlists
+# (Spotify's tracks.total, or the library file), and the time they take under the request limits of this script.
+# During the run a progress line shows the measured request rate, the time spent throttled and a rolling ETA,
+# and an optional request budget or deadline stops the run cleanly before the next playlist.
+
+# Estimated requests per endpoint and run time of a migration
+class RunPlan:
+    def __init__(self):
+        self.requests = {"tidal GET /users/me": 1, "tidal GET /playlists": 1}
+        self.playlistCount = 0
+        self.trackCount = 0
+        self.likedCount = 0
+
+    # Returns the estimated requests of one playlist (or the liked songs) per endpoint
+    # fetched is whether its tracks are downloaded from Spotify (not served from the store or a library file),
+    # resolved whether its tracks are already matched, so that only the writes are left
+    @staticmethod
+    def estimatePlaylist(trackCount, fetched=True, likedSongs=False, likedSongsAsPlaylist=False, resolved=False):
+        if likedSongs:
+            spotifyEndpoint, spotifyLimit = "spotify GET /me/tracks", SPOTIFY_PAGE_LIMIT
+        else:
+            spotifyEndpoint, spotifyLimit = "spotify GET /playlists/{id}/tracks", SPOTIFY_PLAYLIST_ITEMS_LIMIT
+        estimate = {}
+        if fetched:
+            estimate[spotifyEndpoint] = -(-trackCount // spotifyLimit)
+        if not resolved:
+            estimate["tidal GET /tracks"] = -(-trackCount // TIDAL_ISRC_BATCH_SIZE)
+            estimate["tidal GET /searchResults/{query}"] = round(trackCount * PLAN_SEARCH_SHARE * PLAN_QUERIES_PER_SEARCH)
+        if likedSongs and not likedSongsAsPlaylist:
+            estimate["tidal POST /userCollections/{id}/relationships/tracks"] = -(-trackCount // TIDAL_FAVORITES_BATCH_SIZE)
+        else:
+            estimate["tidal POST /playlists"] = 1
+            estimate["tidal POST /playlists/{id}/relationships/items"] = -(-trackCount // TIDAL_WRITE_BATCH_SIZE)
+        return estimate
+
+    def addPlaylist(self, trackCount, fetched=True, likedSongs=False, likedSongsAsPlaylist=False, resolved=False):
+        self.playlistCount += 1
+        self.trackCount += trackCount
+        if likedSongs:
+            self.likedCount = trackCount
+        for endpoint, count in self.estimatePlaylist(trackCount, fetched, likedSongs, likedSongsAsPlaylist, resolved).items():
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + count
+
+    def totalRequests(self):
+        return sum(self.requests.values())
+
+    # Returns the estimated run time in seconds: Spotify pages and searches run concurrently with bounded workers,
+    # ISRC lookups one at a time and writes are paced. In the pipeline the stages overlap, so the slowest one counts.
+    def estimateSeconds(self, pipelined=True):
+        stageSeconds = [0.0, 0.0, 0.0, 0.0]  # Spotify, ISRC lookups, searches, writes
+        writeRate = min(TIDAL_WRITE_MAX_REQUESTS_PER_SECOND, TIDAL_WRITE_MAX_IN_FLIGHT / PLAN_REQUEST_LATENCY)
+        for endpoint, count in self.requests.items():
+            if endpoint.startswith("spotify "):
+                stageSeconds[0] += count * PLAN_REQUEST_LATENCY / SPOTIFY_MAX_WORKERS
+            elif endpoint == "tidal GET /tracks":
+                stageSeconds[1] += count * PLAN_REQUEST_LATENCY
+            elif endpoint.startswith("tidal GET /searchResults"):
+                stageSeconds[2] += count * PLAN_REQUEST_LATENCY / TIDAL_SEARCH_INITIAL_IN_FLIGHT
+            elif endpoint.startswith("tidal POST"):
+                stageSeconds[3] += count / writeRate
+            else:
+                stageSeconds[1] += count * PLAN_REQUEST_LATENCY
+        return max(stageSeconds) if pipelined else sum(stageSeconds)
+
+    def printPlan(self, pipelined=True):
+        print(f"\nRequest plan for {self.playlistCount} playlists with {self.trackCount} tracks (estimated):")
+        for endpoint, count in sorted(self.requests.items()):
+            if count:
+                print(f"  {endpoint:<55} {count:>7}")
+        print(f"  {'total':<55} {self.totalRequests():>7}")
+        print(f"The transfer takes about {formatDuration(self.estimateSeconds(pipelined))} if TIDAL does not rate limit it.\n")
+
+# Plans a run from the selected Spotify playlists (with their tracks.total) and the liked songs
+# Playlists whose snapshot is in the store are not downloaded again
+# Returns the run plan
+def planRunFromSpotify(spotifyClient, playlists, store=None, likedSongsAsPlaylist=False):
+    plan = RunPlan()
+    for playlist in playlists:
+        snapshotId = playlist.get("snapshot_id")
+        fetched = not (store and snapshotId and store.hasPlaylist(playlist["id"], snapshotId))
+        plan.addPlaylist(playlist.get("tracks", {}).get("total", 0), fetched)
+    likedCount = spotifyGetUserSavedTracksTotal(spotifyClient)
+    if likedCount:
+        plan.addPlaylist(likedCount, likedSongs=True, likedSongsAsPlaylist=likedSongsAsPlaylist)
+    return plan
+
+# Plans the TIDAL part of a run from an exported library file, only its writes if its tracks are resolved already
+# Returns the run plan
+def planRunFromLibrary(filename, likedSongsAsPlaylist=False, resolved=False):
+    plan = RunPlan()
+    for playlist in readLibraryFromJsonl(filename):
+        plan.addPlaylist(len(playlist["tracks"]), fetched=False,
+                         likedSongs=isLikedSongsPlaylist(playlist["playlist_name"], playlist["playlist_id"]),
+                         likedSongsAsPlaylist=likedSongsAsPlaylist, resolved=resolved)
+    return plan
+
+# Returns a duration in seconds as e.g. "1h05m", "12m30s" or "45s"
+def formatDuration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+# Parses a --deadline value: a clock time ("HH:MM", the next time it comes) or a duration ("90m", "2h", "600s")
+# Returns the deadline as a Unix timestamp
+def parseDeadline(value):
+    match = re.fullmatch(r"(\d{1,2}):(\d{2})", value)
+    if match and int(match[1]) < 24 and int(match[2]) < 60:
+        now = time.localtime()
+        deadline = time.mktime((now.tm_year, now.tm_mon, now.tm_mday, int(match[1]), int(match[2]), 0, 0, 0, -1))
+        return deadline if deadline > time.time() else deadline + 24 * 60 * 60
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smh])", value)
+    if match:
+        return time.time() + float(match[1]) * {"s": 1, "m": 60, "h": 3600}[match[2]]
+    raise argparse.ArgumentTypeError(f"invalid deadline {value!r}, use HH:MM or a duration like 90m")
+
+# Request budget and deadline of a run, checked before each playlist is started
+# The pipeline exports playlists ahead of their matching and writing, so the budget counts the estimated requests
+# of the playlists it allowed, not only the requests made so far
+# likedCount is the number of liked songs from the plan, they are only counted once they are fetched
+class RunBudget:
+    def __init__(self, maxRequests=None, deadline=None, likedCount=0):
+        self.maxRequests = maxRequests
+        self.deadline = deadline
+        self.likedCount = likedCount
+        self.committedRequests = 0  # requests made before the last allowed playlist plus the estimates of the allowed playlists
+        self.reached = False
+        self.lock = threading.Lock()  # matching checks the budget from the search threads
+
+    # Returns whether the next playlist (with the estimated requests of its tracks) may be started
+    def allows(self, playlistName, trackCount, likedSongs=False, resolved=False):
+        if self.reached:
+            return False
+        estimatedRequests = sum(RunPlan.estimatePlaylist(trackCount, likedSongs=likedSongs, resolved=resolved).values())
+        requestCount = max(requestMetrics.progressTotals()[0], self.committedRequests)
+        if self.maxRequests is not None and requestCount + estimatedRequests > self.maxRequests:
+            print(f"Request budget: {requestCount} of {self.maxRequests} requests used or planned, playlist {playlistName} "
+                  f"would need about {estimatedRequests} more. Stopping before it. Continue later with --resume.")
+            self.reached = True
+        elif self.deadline is not None and time.time() >= self.deadline:
+            print(f"Deadline {time.strftime('%H:%M', time.localtime(self.deadline))} reached. "
+                  f"Stopping before playlist {playlistName}. Continue later with --resume.")
+            self.reached = True
+        else:
+            self.committedRequests = requestCount + estimatedRequests
+        return not self.reached
+
+    # Returns whether matching may go on, checked before each ISRC batch and each search
+    # A run that matches the whole library before any playlist is written stops matching once the requests made so far
+    # use up the budget or the deadline is reached
+    def allowsMatching(self):
+        with self.lock:
+            if self.reached:
+                return False
+            requestCount = requestMetrics.progressTotals()[0]
+            if self.maxRequests is not None and requestCount >= self.maxRequests:
+                print(f"Request budget: {requestCount} of {self.maxRequests} requests used while matching. "
+                      f"Stopping. Continue later with --resume.")
+                self.reached = True
+            elif self.deadline is not None and time.time() >= self.deadline:
+                print(f"Deadline {time.strftime('%H:%M', time.localtime(self.deadline))} reached while matching. "
+                      f"Stopping. Continue later with --resume.")
+                self.reached = True
+            return not self.reached
+
+# Prints a progress line every few seconds while the run is going on: requests so far (of the planned),
+# the measured request rate, the time spent throttled and an ETA based on the rate of the last minute
+class ProgressReporter:
+    def __init__(self, plannedRequests, interval=PROGRESS_INTERVAL, window=PROGRESS_WINDOW):
+        self.plannedRequests = plannedRequests
+        self.interval = interval
+        self.window = window
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.startTime = time.time()
+        self.startRequests, self.startThrottled = requestMetrics.progressTotals()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopEvent.set()
+        self.thread.join()
+        self.printProgress(deque([(self.startTime, 0)]))  # the average rate of the whole run
+
+    # Returns the requests and the time spent throttled since the start of the run
+    def totals(self):
+        requestCount, throttledSeconds = requestMetrics.progressTotals()
+        return requestCount - self.startRequests, throttledSeconds - self.startThrottled
+
+    def run(self):
+        history = deque([(self.startTime, 0)])  # (time, requests) of the last window
+        while not self.stopEvent.wait(self.interval):
+            history.append((time.time(), self.totals()[0]))
+            while len(history) > 2 and history[-1][0] - history[1][0] >= self.window:
+                history.popleft()
+            self.printProgress(history)
+
+    def printProgress(self, history):
+        now = time.time()
+        requestCount, throttledSeconds = self.totals()
+        windowSeconds = now - history[0][0]
+        rate = (requestCount - history[0][1]) / windowSeconds if windowSeconds > 0 else 0.0
+        if self.stopEvent.is_set():
+            eta = "finished"
+        elif requestCount >= self.plannedRequests:
+            eta = "more requests than planned"
+        elif rate > 0:
+            eta = f"ETA {formatDuration((self.plannedRequests - requestCount) / rate)}"
+        else:
+            eta = "ETA unknown"
+        print(f"Progress: {requestCount}/{self.plannedRequests} requests in {formatDuration(now - self.startTime)}, "
+              f"{rate:.1f} req/s, {throttledSeconds:.0f}s throttled, {eta}")
+
+## PIPELINE
+# Streams export -> match -> write through bounded queues, so that tracks are matched while later playlists
+# are still downloading and written as soon as a full batch of resolved IDs is ready:
+#   export stage:  ("playlist", index, name), ("track", track), ("playlist_end", index) -> trackQueue
+#   match stage:   ("playlist", index, name, tidalId, startPosition), ("ids", [trackIds]), ("playlist_end", index) -> idQueue
+#   write stage:   posts full batches through the write scheduler
+
+# Puts an item into a bounded queue, giving up if the pipeline is stopped
+# Returns True if the item was put (else False)
+def pipelinePut(itemQueue, item, stopEvent):
+    while not stopEvent.is_set():
+        try:
+            itemQueue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+# Calls func for each item with up to depth calls running at once
+# Returns a generator that yields the results in order
+def prefetchOrdered(executor, func, items, depth):
+    futures = deque()
+    for item in items:
+        futures.append(executor.submit(func, item))
+        if len(futures) >= depth:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+# Export stage: fetches the playlists (several at once) and liked songs and feeds their tracks into trackQueue,
+# writing the library file along the way
+# With a budget, the export ends before the first playlist the budget does not allow
+# A playlist whose tracks could not all be retrieved is left out, so that it is not synced with a partial track list
+# With catalogs that have a search cache, the ISRCs of each playlist are looked up before it is emitted (the match
+# stage finds the results in the cache) and the tracks that missed are counted for the artist catalogs, so that
+# catalogs are prefetched from the whole exported playlists and not only from the small windows being searched;
+# tracks in resolvedTrackIds are skipped
+# Returns whether all playlists were exported
+def pipelineExportStage(client, playlists, filename, trackQueue, stopEvent, store=None, maxWorkers=SPOTIFY_MAX_WORKERS,
+                        budget=None, catalogs=None, resolvedTrackIds=None):
+    def fetchPlaylistTracks(playlist):
+        if stopEvent.is_set():
+            return []
+        if store:
+            return spotifyGetPlaylistTracksWithStore(client, playlist, store, maxWorkers)[0]
+        return spotifyGetCompactPlaylistTracks(client, playlist["id"], maxWorkers)
+
+    def countSearchTracks(tracks):
+        unresolvedTracks = [track for track in tracks if trackKey(track) not in (resolvedTrackIds or {})]
+        isrcMatches = tidalResolveIsrcs(catalogs.client, [track["isrc"] for track in unresolvedTracks], catalogs.cache,
+                                        limiter=catalogs.limiter)
+        catalogs.countTracks(track for track in unresolvedTracks if not isrcMatches.get((track["isrc"] or "").upper()))
+
+    def emitPlaylist(writer, index, name, playlistId, tracks):
+        if catalogs and catalogs.cache and catalogs.minTracks:
+            countSearchTracks(tracks)
+        writer.startPlaylist(name, playlistId)
+        if not pipelinePut(trackQueue, ("playlist", index, name, playlistId), stopEvent):
+            return False
+        for track in tracks:
+            writer.writeTrack(track)
+            if not pipelinePut(trackQueue, ("track", track), stopEvent):
+                return False
+        return pipelinePut(trackQueue, ("playlist_end", index), stopEvent)
+
+    try:
+        with LibraryWriter(filename) as writer, ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            playlistTracks = prefetchOrdered(executor, fetchPlaylistTracks, playlists, maxWorkers)
+            complete = True
+            for index, (playlist, tracks) in enumerate(zip(playlists, playlistTracks)):
+                if tracks is None:
+                    print(f"Leaving out playlist {playlist['name']}, its tracks could not all be retrieved from Spotify.")
+                    complete = False  # the run is not completed, so that the next run transfers it
+                    continue
+                if budget and not budget.allows(playlist["name"], len(tracks)):
+                    return False
+                print(f"App received tracks from playlist {playlist['name']}: {len(tracks)} tracks")
+                if not emitPlaylist(writer, index, playlist["name"], playlist["id"], tracks):
+                    return False
+            if budget and not budget.allows(LIKED_SONGS_PLAYLIST_NAME, budget.likedCount, likedSongs=True):
+                return False
+            if store:
+                likedTracks = spotifyGetUserSavedTracksWithStore(client, store, maxWorkers)
+            else:
+                likedTracks = spotifyGetCompactUserSavedTracks(client, maxWorkers)
+            if likedTracks is None:
+                print("Leaving out the liked songs, they could not all be retrieved from Spotify.")
+                complete = False
+            elif likedTracks and not emitPlaylist(writer, len(playlists), LIKED_SONGS_PLAYLIST_NAME, None, likedTracks):
+                return False
+        spotifyPrintTransferSummary()
+        print(f"Playlists saved to {filename}")
+        return complete
+    except BaseException:
+        stopEvent.set()  # stops the other stages, so that they do not wait for tracks forever
+        raise
+    finally:
+        trackQueue.put(None)
+
+# Match stage: resolves the tracks from trackQueue in windows of one ISRC batch, creates the TIDAL playlists
+# and feeds the resolved IDs in playlist order into idQueue
+# The liked songs go to the TIDAL favorites, unless likedSongsAsPlaylist is set
+# Returns True if any track was not found
+def pipelineMatchStage(client, trackQueue, idQueue, stopEvent, journal, resolvedTrackIds, cache=None,
+                       searchEngine=None, windowSize=TIDAL_ISRC_BATCH_SIZE, tidalPlaylists=None,
+                       likedSongsAsPlaylist=False):
+    tracksNotFound = False
+    playlistName = None
+    window = []
+    exhausted = False  # whether the end of trackQueue was taken already
+
+    def flushWindow():
+        nonlocal tracksNotFound
+        pending = {trackKey(track): track for track in window if trackKey(track) not in resolvedTrackIds}
+        resolved = tidalResolveTracks(client, pending, cache, journal.recordResolved, quiet=True, searchEngine=searchEngine)
+        if resolved is None:
+            print("Aborting operation due to fundamental search error. Continue later with --resume.")
+            stopEvent.set()
+            return False
+        resolvedTrackIds.update(resolved)
+        trackIds = []
+        for track in window:
+            trackId = resolvedTrackIds.get(trackKey(track))
+            if trackId:
+                trackIds.append(trackId)
+            else:
+                print(f"No results found for '{track['track_name']}' by {', '.join(track['artist_names'])}")
+                with open("tidal_not_found.txt", "a", encoding="utf-8") as f:
+                    f.write(f"In playlist {playlistName}: {track['track_name']} by {', '.join(track['artist_names'])}\n")
+                tracksNotFound = True
+        window.clear()
+        return pipelinePut(idQueue, ("ids", trackIds), stopEvent)
+
+    try:
+        for item in iter(trackQueue.get, None):
+            if stopEvent.is_set():
+                break
+            match item[0]:
+                case "playlist":
+                    _, index, playlistName, spotifyPlaylistId = item
+                    journalPlaylist = journal.playlists.get(index)
+                    if (not likedSongsAsPlaylist and not journalPlaylist and tidalPlaylists and tidalPlaylists.userId
+                            and isLikedSongsPlaylist(playlistName, spotifyPlaylistId)):
+                        if not pipelinePut(idQueue, ("favorites", index, playlistName, tidalPlaylists.userId), stopEvent):
+                            break
+                        continue
+                    resumed = journalPlaylist and journalPlaylist["name"] == playlistName
+                    existingPlaylist = None
+                    if not resumed and tidalPlaylists:
+                        existingPlaylist = tidalPlaylists.claim(playlistName, spotifyPlaylistId)
+                    if resumed:
+                        tidalPlaylistId = journalPlaylist["tidal_id"]
+                        if journalPlaylist["done"]:
+                            startPosition = None  # nothing left to write
+                            print(f"Skipping playlist {playlistName}, it was already transferred.")
+                        elif journalPlaylist["failed"]:
+                            existingPlaylist = {"id": tidalPlaylistId, "modified_at": None}
+                            startPosition = 0  # synced as a whole at the end of the playlist
+                            print(f"Syncing Tidal playlist {playlistName}, some of its tracks could not be added before.")
+                        else:
+                            startPosition = journalPlaylist["position"]
+                            print(f"Continuing Tidal playlist: {playlistName}")
+                    elif existingPlaylist:
+                        tidalPlaylistId = existingPlaylist["id"]
+                        startPosition = 0  # synced as a whole at the end of the playlist
+                    else:
+                        tidalPlaylistId = tidalCreatePlaylist(client, playlistName)
+                        if tidalPlaylistId is None:
+                            stopEvent.set()
+                            break
+                        startPosition = 0
+                        if tidalPlaylists:
+                            tidalPlaylists.addCreated(spotifyPlaylistId, tidalPlaylistId)
+                        journal.recordPlaylistCreated(index, playlistName, tidalPlaylistId)
+                        print(f"Created Tidal playlist: {playlistName}")
+                    if not pipelinePut(idQueue, ("playlist", index, playlistName, tidalPlaylistId, startPosition,
+                                                 existingPlaylist), stopEvent):
+                        break
+                case "track":
+                    window.append(item[1])
+                    if len(window) >= windowSize and not flushWindow():
+                        break
+                case "playlist_end":
+                    if not flushWindow() or not pipelinePut(idQueue, item, stopEvent):
+                        break
+        else:
+            exhausted = True
+    except BaseException:
+        stopEvent.set()  # stops the other stages, so that they do not wait for this one forever
+        raise
+    finally:
+        if stopEvent.is_set() and not exhausted:
+            while trackQueue.get() is not None:
+                pass  # drain, so that the export stage can finish
+        idQueue.put(None)
+    return tracksNotFound
+
+# Write stage: posts the resolved IDs from idQueue in full batches as soon as they are available
+# Returns the list of track IDs that could not be added
+def pipelineWriteStage(scheduler, idQueue, journal, syncState=None, removeExtra=False):
+    failedTrackIds = []
+    current = None
+    buffer = []
+
+    def postBuffered(final):
+        while buffer and (final or len(buffer) >= scheduler.batchSize):
+            chunk = buffer[:scheduler.batchSize]
+            del buffer[:len(chunk)]
+            failedChunkTrackIds = scheduler.postChunk(current["tidalId"], chunk)
+            failedTrackIds.extend(failedChunkTrackIds)
+            current["position"] += len(chunk)
+            journal.recordChunkPosted(current["index"], current["position"], bool(failedChunkTrackIds))
+
+    for item in iter(idQueue.get, None):
+        match item[0]:
+            case "playlist":
+                _, index, name, tidalId, startPosition, existingPlaylist = item
+                current = {"index": index, "name": name, "tidalId": tidalId, "done": startPosition is None,
+                           "position": startPosition or 0, "skip": startPosition or 0, "count": 0,
+                           "existing": existingPlaylist, "favorites": None, "trackIds": [],
+                           "failedBefore": len(failedTrackIds)}
+            case "favorites":
+                _, index, name, userId = item
+                current = {"index": index, "name": name, "done": False, "existing": None,
+                           "favorites": TidalFavoritesWriter(scheduler, userId, syncState)}
+            case "ids":
+                if current["done"]:
+                    continue
+                if current["favorites"]:
+                    current["favorites"].add(item[1])
+                    continue
+                if current["existing"]:
+                    buffer.extend(item[1])  # an existing playlist is diffed against all its tracks at once
+                    continue
+                current["trackIds"].extend(item[1])
+                for trackId in item[1]:
+                    current["count"] += 1
+                    if current["skip"]:
+                        current["skip"] -= 1
+                    else:
+                        buffer.append(trackId)
+                postBuffered(False)
+            case "playlist_end":
+                if current["done"]:
+                    continue
+                if current["existing"]:
+                    failedTrackIds.extend(tidalSyncPlaylist(scheduler, current["existing"], buffer, current["name"],
+                                                            syncState, removeExtra))
+                    buffer.clear()
+                    journalPlaylist = journal.playlists.get(current["index"])
+                    if (journalPlaylist and journalPlaylist["tidal_id"] == current["tidalId"]
+                            and len(failedTrackIds) == current["failedBefore"]):
+                        journal.recordPlaylistDone(current["index"])  # a resumed playlist that was synced
+                    continue
+                if current["favorites"]:
+                    failedTrackIds.extend(current["favorites"].finish())
+                    continue
+                postBuffered(True)
+                if len(failedTrackIds) == current["failedBefore"]:
+                    journal.recordPlaylistDone(current["index"])  # else a resume syncs the playlist
+                    if syncState:
+                        tidalRecordFilledPlaylist(scheduler.client, current["tidalId"], current["trackIds"], syncState,
+                                                  scheduler.readLimiter)
+                print(f"Playlist {current['name']} filled with {current['count']} tracks.")
+    return failedTrackIds
+
+# Runs export, match and write stages concurrently
+# Playlists that already exist on TIDAL are synced, removeExtra also removes their items that are not wanted
+# The liked songs are added to the TIDAL favorites, or to a playlist if likedSongsAsPlaylist is set
+# With a budget, the run stops before the first playlist the budget does not allow and is not completed
+# Artists with at least catalogMinTracks exported tracks waiting for search are matched against their prefetched catalog
+# Returns whether any track was not found, the list of track IDs that could not be added, and whether it completed
+def runPipeline(spotifyClient, tidalClient, playlists, filename, journal, cache=None, store=None, removeExtra=False,
+                likedSongsAsPlaylist=False, budget=None, catalogMinTracks=CATALOG_MIN_TRACKS):
+    stopEvent = threading.Event()
+    trackQueue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    idQueue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    resolvedTrackIds = dict(journal.resolvedTrackIds)
+    searchEngine = TidalSearchEngine(tidalClient, cache, catalogMinTracks=catalogMinTracks)
+    scheduler = TidalWriteScheduler(tidalClient, readLimiter=searchEngine.limiter)
+    syncState = TidalSyncState()
+    tidalPlaylists = TidalPlaylistIndex(tidalClient, searchEngine.limiter, syncState)
+    tidalPlaylists.reserve(playlist["tidal_id"] for playlist in journal.playlists.values())
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        exportFuture = executor.submit(pipelineExportStage, spotifyClient, playlists, filename, trackQueue, stopEvent, store,
+                                       budget=budget, catalogs=searchEngine.catalogs, resolvedTrackIds=resolvedTrackIds)
+        matchFuture = executor.submit(pipelineMatchStage, tidalClient, trackQueue, idQueue, stopEvent, journal,
+                                      resolvedTrackIds, cache, searchEngine, tidalPlaylists=tidalPlaylists,
+                                      likedSongsAsPlaylist=likedSongsAsPlaylist)
+        try:
+            failedTrackIds = pipelineWriteStage(scheduler, idQueue, journal, syncState, removeExtra)
+        except BaseException:
+            stopEvent.set()
+            while idQueue.get() is not None:
+                pass  # drain, so that the match stage can finish
+            raise
+        exported = exportFuture.result()
+        tracksNotFound = matchFuture.result()
+    scheduler.shutdown()
+    syncState.close()
+    searchEngine.printSummary()
+    searchEngine.shutdown()
+    completed = exported and not stopEvent.is_set()
+    if completed:
+        journal.recordExported()
+    return tracksNotFound, failedTrackIds, completed
 
 ## MAIN EXECUTION
-if __name__ == "__main__":
-    
-    input("Welcome to Spotify to TIDAL. Press any key to continue to Spotify login in browser: ")
-    # Log in to Spotify and get playlists
+
+# Logs in to Spotify with the saved login, or in the browser if there is none (not in headless mode)
+# Returns the Spotify client, exits if the login fails
+def spotifyLogin(tokenStore, headless=False):
+    spotifyClient = SpotifyClient()
+    if useSavedToken(spotifyClient, tokenStore, "spotify", spotifyRefreshAccessToken):
+        print("Logged in to Spotify with the saved login.")
+        return spotifyClient
+    if headless:
+        print("No saved Spotify login found. Log in once with --login-only or without --headless. Exiting.")
+        exit(1)
+    input("Press any key to continue to Spotify login in browser: ")
     spotifyAuthorizationCode = spotifyGetUserAuthorizationCode()
     while(spotifyAuthorizationCode == None):
         cmdinput = input("Spotify authorization failed. Do you want to try again? (y/n)")
@@ -447,15 +3059,50 @@ if __name__ == "__main__":
                 exit()
             case _:
                 spotifyAuthorizationCode = spotifyGetUserAuthorizationCode()
-            
-    spotifyAccessToken = spotifyGetAccessToken(spotifyAuthorizationCode)
+
+    spotifyAccessToken = spotifyGetAccessToken(spotifyClient, spotifyAuthorizationCode, tokenStore)
     if spotifyAccessToken == None:
         print("Spotify authorization failed. Exiting.")
         exit()
+    print("Spotify login successful.")
+    return spotifyClient
+
+# Selects playlists by name or Spotify ID: the included ones (all if none are included) without the excluded ones
+# Returns the selected playlists in their Spotify order
+def selectPlaylists(playlists, include=(), exclude=()):
+    knownNames = {playlist["name"] for playlist in playlists} | {playlist["id"] for playlist in playlists}
+    for name in [*include, *exclude]:
+        if name not in knownNames:
+            print(f"Playlist '{name}' was not found on Spotify and is ignored.")
+    return [playlist for playlist in playlists
+            if (not include or playlist["name"] in include or playlist["id"] in include)
+            and playlist["name"] not in exclude and playlist["id"] not in exclude]
 
-    print("Spotify login successful. Loading playlists (this may take a while)...")
-    spotifyPlaylists = list(spotifyGetPlaylists(spotifyAccessToken))
+# Logs in to Spotify and selects playlists, by asking the user or from the given selection
+# (a dict with "include" and "exclude" lists of playlist names or IDs)
+# Returns the Spotify client and the selected playlists, exits if the user cancels
+def spotifyLoginAndSelectPlaylists(tokenStore, selection=None, headless=False):
+    print("Welcome to Spotify to TIDAL.")
+    spotifyClient = spotifyLogin(tokenStore, headless)
+
+    print("Loading playlists (this may take a while)...")
+    spotifyPlaylists = list(spotifyGetPlaylists(spotifyClient))
     playlistNames = [playlist["name"] for playlist in spotifyPlaylists]
+    if selection is None and headless:
+        selection = {}  # scheduled runs without a selection transfer all playlists
+    if selection is not None:
+        playlists = selectPlaylists(spotifyPlaylists, selection.get("include", []), selection.get("exclude", []))
+        print("\nThe following playlists will be imported:")
+        for i, playlist in enumerate(spotifyPlaylists):
+            if playlist in playlists:
+                print(f"{i} - {playlist['name']}")
+        if not headless:
+            cmdinput = input("Continue? (y/n): ")
+            if cmdinput.lower() != "y":
+                print("Exiting.")
+                exit()
+        return spotifyClient, playlists
+
     print(f"App received the following playlists from Spotify:")
     for i in range(len(playlistNames)):
         print(f"{i} - {playlistNames[i]}")
@@ -502,59 +3149,451 @@ if __name__ == "__main__":
     if cmdinput.lower() != "y":
         print("Exiting.")
         exit()
+    return spotifyClient, playlists
+
+# Logs in to Spotify, selects playlists and saves them to a library file
+# Exits if the user cancels
+# Returns whether all playlists were saved
+def exportSpotifyLibrary(filename, tokenStore, selection=None, headless=False):
+    spotifyClient, playlists = spotifyLoginAndSelectPlaylists(tokenStore, selection, headless)
     print("Loading tracks from Spotify playlists (this may take a while)...")
-    savePlaylistsToJson(spotifyAccessToken, "playlists3", playlists)
-    
-    ## Load playlists from file
-    loadedPlaylists = []
-    with open("playlists3.json", "r") as f:
-        loadedPlaylists = json.load(f)
-    
-    ## Log in to TIDAL, create playlists and fill them with tracks
-    input("Press any key to continue to TIDAL login in browser: ")
-    tidalAuthorizationCode = tidalGetUserAuthorizationCode()
-    if tidalAuthorizationCode == None:
-        print("TIDAL authorization failed. Exiting.")
-        exit()
-    [tidalAccessToken, userID] = tidalGetAccessToken(tidalAuthorizationCode)
-    cmdinput = input("TIDAL login successful. Do you want to start transferring playlists now? (y/n): ")
+    spotifyStore = SpotifyLibraryStore()
+    complete = saveLibraryToJsonl(spotifyClient, filename, playlists, store=spotifyStore)
+    spotifyStore.close()
+    spotifyClient.close()
+    return complete
+
+# match command: resolves the unique tracks of the exported library on TIDAL and appends them to the match file
+# Tracks that are in the match file already are not looked up again, so an interrupted match continues
+# Returns whether all tracks were resolved
+def matchLibraryToFile(tidalClient, libraryFilename, matchFilename, searchCache=None, catalogMinTracks=CATALOG_MIN_TRACKS):
+    resolvedTrackIds = readMatchFile(matchFilename)
+    with MatchWriter(matchFilename) as writer:
+        resolvedTrackIds = matchLibrary(tidalClient, libraryFilename, resolvedTrackIds, writer.recordResolved, searchCache,
+                                        catalogMinTracks)
+    if resolvedTrackIds is None:
+        print("Aborting operation due to fundamental search error. Run the match command again to continue.")
+        return False
+    print(f"Matches saved to {matchFilename}.")
+    return True
+
+# Reads the matches of the push command and checks that every track of the library has one
+# Returns a dictionary mapping track keys to TIDAL track IDs (else None)
+def readMatchesForLibrary(libraryFilename, matchFilename):
+    resolvedTrackIds = readMatchFile(matchFilename)
+    uniqueTracks, _ = buildTrackIndex(libraryFilename)
+    unmatchedCount = sum(key not in resolvedTrackIds for key in uniqueTracks)
+    if unmatchedCount:
+        print(f"{unmatchedCount} of {len(uniqueTracks)} tracks of {libraryFilename} are not in {matchFilename}. "
+              "Run the match command first.")
+        return None
+    return resolvedTrackIds
+
+# Checks whether the saved TIDAL login was granted all scopes of a space-separated list
+# Logins saved before their scope was recorded count as lacking it
+def tidalSavedLoginHasScope(tokenStore, scope):
+    savedToken = tokenStore.get("tidal") or {}
+    return set(scope.split()) <= set((savedToken.get("scope") or "").split())
+
+# A saved TIDAL login without the collection scope cannot add the liked songs to the favorites. Interactive runs log in
+# again, headless runs cannot and add the liked songs to a playlist instead.
+# Returns whether the liked songs go to a playlist
+def tidalLikedSongsAsPlaylist(tokenStore, headless, likedSongsAsPlaylist=False):
+    if likedSongsAsPlaylist or not headless or not tokenStore.get("tidal"):
+        return likedSongsAsPlaylist
+    if tidalSavedLoginHasScope(tokenStore, TIDAL_COLLECTION_SCOPE):
+        return False
+    print(f"The saved TIDAL login has no access to the favorites, so the liked songs are added to the playlist "
+          f"{LIKED_SONGS_PLAYLIST_NAME}. Log in again with --login-only to add them to the favorites.")
+    return True
+
+# Logs in to TIDAL with the saved login, or in the browser if there is none or it lacks a scope, and asks the user to
+# start the transfer (unless askToStart is False)
+# In headless mode it never asks, keeps a saved login that lacks a scope and exits if there is no saved login
+# Returns the TIDAL client, exits if the user cancels
+def tidalLogin(tokenStore, headless=False, askToStart=True):
+    tidalClient = TidalClient()
+    if (useSavedToken(tidalClient, tokenStore, "tidal", tidalRefreshAccessToken)
+            and (headless or tidalSavedLoginHasScope(tokenStore, TIDAL_SCOPE))):
+        print("Logged in to TIDAL with the saved login.")
+        if headless or not askToStart:
+            return tidalClient
+    elif headless:
+        print("No saved TIDAL login found. Log in once with --login-only or without --headless. Exiting.")
+        exit(1)
+    else:
+        if tokenStore.get("tidal"):
+            print("The saved TIDAL login lacks access to the favorites or has expired, logging in again.")
+        input("Press any key to continue to TIDAL login in browser: ")
+        tidalAuthorizationCode = tidalGetUserAuthorizationCode()
+        if tidalAuthorizationCode == None or tidalGetAccessToken(tidalClient, tidalAuthorizationCode, tokenStore) is None:
+            print("TIDAL authorization failed. Exiting.")
+            exit()
+        print("TIDAL login successful.")
+        if not askToStart:
+            return tidalClient
+    cmdinput = input("Do you want to start transferring playlists now? (y/n): ")
     if cmdinput.lower() != "y":
         print("Exiting.")
         exit()
     for seconds in range(5, 0, -1):
         print(f"Starting transfer in {seconds}...", end="\r")
         time.sleep(1)
-    abortOperation = False
+    return tidalClient
+
+# Transfers an exported library file to TIDAL in phases: resolve all unique tracks, then create and fill playlists
+# Playlists that already exist on TIDAL are synced, removeExtra also removes their items that are not wanted
+# The liked songs are added to the TIDAL favorites, or to a playlist if likedSongsAsPlaylist is set
+# With a budget, matching stops once it is used up or its deadline is reached, and the playlists stop before the first
+# playlist the budget does not allow; either way the run is not completed
+# Artists with at least catalogMinTracks tracks waiting for search are matched against their prefetched catalog
+# Returns whether any track was not found, the list of track IDs that could not be added, and whether it completed
+def transferLibrary(tidalClient, filename, journal, searchCache=None, removeExtra=False, likedSongsAsPlaylist=False,
+                    budget=None, catalogMinTracks=CATALOG_MIN_TRACKS):
+    resolvedTrackIds = matchLibrary(tidalClient, filename, journal.resolvedTrackIds, journal.recordResolved, searchCache,
+                                    catalogMinTracks, budget)
+    if resolvedTrackIds is None:
+        print("Aborting operation due to fundamental search error. Continue later with --resume.")
+        return False, [], False
+    if budget and budget.reached:
+        return False, [], False  # the matched tracks are in the journal, the resumed run matches the rest
+    return pushLibrary(tidalClient, filename, resolvedTrackIds, journal, removeExtra, likedSongsAsPlaylist, budget)
+
+# Indexes the unique tracks of all playlists of a library file and resolves each of them once,
+# except the tracks that are in resolvedTrackIds already
+# onResolved(key, trackId) is called for every newly resolved track
+# With a budget, matching stops once it is used up or its deadline is reached, and the tracks left are not included
+# Returns a dictionary mapping track keys to TIDAL track IDs, including the given ones (else None if a search failed)
+def matchLibrary(tidalClient, filename, resolvedTrackIds, onResolved=None, searchCache=None,
+                 catalogMinTracks=CATALOG_MIN_TRACKS, budget=None):
+    uniqueTracks, trackCount = buildTrackIndex(filename)
+    print(f"Found {len(uniqueTracks)} unique tracks in {trackCount} playlist entries "
+          f"(deduplication saved {trackCount - len(uniqueTracks)} lookups).")
+    unresolvedTracks = {key: track for key, track in uniqueTracks.items() if key not in resolvedTrackIds}
+    if len(unresolvedTracks) < len(uniqueTracks):
+        print(f"{len(uniqueTracks) - len(unresolvedTracks)} tracks are already matched.")
+    searchEngine = TidalSearchEngine(tidalClient, searchCache, catalogMinTracks=catalogMinTracks)
+    try:
+        newTrackIds = tidalResolveTracks(tidalClient, unresolvedTracks, searchCache, onResolved, searchEngine=searchEngine,
+                                         budget=budget)
+    finally:
+        searchEngine.printSummary()
+        searchEngine.shutdown()
+    if newTrackIds is None:
+        return None
+    return {**resolvedTrackIds, **newTrackIds}
+
+# Creates, fills or syncs the TIDAL playlists of a library file with the resolved track IDs, without any search
+# Playlists that already exist on TIDAL are synced, removeExtra also removes their items that are not wanted
+# The liked songs are added to the TIDAL favorites, or to a playlist if likedSongsAsPlaylist is set
+# With a budget, the playlists stop before the first playlist the budget does not allow and the run is not completed
+# Returns whether any track was not found, the list of track IDs that could not be added, and whether it completed
+def pushLibrary(tidalClient, filename, resolvedTrackIds, journal, removeExtra=False, likedSongsAsPlaylist=False,
+                budget=None):
     tracksNotFound = False
-    for playlist in loadedPlaylists:
-        tidalPlaylistId = tidalCreatePlaylist(tidalAccessToken, playlist["playlist_name"])
-        print(f"Created Tidal playlist: {playlist['playlist_name']}")
+    readLimiter = AdaptiveConcurrencyLimiter()
+    writeScheduler = TidalWriteScheduler(tidalClient, readLimiter=readLimiter)
+    syncState = TidalSyncState()
+    tidalPlaylists = TidalPlaylistIndex(tidalClient, readLimiter, syncState)
+    tidalPlaylists.reserve(playlist["tidal_id"] for playlist in journal.playlists.values())
+    ## Load playlists from file, one playlist at a time
+    for playlistIndex, playlist in enumerate(readLibraryFromJsonl(filename)):
+        journalPlaylist = journal.playlists.get(playlistIndex)
+        if journalPlaylist and journalPlaylist["name"] != playlist["playlist_name"]:
+            journalPlaylist = None  # the library changed since the journaled playlist was created
+        if journalPlaylist and journalPlaylist["done"]:
+            print(f"Skipping playlist {playlist['playlist_name']}, it was already transferred.")
+            continue
+        likedSongs = isLikedSongsPlaylist(playlist["playlist_name"], playlist["playlist_id"])
+        if budget and not budget.allows(playlist["playlist_name"], len(playlist["tracks"]), likedSongs, resolved=True):
+            break
+        toFavorites = not likedSongsAsPlaylist and not journalPlaylist and tidalPlaylists.userId and likedSongs
+        existingPlaylist = None
+        if not journalPlaylist and not toFavorites:
+            existingPlaylist = tidalPlaylists.claim(playlist["playlist_name"], playlist["playlist_id"])
+        if journalPlaylist:
+            tidalPlaylistId = journalPlaylist["tidal_id"]
+            startPosition = journalPlaylist["position"]
+            if journalPlaylist["failed"]:
+                existingPlaylist = {"id": tidalPlaylistId, "modified_at": None}
+                print(f"Syncing Tidal playlist {playlist['playlist_name']}, some of its tracks could not be added before.")
+            else:
+                print(f"Continuing Tidal playlist: {playlist['playlist_name']}")
+        elif existingPlaylist:
+            tidalPlaylistId = existingPlaylist["id"]
+        elif not toFavorites:
+            tidalPlaylistId = tidalCreatePlaylist(tidalClient, playlist["playlist_name"])
+            if tidalPlaylistId is None:
+                continue
+            tidalPlaylists.addCreated(playlist["playlist_id"], tidalPlaylistId)
+            startPosition = 0
+            journal.recordPlaylistCreated(playlistIndex, playlist["playlist_name"], tidalPlaylistId)
+            print(f"Created Tidal playlist: {playlist['playlist_name']}")
         
         returnedTrackIdList = []
         for track in playlist["tracks"]:
-            searchResult = tidalSearchForTrack(tidalAccessToken, 
-                                               track["track_name"],
-                                               [artist["name"] for artist in track["artist_name"]])
-            if searchResult:
-                if searchResult["data"]["relationships"]["tracks"]["data"]:
-                    returnedTrackIdList.append(searchResult["data"]["relationships"]["tracks"]["data"][0]["id"])
-                else:
-                    print(f"No results found for '{track['track_name']}' by {', '.join([artist['name'] for artist in track['artist_name']])}")
-                    # print("Search result:")
-                    # print(json.dumps(searchResult, indent=2))
-                    with open("tidal_not_found.txt", "a", encoding="utf-8") as f:
-                        f.write(f"In playlist {playlist["playlist_name"]}: {track['track_name']} by {', '.join([artist['name'] for artist in track['artist_name']])}\n")
-                    tracksNotFound = True
-            else:
-                print("Search failed for track:", track["track_name"])
-                print("Playlist population aborted for playlist:", playlist["playlist_name"])
-                abortOperation = True
-                break
-        tidalFillPlaylistWithTracks(tidalAccessToken, tidalPlaylistId, returnedTrackIdList, playlist["playlist_name"])
-        if abortOperation:
-            print("Aborting operation due to fundamental search error.")
-            exit()
+            trackId = resolvedTrackIds.get(trackKey(track))
+            if trackId:
+                returnedTrackIdList.append(trackId)
+            elif not journalPlaylist:
+                print(f"No results found for '{track['track_name']}' by {', '.join(track['artist_names'])}")
+                with open("tidal_not_found.txt", "a", encoding="utf-8") as f:
+                    f.write(f"In playlist {playlist['playlist_name']}: {track['track_name']} by {', '.join(track['artist_names'])}\n")
+                tracksNotFound = True
+        if toFavorites:
+            writeScheduler.submitFavorites(tidalPlaylists.userId, returnedTrackIdList, syncState)
+            continue
+        if existingPlaylist:
+            future = writeScheduler.submitSync(existingPlaylist, returnedTrackIdList, playlist["playlist_name"], syncState,
+                                               removeExtra)
+        else:
+            future = writeScheduler.submit(tidalPlaylistId, returnedTrackIdList, playlist["playlist_name"], startPosition,
+                                           lambda position, failed, index=playlistIndex:
+                                           journal.recordChunkPosted(index, position, failed))
+            future.add_done_callback(
+                lambda future, tidalId=tidalPlaylistId, trackIds=returnedTrackIdList:
+                tidalRecordFilledPlaylist(tidalClient, tidalId, trackIds, syncState, writeScheduler.readLimiter)
+                if not future.exception() and not future.result() else None)
+        if journalPlaylist or not existingPlaylist:
+            future.add_done_callback(
+                lambda future, index=playlistIndex:
+                journal.recordPlaylistDone(index) if not future.exception() and not future.result() else None)
+    failedTrackIds = writeScheduler.waitForAll()
+    writeScheduler.shutdown()
+    syncState.close()
+    return tracksNotFound, failedTrackIds, not (budget and budget.reached)
+
+## BATCH MIGRATION
+
+# Migrates the library of one pre-authorized account, in a batch worker process
+# The worker runs in the account directory, so the saved logins, library, journal, store, report and log are the
+# account's own, and its rate limiting is independent of the other workers. Matches go through the search cache
+# shared by all workers, so a track resolved for one account is not searched again for the next one.
+# Returns a summary of the migration
+def migrateAccount(account, sharedCacheFile, resume=False):
+    global requestMetrics, spotifyRetryAt
+    requestMetrics = RequestMetrics()  # worker processes are reused, start every account from scratch
+    spotifyRetryAt = 0
+    startTime = time.time()
+    summary = {"account": account["name"], "completed": False, "playlists": 0, "tracks_not_found": False,
+               "failed_tracks": 0}
+    os.makedirs(account["directory"], exist_ok=True)
+    os.chdir(account["directory"])
+    with open(BATCH_LOG_FILE, "a", encoding="utf-8") as log, contextlib.redirect_stdout(log):
+        print(f"Batch migration of account {account['name']} started at {time.strftime('%Y-%m-%d %H:%M:%S')}")
+        try:
+            tokenStore = TokenStore()
+            spotifyClient = spotifyLogin(tokenStore, headless=True)
+            tidalClient = tidalLogin(tokenStore, headless=True)
+            likedSongsAsPlaylist = tidalLikedSongsAsPlaylist(tokenStore, headless=True)
+            playlists = selectPlaylists(list(spotifyGetPlaylists(spotifyClient)),
+                                        account.get("include", []), account.get("exclude", []))
+            journal = RunJournal(resume=resume)
+            searchCache = TidalSearchCache(sharedCacheFile)
+            spotifyStore = SpotifyLibraryStore()
+            tracksNotFound, failedTrackIds, completed = runPipeline(spotifyClient, tidalClient, playlists, LIBRARY_FILE,
+                                                                    journal, searchCache, spotifyStore,
+                                                                    likedSongsAsPlaylist=likedSongsAsPlaylist)
+            searchCache.printSummary()
+            for closable in (spotifyStore, searchCache, journal, spotifyClient, tidalClient):
+                closable.close()
+            summary.update(completed=completed, playlists=len(playlists), tracks_not_found=tracksNotFound,
+                           failed_tracks=len(failedTrackIds))
+        except SystemExit:
+            print("Batch migration of this account was aborted.")
+        except Exception as e:
+            print(f"Batch migration of this account failed: {e!r}")
+        requestMetrics.writeJsonReport(METRICS_REPORT_FILE)
+    summary["requests"] = requestMetrics.report()["requests"]
+    summary["wall_seconds"] = round(time.time() - startTime, 1)
+    return summary
+
+# Reads the accounts of a batch migration from a JSON file:
+# [{"name": "alice", "directory": "accounts/alice", "include": [...], "exclude": [...]}, ...]
+# The directory defaults to the name, relative paths are relative to the accounts file
+# Returns the accounts with absolute directories
+def readBatchAccounts(filename):
+    with open(filename, "r", encoding="utf-8") as f:
+        accounts = json.load(f)
+    baseDirectory = os.path.dirname(os.path.abspath(filename))
+    for account in accounts:
+        account["directory"] = os.path.join(baseDirectory, account.get("directory", account["name"]))
+    return accounts
+
+# Migrates all accounts of a batch with a pool of worker processes
+# Returns the summaries of all accounts in the order of the accounts file
+def runBatchMigration(accounts, sharedCacheFile, maxWorkers=BATCH_MAX_WORKERS, resume=False):
+    TidalSearchCache(sharedCacheFile).close()  # create the shared cache once, before the workers open it
+    summaries = {}
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        futures = {executor.submit(migrateAccount, account, sharedCacheFile, resume): account for account in accounts}
+        for future in as_completed(futures):
+            summary = future.result()
+            summaries[summary["account"]] = summary
+            status = "completed" if summary["completed"] else "NOT completed"
+            print(f"Account {summary['account']}: {status}, {summary['playlists']} playlists, "
+                  f"{summary['failed_tracks']} tracks not added, {summary['requests']} requests "
+                  f"in {summary['wall_seconds']} seconds (log: {os.path.join(futures[future]['directory'], BATCH_LOG_FILE)})")
+    return [summaries[account["name"]] for account in accounts]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate Spotify playlists to TIDAL.")
+    parser.add_argument("command", nargs="?", choices=["export", "match", "push"],
+                        help=f"run a single stage: export the Spotify library to {LIBRARY_FILE}, match its tracks on TIDAL "
+                             f"into {MATCH_FILE}, or push the matched playlists to TIDAL (default: run all stages)")
+    parser.add_argument("--convert", metavar="JSON_FILE",
+                        help=f"convert an old playlists JSON file to {LIBRARY_FILE} and exit")
+    parser.add_argument("--resume", action="store_true",
+                        help=f"resume an interrupted run from {RUN_JOURNAL_FILE} instead of starting over")
+    parser.add_argument("--phased", action="store_true",
+                        help="export the whole library before matching and writing instead of running all stages at once")
+    parser.add_argument("--report", metavar="FILE", default=METRICS_REPORT_FILE,
+                        help=f"write the request metrics of the run as JSON to FILE (default: {METRICS_REPORT_FILE})")
+    parser.add_argument("--prometheus-textfile", metavar="FILE",
+                        help="also write the request metrics in the Prometheus text format to FILE")
+    parser.add_argument("--max-requests", type=int, metavar="N",
+                        help="stop before the first playlist that would take the run over N requests (continue with --resume)")
+    parser.add_argument("--deadline", type=parseDeadline, metavar="TIME",
+                        help='do not start another playlist after TIME, a clock time ("06:30") or a duration ("90m", "2h")')
+    parser.add_argument("--catalog-min-tracks", type=int, default=CATALOG_MIN_TRACKS, metavar="N",
+                        help="match the tracks of artists with at least N tracks to search against the artist's TIDAL catalog "
+                             f"instead of searching them one by one, 0 to always search (default: {CATALOG_MIN_TRACKS})")
+    parser.add_argument("--liked-songs-as-playlist", action="store_true",
+                        help=f"add the liked songs to a TIDAL playlist named {LIKED_SONGS_PLAYLIST_NAME} instead of your TIDAL favorites")
+    parser.add_argument("--sync-remove", action="store_true",
+                        help="remove tracks from existing TIDAL playlists that are not in the Spotify playlist (anymore)")
+    parser.add_argument("--headless", action="store_true",
+                        help=f"never open the browser or ask for input, use the logins saved in {TOKEN_STORE_FILE} "
+                             "(transfers all playlists unless a selection is given)")
+    parser.add_argument("--include", metavar="PLAYLIST", action="append",
+                        help="transfer this playlist (name or Spotify ID), can be given several times")
+    parser.add_argument("--exclude", metavar="PLAYLIST", action="append",
+                        help="do not transfer this playlist (name or Spotify ID), can be given several times")
+    parser.add_argument("--config", metavar="FILE",
+                        help='read the playlist selection from a JSON file: {"include": [...], "exclude": [...], "headless": true}')
+    parser.add_argument("--workdir", metavar="DIR",
+                        help="keep the saved logins and all files of the run in DIR (e.g. the directory of a batch account)")
+    parser.add_argument("--login-only", action="store_true",
+                        help=f"log in to Spotify and TIDAL, save the logins to {TOKEN_STORE_FILE} and exit")
+    parser.add_argument("--batch", metavar="ACCOUNTS_FILE",
+                        help="migrate all pre-authorized accounts listed in ACCOUNTS_FILE with a pool of worker processes")
+    parser.add_argument("--workers", type=int, default=BATCH_MAX_WORKERS,
+                        help=f"number of accounts migrated at the same time in batch mode (default: {BATCH_MAX_WORKERS})")
+    parser.add_argument("--shared-cache", metavar="FILE",
+                        help=f"search cache shared by all batch workers (default: {SEARCH_CACHE_FILE} next to ACCOUNTS_FILE)")
+    args = parser.parse_args()
+    if args.batch:
+        accounts = readBatchAccounts(args.batch)
+        # absolute, because every worker runs in its account directory
+        sharedCacheFile = os.path.abspath(args.shared_cache or os.path.join(os.path.dirname(os.path.abspath(args.batch)),
+                                                                            SEARCH_CACHE_FILE))
+        print(f"Migrating {len(accounts)} accounts with {args.workers} worker processes...")
+        summaries = runBatchMigration(accounts, sharedCacheFile, args.workers, args.resume)
+        exit(0 if all(summary["completed"] for summary in summaries) else 1)
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        os.chdir(args.workdir)
+    if args.convert:
+        convertPlaylistsJsonToJsonl(args.convert, LIBRARY_FILE)
+        exit()
+
+    # Write the metrics report at exit, also when the run is aborted
+    def writeMetricsReports():
+        requestMetrics.writeJsonReport(args.report)
+        if args.prometheus_textfile:
+            requestMetrics.writePrometheusTextfile(args.prometheus_textfile)
+        print(f"Request metrics saved to {args.report}")
+    atexit.register(writeMetricsReports)
+
+    ## Playlist selection from the config file or the command line (the command line wins)
+    selection = None
+    headless = args.headless
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        selection = {"include": config.get("include", []), "exclude": config.get("exclude", [])}
+        headless = headless or config.get("headless", False)
+    if args.include or args.exclude:
+        selection = {"include": args.include or [], "exclude": args.exclude or []}
+
+    tokenStore = TokenStore()
+    if args.login_only:
+        spotifyLogin(tokenStore).close()
+        tidalLogin(tokenStore, askToStart=False).close()
+        print(f"Logins saved to {TOKEN_STORE_FILE}.")
+        exit()
+
+    ## Single stages, passing the library and the matches through files
+    if args.command == "export":
+        exit(0 if exportSpotifyLibrary(LIBRARY_FILE, tokenStore, selection, headless) else 1)
+    if args.command and not os.path.exists(LIBRARY_FILE):
+        print(f"No exported library {LIBRARY_FILE} found. Run the export command first.")
+        exit(1)
+    if args.command == "match":
+        tidalClient = tidalLogin(tokenStore, headless, askToStart=False)
+        searchCache = TidalSearchCache()
+        matched = matchLibraryToFile(tidalClient, LIBRARY_FILE, MATCH_FILE, searchCache, args.catalog_min_tracks)
+        searchCache.printSummary()
+        searchCache.close()
+        tidalClient.close()
+        exit(0 if matched else 1)
+
+    journal = RunJournal(resume=args.resume)
+    searchCache = None if args.command == "push" else TidalSearchCache()
+    exportComplete = True
+    likedSongsAsPlaylist = tidalLikedSongsAsPlaylist(tokenStore, headless, args.liked_songs_as_playlist)
+    if args.command == "push":
+        resolvedTrackIds = readMatchesForLibrary(LIBRARY_FILE, MATCH_FILE)
+        if resolvedTrackIds is None:
+            exit(1)
+        plan = planRunFromLibrary(LIBRARY_FILE, likedSongsAsPlaylist, resolved=True)
+        plan.printPlan(pipelined=False)
+        budget = RunBudget(args.max_requests, args.deadline, plan.likedCount)
+        tidalClient = tidalLogin(tokenStore, headless, askToStart=False)
+        with ProgressReporter(plan.totalRequests()):
+            tracksNotFound, failedTrackIds, completed = pushLibrary(tidalClient, LIBRARY_FILE, resolvedTrackIds, journal,
+                                                                    args.sync_remove, likedSongsAsPlaylist, budget)
+    elif journal.exported and os.path.exists(LIBRARY_FILE) or args.phased:
+        if journal.exported and os.path.exists(LIBRARY_FILE):
+            print(f"Using the Spotify library {LIBRARY_FILE} exported by the interrupted run.")
+        else:
+            exportComplete = exportSpotifyLibrary(LIBRARY_FILE, tokenStore, selection, headless)
+            if exportComplete:
+                journal.recordExported()  # else --resume exports again, with the playlists that were left out
+        plan = planRunFromLibrary(LIBRARY_FILE, likedSongsAsPlaylist)
+        plan.printPlan(pipelined=False)
+        budget = RunBudget(args.max_requests, args.deadline, plan.likedCount)
+        tidalClient = tidalLogin(tokenStore, headless)
+        with ProgressReporter(plan.totalRequests()):
+            tracksNotFound, failedTrackIds, completed = transferLibrary(tidalClient, LIBRARY_FILE, journal, searchCache,
+                                                                        args.sync_remove, likedSongsAsPlaylist,
+                                                                        budget, args.catalog_min_tracks)
+    else:
+        ## Log in to both services, plan the run, then export, match and write playlists at the same time
+        spotifyClient, playlists = spotifyLoginAndSelectPlaylists(tokenStore, selection, headless)
+        spotifyStore = SpotifyLibraryStore()
+        plan = planRunFromSpotify(spotifyClient, playlists, spotifyStore, likedSongsAsPlaylist)
+        plan.printPlan()
+        budget = RunBudget(args.max_requests, args.deadline, plan.likedCount)
+        tidalClient = tidalLogin(tokenStore, headless)
+        with ProgressReporter(plan.totalRequests()):
+            tracksNotFound, failedTrackIds, completed = runPipeline(spotifyClient, tidalClient, playlists, LIBRARY_FILE,
+                                                                    journal, searchCache, spotifyStore, args.sync_remove,
+                                                                    likedSongsAsPlaylist, budget,
+                                                                    args.catalog_min_tracks)
+        spotifyStore.close()
+        spotifyClient.close()
+    if searchCache:
+        searchCache.printSummary()
+        searchCache.close()
+    journal.close()
+    if not completed or not exportComplete:
+        exit(1)
+    if failedTrackIds:
+        print(f"{len(failedTrackIds)} tracks could not be added to their playlists.")
     print("Tidal playlist population completed.")
+    if headless:
+        exit()
     if tracksNotFound:
         cmdinput = input("Some tracks were not found. Do you want to open the tidal_not_found.txt file? (y/n): ")
         if cmdinput.lower() == "y":